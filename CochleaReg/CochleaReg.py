@@ -165,6 +165,18 @@ class CochleaRegWidget(ScriptedLoadableModuleWidget):
     self.mainFormLayout.addRow(self.applyBtn, self.timeLbl)
     self.runBtn = self.applyBtn
 
+    # Create a button to cancel a running registration and a progress bar
+    self.cancelBtn = qt.QPushButton("Cancel")
+    self.cancelBtn.setFixedHeight(40)
+    self.cancelBtn.setFixedWidth (250)
+    self.cancelBtn.setEnabled(False)
+    self.cancelBtn.toolTip = ('Stop the running registration and remove its temporary files')
+    self.cancelBtn.connect('clicked(bool)', self.onCancelBtnClick)
+    self.progressBar = qt.QProgressBar()
+    self.progressBar.setRange(0,100)
+    self.progressBar.setValue(0)
+    self.mainFormLayout.addRow(self.cancelBtn, self.progressBar)
+
     self.layout.addStretch(1) # Collapsible button is held in place when collapsing/expanding.
 
   #------------------------------------------------------------------------
@@ -205,21 +217,45 @@ class CochleaRegWidget(ScriptedLoadableModuleWidget):
   def onApplyBtnClick(self):
       self.runBtn.setText("...please wait")
       self.runBtn.setStyleSheet("QPushButton{ background-color: red  }")
+      self.runBtn.setEnabled(False)
+      self.cancelBtn.setEnabled(True)
+      self.progressBar.setValue(0)
       slicer.app.processEvents()
       self.stm=time.time()
       print("time:" + str(self.stm))
       self.timeLbl.setText("                 Time: 00:00")
 
       print(type(self.fixedFiducialNode))
-      # create an option to use IJK point or fidicual node
-      registeredMovingVolumeNode =self.logic.run( self.fixedSelectorCoBx.currentNode(),self.fixedFiducialNode, self.movingSelectorCoBx.currentNode(),self.movingFiducialNode )
-      self.vsc.fuseTwoImages(self.fixedSelectorCoBx.currentNode(), registeredMovingVolumeNode, True)
+      # the long steps run in the background, Slicer stays usable during the registration
+      self.logic.progressCallback = self.onProgress
+      try:
+         # create an option to use IJK point or fidicual node
+         registeredMovingVolumeNode =self.logic.run( self.fixedSelectorCoBx.currentNode(),self.fixedFiducialNode, self.movingSelectorCoBx.currentNode(),self.movingFiducialNode )
+      finally:
+         self.runBtn.setEnabled(True)
+         self.cancelBtn.setEnabled(False)
+         self.runBtn.setText("Run")
+         self.runBtn.setStyleSheet("QPushButton{ background-color: DarkSeaGreen  }")
       self.etm=time.time()
       tm=self.etm - self.stm
+      if registeredMovingVolumeNode is None:
+         self.timeLbl.setText("Cancelled after: "+str(tm)+"  seconds")
+         return
+      if self.logic.errorMessage is not None:
+         self.timeLbl.setText("Failed after: "+str(tm)+"  seconds")
+         slicer.util.errorDisplay(self.logic.errorMessage, windowTitle="Cochlea registration")
+         return
+      self.vsc.fuseTwoImages(self.fixedSelectorCoBx.currentNode(), registeredMovingVolumeNode, True)
       self.timeLbl.setText("Time: "+str(tm)+"  seconds")
-      self.runBtn.setText("Run")
-      self.runBtn.setStyleSheet("QPushButton{ background-color: DarkSeaGreen  }")
       slicer.app.processEvents()
+
+  def onCancelBtnClick(self):
+      self.cancelBtn.setEnabled(False)
+      self.logic.cancel()
+
+  def onProgress(self, stage, percent):
+      self.progressBar.setValue(percent)
+      self.timeLbl.setText(stage + " ...  Time: " + "%.1f" % (time.time()-self.stm) + "  seconds")
  
   def cleanup(self):
       pass
@@ -228,23 +264,58 @@ class CochleaRegWidget(ScriptedLoadableModuleWidget):
 #                           Logic
 #===================================================================
 class CochleaRegLogic(ScriptedLoadableModuleLogic):
+  progressCallback = None # function(stage, percent)
+
   #--------------------------------------------------------------------------------------------
   #                       Registration Process
   #--------------------------------------------------------------------------------------------
   # This method perform the registration steps
+  # returns the registered moving volume node or None if the user cancelled,
+  # if it fails the reason is in self.errorMessage
   def run(self, fixedVolumeNode, fixedFiducialNode, movingVolumeNode, movingFiducialNode):
       logging.info('Processing started')
       print(fixedVolumeNode.GetName())
       print(movingVolumeNode.GetName())
       self.vsc   = VisSimCommon.VisSimCommonLogic()
+      self.vsc.progressCallback = self.progressCallback
       self.vsc.setGlobalVariables(0)
 
-      self.vsc.removeOtputsFolderContents()
+      # temporary files of this run are written to its own workspace
+      self.vsc.createWorkspace()
+      sceneNodeIDs = self.vsc.getSceneNodeIDs()
+      self.errorMessage = None
+      try:
+         with self.vsc.span("run"):
+              # the elastix preset and overrides are applied to a copy of the parameter file
+              self.vsc.createRunParameterFiles(['parsPath'], movingVolumeNode.GetName()+"_elastixParameters.json")
+              registeredMovingVolumeNode = self.runRegistration(fixedVolumeNode, fixedFiducialNode, movingVolumeNode, movingFiducialNode)
+              # an error code instead of the result, elastix keeps the reason of its errors
+              if isinstance(registeredMovingVolumeNode, int):
+                 self.errorMessage = getattr(self.vsc, 'lastError', None) or "Registration failed, see the Python console"
+      except VisSimCommon.VisSimCancelledError:
+         print("================= Cochlea registration is cancelled, cleaning up  =====================")
+         self.vsc.removeNewNodes(sceneNodeIDs, fixedVolumeNode.GetName())
+         self.vsc.removeNewNodes(sceneNodeIDs, movingVolumeNode.GetName())
+         movingVolumeNode.SetAndObserveTransformNodeID(None)
+         logging.info('Processing cancelled')
+         return None
+      finally:
+         # stage timings and elastix convergence of the run
+         self.vsc.writeTrace()
+         self.vsc.writeElastixRuns()
+         #Remove temporary files and nodes:
+         self.vsc.removeTmpsFiles([fixedFiducialNode, movingFiducialNode])
+      logging.info('Processing completed')
+      return registeredMovingVolumeNode
+
+  # stop the running registration, the running elastix process is killed
+  def cancel(self):
+      if hasattr(self, 'vsc'):
+         self.vsc.requestCancel()
 
+  def runRegistration(self, fixedVolumeNode, fixedFiducialNode, movingVolumeNode, movingFiducialNode):
       # results paths
-      resTransPath  = os.path.join(self.vsc.vtVars['outputPath'] ,"TransformParameters.0.txt")
-      resOldDefPath = os.path.join(self.vsc.vtVars['outputPath'] , "deformationField"+self.vsc.vtVars['imgType'])
-      resDefPath    = os.path.join(self.vsc.vtVars['outputPath'] , movingVolumeNode.GetName()+"_dFld"+self.vsc.vtVars['imgType'])
+      resDefPath    = os.path.join(self.vsc.getWorkPath() , movingVolumeNode.GetName()+"_dFld"+self.vsc.vtVars['imgType'])
       transNodeName = movingVolumeNode.GetName() + "_Transform"
 
       # Save original fixed and moving images
@@ -268,8 +339,7 @@ class CochleaRegLogic(ScriptedLoadableModuleLogic):
             print("Error: select cochlea fixed point")
             return -1
 
-      fnm = os.path.join(self.vsc.vtVars['outputPath'] , fixedVolumeNode.GetName()+"_F_Cochlea_Pos.fcsv")
-      sR = slicer.util.saveNode(fixedFiducialNode, fnm )
+      sR = self.vsc.saveResultNode(fixedFiducialNode, fixedVolumeNode.GetName()+"_F_Cochlea_Pos.fcsv")
 
       movingPoint = self.vsc.ptRAS2IJK(movingFiducialNode,movingVolumeNode,0)
       print("run moving point: ============================")
@@ -281,8 +351,7 @@ class CochleaRegLogic(ScriptedLoadableModuleLogic):
             print("Error: select cochlea moving point")
             return -1
 
-      fnm = os.path.join(self.vsc.vtVars['outputPath'] , movingVolumeNode.GetName()+"_M_Cochlea_Pos.fcsv")
-      sR = slicer.util.saveNode(movingFiducialNode, fnm )
+      sR = self.vsc.saveResultNode(movingFiducialNode, movingVolumeNode.GetName()+"_M_Cochlea_Pos.fcsv")
 
       #Remove old resulted nodes
       #for node in slicer.util.getNodes():
@@ -299,30 +368,56 @@ class CochleaRegLogic(ScriptedLoadableModuleLogic):
       movingPointT = self.vsc.v2t(movingPoint)
 
       print("=================== Cropping =====================")
-      self.vsc.vtVars['fixedCropPath'] = self.vsc.runCropping(fixedVolumeNode, fixedPointT,self.vsc.vtVars['croppingLength'],  self.vsc.vtVars['RSxyz'],  self.vsc.vtVars['hrChk'],0)
-      croppedFixedNode = slicer.util.loadVolume(self.vsc.vtVars['fixedCropPath'])
-      croppedFixedNode.SetName(fixedVolumeNode.GetName()+"_F_Crop")
+      self.vsc.setProgress("crop", 0, 10)
+      engine = self.vsc.getElastixEngine()
+      # both images are cropped with the same spacing, there is no atlas so adaptive
+      # resampling keeps RSxyz and only the preview spacing changes it
+      self.vsc.setResamplingSpacing([fixedVolumeNode, movingVolumeNode])
+      croppedFixedNode = self.vsc.runCroppingInMemory(fixedVolumeNode, fixedPointT,self.vsc.vtVars['croppingLength'],  self.vsc.vtVars['RSxyz'],  self.vsc.vtVars['hrChk'], fixedVolumeNode.GetName()+"_F_Crop")
+      fixedImg = self.vsc.croppedImage
+      if engine.needsFiles:
+         # elastix binaries need the cropped images as files
+         fixedCropPath = os.path.join(self.vsc.getWorkPath(), croppedFixedNode.GetName()+self.vsc.vtVars['imgType'])
+         fixedImg = self.vsc.writeCroppedImage(self.vsc.croppedImage, fixedCropPath)
+         self.vsc.vtVars['fixedCropPath'] = fixedImg
+
+      croppedMovingNode = self.vsc.runCroppingInMemory(movingVolumeNode, movingPointT,self.vsc.vtVars['croppingLength'],  self.vsc.vtVars['RSxyz'],  self.vsc.vtVars['hrChk'], movingVolumeNode.GetName()+"_M_Crop")
+      movingImg = self.vsc.croppedImage
+      if engine.needsFiles:
+         movingCropPath = os.path.join(self.vsc.getWorkPath(), croppedMovingNode.GetName()+self.vsc.vtVars['imgType'])
+         movingImg = self.vsc.writeCroppedImage(self.vsc.croppedImage, movingCropPath)
+         self.vsc.vtVars['movingCropPath'] = movingImg
 
-      self.vsc.vtVars['movingCropPath'] = self.vsc.runCropping(movingVolumeNode, movingPointT,self.vsc.vtVars['croppingLength'],  self.vsc.vtVars['RSxyz'],  self.vsc.vtVars['hrChk'],0)
-      croppedMovingNode = slicer.util.loadVolume(self.vsc.vtVars['movingCropPath'])
-      croppedMovingNode.SetName(movingVolumeNode.GetName()+"_M_Crop")
       print ("************  Register cropped moving image to cropped fixed image **********************")
-      cTI = self.vsc.runElastix(self.vsc.vtVars['elastixBinPath'],self.vsc.vtVars['fixedCropPath'],  self.vsc.vtVars['movingCropPath'], self.vsc.vtVars['outputPath'], self.vsc.vtVars['parsPath'], self.vsc.vtVars['noOutput'], "336")
-      #copyfile(resTransPathOld, resTransPath)
+      self.vsc.setProgress("registration", 10, 80)
+      [cTI, resImg, resTrans] = engine.register(fixedImg, movingImg, [self.vsc.vtVars['parsPath']], self.vsc.getWorkPath(), "336")
+      # no transform to move the image with
+      if not cTI == 0:
+         print("Error: registration failed")
+         return -1
       #genrates deformation field
-      cTR = self.vsc.runTransformix(self.vsc.vtVars['transformixBinPath'],self.vsc.vtVars['movingCropPath'], self.vsc.vtVars['outputPath'], resTransPath, self.vsc.vtVars['noOutput'], "339")
+      self.vsc.setProgress("transformix", 80, 90)
+      [cTR, resImg, resDef] = engine.transform(movingImg, resTrans, self.vsc.getWorkPath(), "339")
+      if not cTR == 0:
+         print("Error: can not compute the deformation field")
+         return -1
       # rename fthe file:
-      os.rename(resOldDefPath,resDefPath)
+      if isinstance(resDef, str):
+         os.rename(resDef,resDefPath)
+         resDef = resDefPath
 
       print ("************  Load deformation field Transform  **********************")
-      vtTransformNode = slicer.util.loadTransform(resDefPath)
-      vtTransformNode.SetName(transNodeName)
+      self.vsc.setProgress("warping", 90, 100)
+      vtTransformNode = self.vsc.loadDeformationField(resDef, transNodeName)
+      # keep the deformation field in the output folder
+      if isinstance(resDef, str):
+         self.vsc.publishFile(resDef)
       print ("************  Transform The Original Moving image **********************")
       movingVolumeNode.SetAndObserveTransformNodeID(vtTransformNode.GetID())
       #export seg to lbl then export back with input image as reference
-      slicer.vtkSlicerTransformLogic().hardenTransform(movingVolumeNode)     # apply the transform
-      fnm = os.path.join(self.vsc.vtVars['outputPath'] , movingVolumeNode.GetName()+"_Registered.nrrd")
-      sR = slicer.util.saveNode(movingVolumeNode, fnm )
+      with self.vsc.span("harden transform"):
+           slicer.vtkSlicerTransformLogic().hardenTransform(movingVolumeNode)     # apply the transform
+      fnm = self.vsc.saveResultNode(movingVolumeNode, movingVolumeNode.GetName()+"_Registered.nrrd")
       registeredMovingVolumeNode = slicer.util.loadVolume(fnm)
       registeredMovingVolumeNode.SetName(movingVolumeNode.GetName()+"_Registered")
       #remove the tempnode and load the original
@@ -334,10 +429,8 @@ class CochleaRegLogic(ScriptedLoadableModuleLogic):
       else:
            print("error happened during registration ")
 
-      #Remove temporary files and nodes:
-      self.vsc.removeTmpsFiles()
+      self.vsc.setProgress("done", 100)
       print("================= Cochlea registration is complete  =====================")
-      logging.info('Processing completed')
 
       return registeredMovingVolumeNode
 
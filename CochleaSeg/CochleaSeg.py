@@ -22,6 +22,7 @@
 # Non Slicer libs
 from __future__ import print_function
 import os, sys, time, re, shutil,  math, unittest, logging, zipfile, platform, subprocess, hashlib
+import csv, argparse, tempfile, multiprocessing, glob, collections, json
 from shutil import copyfile
 
 from six.moves.urllib.request import urlretrieve
@@ -130,6 +131,13 @@ class CochleaSegWidget(ScriptedLoadableModuleWidget):
     self.inputFiducialBtn.connect('clicked(bool)', lambda: self.onInputFiducialBtnClick("input"))
     self.mainFormLayout.addRow( self.inputFiducialBtn, self.inputPointEdt)
 
+    # Create a button to find the cochlea location without a fiducial
+    self.locateBtn = qt.QPushButton("Locate cochlea automatically")
+    self.locateBtn.setFixedHeight(40)
+    self.locateBtn.setToolTip("Find the cochlea location and side using the atlas images, check the point before running")
+    self.locateBtn.connect('clicked(bool)', self.onLocateBtnClick)
+    self.mainFormLayout.addRow(self.locateBtn)
+
 
     # Create a button to run segmentation
     self.applyBtn = qt.QPushButton("Run")
@@ -141,12 +149,34 @@ class CochleaSegWidget(ScriptedLoadableModuleWidget):
     self.mainFormLayout.addRow(self.applyBtn, self.timeLbl)
     self.runBtn = self.applyBtn
 
+    # Create a button to cancel a running segmentation and a progress bar
+    self.cancelBtn = qt.QPushButton("Cancel")
+    self.cancelBtn.setFixedHeight(40)
+    self.cancelBtn.setFixedWidth (250)
+    self.cancelBtn.setEnabled(False)
+    self.cancelBtn.toolTip = ('Stop the running segmentation and remove its temporary files')
+    self.cancelBtn.connect('clicked(bool)', self.onCancelBtnClick)
+    self.progressBar = qt.QProgressBar()
+    self.progressBar.setRange(0,100)
+    self.progressBar.setValue(0)
+    self.mainFormLayout.addRow(self.cancelBtn, self.progressBar)
+
     # Add check box for right ear side
     self.sideChkBox = qt.QCheckBox()
     self.sideChkBox.text = "Right side cochlea"
     self.sideChkBox.stateChanged.connect(self.onSideChkBoxChange)
     self.mainFormLayout.addRow(self.sideChkBox)
 
+    # Add check box to segment both cochleae, the second location is added with the Slicer Fiducial tool
+    self.bilateralChkBox = qt.QCheckBox()
+    self.bilateralChkBox.text = "Both cochleae (two locations)"
+    self.mainFormLayout.addRow(self.bilateralChkBox)
+
+    # Add check box for a fast preview at 0.25 mm
+    self.previewChkBox = qt.QCheckBox()
+    self.previewChkBox.text = "Fast preview (0.25 mm)"
+    self.mainFormLayout.addRow(self.previewChkBox)
+
     # Create and link Btn to update measuerments
     self.updateLengthBtn = qt.QPushButton("Update Length")
     self.updateLengthBtn.setFixedHeight(40)
@@ -175,33 +205,38 @@ class CochleaSegWidget(ScriptedLoadableModuleWidget):
           if ( "_tbl" in f.GetName() ):
              spTblNode = f
              break
-      # fidNames=["_StPts","_SvPts","_StLtPts","_StOcPts","_avPts"]
-      nodes = slicer.util.getNodesByClass('vtkMRMLMarkupsFiducialNode')
+      if spTblNode is None:
+         print("Error: run segmentation first")
+         return
+      # table items of each fiducial type, the rows are found by the item and the side so
+      # the table of one cochlea and the bilateral table with a Side column both work
+      fidItems = {"_StPts": ["Scala Tympani"], "_SvPts": ["Scala Vestibuli"], "_StLtPts": ["Length StLt"], "_StOcPts": ["Length StOc"],
+                  "_avPts": ["A-value Distance", "A-value StLt", "A-value StOc"]}
+      columns = [spTblNode.GetTable().GetColumn(j).GetName() for j in range(spTblNode.GetNumberOfColumns())]
+      itemCol   = columns.index("Item") if "Item" in columns else 0
+      sideCol   = columns.index("Side") if "Side" in columns else None
+      lengthCol = columns.index("Length (mm)")
+      rows = {}
+      for i in range(spTblNode.GetNumberOfRows()):
+          side = spTblNode.GetCellText(i, sideCol) if sideCol is not None else ""
+          rows[(side, spTblNode.GetCellText(i, itemCol))] = i
+
+      nodes = [f for f in slicer.util.getNodesByClass('vtkMRMLMarkupsFiducialNode') if any(f.GetName().endswith(n) for n in fidItems)]
+      lengths = self.vsc.getFiducialsLengths(nodes)
       for f in nodes:
-           if ( "_StPts" in f.GetName()) :
-                  # update length
-                  stLength  = str(self.vsc.getFiducilsDistance(f))
-                  spTblNode.SetCellText(0,2, stLength)
-           elif ( "_SvPts" in f.GetName()) :
-                  # update length
-                  svLength  = str(self.vsc.getFiducilsDistance(f))
-                  spTblNode.SetCellText(1,2, svLength)
-           elif ( "_StLtPts" in f.GetName()) :
-                  # update length
-                  stLtLength  = str(self.vsc.getFiducilsDistance(f))
-                  spTblNode.SetCellText(2,2, stLtLength)
-           elif ( "_StOcPts" in f.GetName()) :
-                  # update length
-                  stOcLength  = str(self.vsc.getFiducilsDistance(f))
-                  spTblNode.SetCellText(3,2, stOcLength)
-           elif ( "_avPts" in f.GetName()) :
-                  # update length
-                  aVal  = self.vsc.getFiducilsDistance(f)
-                  aValLengths  =self.logic.getAvalueLengths(aVal)
-                  spTblNode.SetCellText(4,2, str(aValLengths[0]))
-                  spTblNode.SetCellText(5,2, str(aValLengths[1]))
-                  spTblNode.SetCellText(6,2, str(aValLengths[2]))
-           spTblNode.Modified()
+           fidLength = lengths[f.GetID()]['length']
+           fidType = [n for n in fidItems if f.GetName().endswith(n)][0]
+           # the landmarks of the bilateral segmentation are named <volume>_<side><type>
+           side = ""
+           if sideCol is not None:
+              m = re.search(r'_([LR])' + fidType + '$', f.GetName())
+              side = m.group(1) if m else ""
+           fidLengths = self.logic.getAvalueLengths(fidLength) if fidType == "_avPts" else [fidLength]
+           for item, itemLength in zip(fidItems[fidType], fidLengths):
+               row = rows.get((side, item))
+               if row is not None:
+                  spTblNode.SetCellText(row, lengthCol, str(itemLength))
+      spTblNode.Modified()
 
   def onInputFiducialBtnClick(self,volumeType):
       self.inputFiducialBtn.setStyleSheet("QPushButton{ background-color: White  }")
@@ -228,49 +263,146 @@ class CochleaSegWidget(ScriptedLoadableModuleWidget):
 
 
 
+  def onLocateBtnClick(self):
+      inputVolumeNode = self.inputSelectorCoBx.currentNode()
+      if inputVolumeNode is None:
+         print("You need to pick a input volume first before locating the cochlea.", file=sys.stderr)
+         return
+      candidates, cochleaSide = self.logic.locateCochlea(inputVolumeNode)
+      if cochleaSide is None:
+         self.inputPointEdt.setText("cochlea is not found")
+         return
+      self.logic.inputFiducialNode = self.logic.createLocationNode(inputVolumeNode, candidates, self.bilateralChkBox.checked)
+      self.inputPointEdt.setText(str(candidates[0]['ijk']))
+      # the side check box updates vtVars['cochleaSide']
+      self.sideChkBox.checked = (cochleaSide == "R")
+      self.vsc.vtVars['cochleaSide'] = cochleaSide
+
   def onApplyBtnClick(self):
       self.runBtn.setText("...please wait")
       self.runBtn.setStyleSheet("QPushButton{ background-color: red  }")
+      self.runBtn.setEnabled(False)
+      self.cancelBtn.setEnabled(True)
+      self.progressBar.setValue(0)
       slicer.app.processEvents()
       self.stm=time.time()
       print("time:" + str(self.stm))
       self.timeLbl.setText("                 Time: 00:00")
 
-      self.logic.run( self.inputSelectorCoBx.currentNode(),self.logic.inputFiducialNode, self.vsc.vtVars['cochleaSide'] )
+      # the long steps run in the background, Slicer stays usable during the segmentation
+      self.logic.progressCallback = self.onProgress
+      customisedVtVars = {'resamplingMode': "preview"} if self.previewChkBox.checked else None
+      try:
+         if self.bilateralChkBox.checked:
+            segNode = self.logic.runBilateral( self.inputSelectorCoBx.currentNode(),self.logic.inputFiducialNode, customisedVtVars=customisedVtVars )
+         else:
+            segNode = self.logic.run( self.inputSelectorCoBx.currentNode(),self.logic.inputFiducialNode, self.vsc.vtVars['cochleaSide'], customisedVtVars=customisedVtVars )
+      finally:
+         self.runBtn.setEnabled(True)
+         self.cancelBtn.setEnabled(False)
+         self.runBtn.setText("Run")
+         self.runBtn.setStyleSheet("QPushButton{ background-color: DarkSeaGreen  }")
 
+      self.etm=time.time()
+      tm=self.etm - self.stm
+      if segNode is None:
+         self.timeLbl.setText("Cancelled after: "+str(tm)+"  seconds")
+         return
+      if self.logic.errorMessage is not None:
+         self.timeLbl.setText("Failed after: "+str(tm)+"  seconds")
+         slicer.util.errorDisplay(self.logic.errorMessage, windowTitle="Cochlea segmentation")
+         return
       slicer.app.layoutManager().setLayout( slicer.modules.tables.logic().GetLayoutWithTable(slicer.app.layoutManager().layout))
       slicer.app.applicationLogic().GetSelectionNode().SetActiveTableID(self.logic.spTblNode.GetID())
       slicer.app.applicationLogic().PropagateTableSelection()
 
-      self.etm=time.time()
-      tm=self.etm - self.stm
       self.timeLbl.setText("Time: "+str(tm)+"  seconds")
-      self.runBtn.setText("Run")
-      self.runBtn.setStyleSheet("QPushButton{ background-color: DarkSeaGreen  }")
       slicer.app.processEvents()
+
+  def onCancelBtnClick(self):
+      self.cancelBtn.setEnabled(False)
+      self.logic.cancel()
+
+  def onProgress(self, stage, percent):
+      self.progressBar.setValue(percent)
+      self.timeLbl.setText(stage + " ...  Time: " + "%.1f" % (time.time()-self.stm) + "  seconds")
   
 #===================================================================
 #                           Logic
 #===================================================================
 class CochleaSegLogic(ScriptedLoadableModuleLogic):
+  progressCallback = None # function(stage, percent)
+
   #--------------------------------------------------------------------------------------------
   #                       Segmentation Process
   #--------------------------------------------------------------------------------------------
   # This method perform the atlas segementation steps
-  def run(self, inputVolumeNode, inputFiducialNode, cochleaSide, customisedOutputPath=None,customisedParPath=None):
+  # returns the segmentation node or None if the user cancelled
+  # customisedVtVars: global variables to change, e.g. {'RSxyz': "[ 0.25, 0.25 , 0.25 ]"}
+  #                   or {'elastixPreset': "fast", 'elastixParameters': "NumberOfResolutions=3"}
+  def run(self, inputVolumeNode, inputFiducialNode, cochleaSide, customisedOutputPath=None,customisedParPath=None, customisedVtVars=None):
+    return self.runInWorkspace(lambda: self.runSegmentation(inputVolumeNode, inputFiducialNode, cochleaSide),
+                               inputVolumeNode, customisedOutputPath, customisedParPath, customisedVtVars, [inputFiducialNode])
+
+  # segment both cochleae, the fiducial node has the two locations
+  # returns the segmentation nodes or None if the user cancelled
+  def runBilateral(self, inputVolumeNode, inputFiducialNode, customisedOutputPath=None,customisedParPath=None, customisedVtVars=None):
+    return self.runInWorkspace(lambda: self.runBilateralSegmentation(inputVolumeNode, inputFiducialNode),
+                               inputVolumeNode, customisedOutputPath, customisedParPath, customisedVtVars, [inputFiducialNode])
+
+  # run a segmentation function with the global variables set and its own workspace,
+  # if it returns an error code the reason is in self.errorMessage
+  # locationNodes: location markups of the run, they are hidden at the end
+  def runInWorkspace(self, segmentationFunc, inputVolumeNode, customisedOutputPath=None,customisedParPath=None, customisedVtVars=None, locationNodes=[]):
     logging.info('Processing started')
  
     self.vsc   = VisSimCommon.VisSimCommonLogic()
+    self.vsc.progressCallback = self.progressCallback
     self.vsc.setGlobalVariables(0)
     
     if customisedOutputPath is not None: 
        self.vsc.vtVars['outputPath'] = customisedOutputPath
     if customisedParPath is not None: 
        self.vsc.vtVars['parsPath'] = customisedParPath
-    
+    if customisedVtVars is not None:
+       self.vsc.vtVars.update(customisedVtVars)
+
+    # temporary files of this run are written to its own workspace
+    self.vsc.createWorkspace()
+    sceneNodeIDs = self.vsc.getSceneNodeIDs()
+    self.errorMessage = None
+    try:
+       with self.vsc.span("run"):
+            # the elastix preset and overrides are applied to copies of the parameter files
+            self.vsc.createRunParameterFiles(['parsPath', 'parsNRPath'], inputVolumeNode.GetName()+"_elastixParameters.json")
+            chSegNode = segmentationFunc()
+            # an error code instead of the result, elastix keeps the reason of its errors
+            if isinstance(chSegNode, int):
+               self.errorMessage = getattr(self.vsc, 'lastError', None) or "Segmentation failed, see the Python console"
+    except VisSimCommon.VisSimCancelledError:
+       print("================= Cochlea analysis is cancelled, cleaning up  =====================")
+       self.vsc.removeNewNodes(sceneNodeIDs, inputVolumeNode.GetName())
+       logging.info('Processing cancelled')
+       return None
+    finally:
+       # stage timings and elastix convergence of the run
+       self.vsc.writeTrace()
+       self.vsc.writeElastixRuns()
+       #Remove temporary files and nodes:
+       self.vsc.removeTmpsFiles(locationNodes)
+    logging.info('Processing completed')
+    return chSegNode
+
+  # stop the running segmentation, the running elastix process is killed
+  def cancel(self):
+    if hasattr(self, 'vsc'):
+       self.vsc.requestCancel()
+
+  def runSegmentation(self, inputVolumeNode, inputFiducialNode, cochleaSide):
     print("inputVolumeNode       = ",inputVolumeNode.GetName())
     print("inputFiducialNode     = ", inputFiducialNode.GetName())
     print("outputPath            = ", self.vsc.vtVars['outputPath'])
+    print("workPath              = ", self.vsc.getWorkPath())
     print("parsPath              = ", self.vsc.vtVars['parsPath'])
     
     self.inputVolumeNode = inputVolumeNode
@@ -292,20 +424,12 @@ class CochleaSegLogic(ScriptedLoadableModuleLogic):
     modelImgStOcPtPath =   os.path.join(self.vsc.vtVars['modelPath'] , "Mdl"+Styp +cochleaSide +"c_StOcPt.fcsv") # Scala Tympani A-value Organ of corti
     modelImgAvPtPath   =   os.path.join(self.vsc.vtVars['modelPath'] , "Mdl"+Styp +cochleaSide +"c_AvPt.fcsv") # A-value two points 
  
-    # set the results paths:
-    resImgPathOld  = os.path.join(self.vsc.vtVars['outputPath'] ,"result.0.nrrd")
-    resImgRgPath   = os.path.join(self.vsc.vtVars['outputPath'] ,"result.Rg.nrrd") 
-    resImgNRgPath   = os.path.join(self.vsc.vtVars['outputPath'] ,"result.NRg.nrrd") 
-    
-    resTransPathOld  = os.path.join(self.vsc.vtVars['outputPath'] ,"TransformParameters.0.txt")
-    resTransRgPath=resTransPathOld[0:-6]+'_Rg_Pars.txt'
-    resTransNRgPath=resTransPathOld[0:-6]+'_NRg_Pars.txt'
+    # set the results paths, rigid and non-rigid registration run in one elastix call
+    resRegPath  = os.path.join(self.vsc.getWorkPath() ,"Reg")
 
     node_name = inputVolumeNode.GetName()
 
-    resOldDefPath = os.path.join(self.vsc.vtVars['outputPath'] , "deformationField"+self.vsc.vtVars['imgType'])
-    resDefRgPath    = os.path.join(self.vsc.vtVars['outputPath'] , node_name+"_Rg_dFld"+self.vsc.vtVars['imgType'])
-    resDefNRgPath    = os.path.join(self.vsc.vtVars['outputPath'] , node_name+"_NRg_dFld"+self.vsc.vtVars['imgType'])
+    resDefPath    = os.path.join(self.vsc.getWorkPath() , node_name+"_dFld"+self.vsc.vtVars['imgType'])
 
     segNodeName   = node_name + "_S.Seg"
 
@@ -315,10 +439,8 @@ class CochleaSegLogic(ScriptedLoadableModuleLogic):
     stOcPtNodeName = node_name + "_StOcPts"
     avPtNodeName   = node_name + "_avPts"
 
-    transRgNodeName = node_name  + "_Rg_Transform"
-    transNRgNodeName = node_name + "_NRg_Transform"
+    transNodeName = node_name  + "_Transform"
 
-    self.vsc.removeOtputsFolderContents()
       # check if the model is found
     if not os.path.isfile(modelPath):
         print("ERROR: model is not found", file=sys.stderr)
@@ -333,142 +455,325 @@ class CochleaSegLogic(ScriptedLoadableModuleLogic):
            print("Error: select cochlea point")
            return -1
 
-    fnm = os.path.join(self.vsc.vtVars['outputPath'] , inputVolumeNode.GetName()+"_Cochlea_Pos.fcsv")
-    sR = slicer.util.saveNode(inputFiducialNode, fnm )
+    sR = self.vsc.saveResultNode(inputFiducialNode, inputVolumeNode.GetName()+"_Cochlea_Pos.fcsv")
     
     #Remove old resulted nodes
     for node in slicer.util.getNodes():
          if ( segNodeName   == node): slicer.mrmlScene.RemoveNode(node)  
-         if ( transRgNodeName == node): slicer.mrmlScene.RemoveNode(node)  
-         if ( transNRgNodeName == node): slicer.mrmlScene.RemoveNode(node)  
+         if ( transNodeName == node): slicer.mrmlScene.RemoveNode(node)  
  
     inputPointT = self.vsc.v2t(inputPoint)
     
     print("=================== Cropping =====================")
-    self.vsc.vtVars['intputCropPath'] = self.vsc.runCropping(inputVolumeNode, inputPointT,self.vsc.vtVars['croppingLength'],  self.vsc.vtVars['RSxyz'],  self.vsc.vtVars['hrChk'],0)
-    croppedNode = slicer.util.loadVolume(self.vsc.vtVars['intputCropPath'])
-    croppedNode.SetName(inputVolumeNode.GetName()+"_Crop")
-    
-    print("=================== Registration =====================")
-    
-    print ("************  Rigid Registeration: model to cropped input image **********************")
-     
-    cTIr = self.vsc.runElastix(self.vsc.vtVars['elastixBinPath'],self.vsc.vtVars['intputCropPath'],  modelPath, self.vsc.vtVars['outputPath'], self.vsc.vtVars['parsPath'], self.vsc.vtVars['noOutput'], "292")
-    
-    os.rename(resImgPathOld,resImgRgPath)
-    os.rename(resTransPathOld,resTransRgPath)
-    
-    #genrates deformation field
-    cTRr = self.vsc.runTransformix(self.vsc.vtVars['transformixBinPath'],modelPath, self.vsc.vtVars['outputPath'], resTransRgPath, self.vsc.vtVars['noOutput'], "295")
-    # rename fthe file:
-    os.rename(resOldDefPath,resDefRgPath)
-     
-    print ("************  Non-Rigid Registeration: registered model to cropped input image **********************")
-     
-    cTInr = self.vsc.runElastix(self.vsc.vtVars['elastixBinPath'],self.vsc.vtVars['intputCropPath'],  resImgRgPath, self.vsc.vtVars['outputPath'], self.vsc.vtVars['parsNRPath'], self.vsc.vtVars['noOutput'], "292")
-     
-    os.rename(resImgPathOld,resImgNRgPath)
-    os.rename(resTransPathOld,resTransNRgPath)
+    self.vsc.setProgress("crop", 0, 10)
+    self.vsc.setResamplingSpacing([inputVolumeNode], [a['image'] for a in self.getCochleaAtlases(cochleaSide, Styp)] or [modelPath])
+    croppedNode = self.vsc.runCroppingInMemory(inputVolumeNode, inputPointT,self.vsc.vtVars['croppingLength'],  self.vsc.vtVars['RSxyz'],  self.vsc.vtVars['hrChk'], inputVolumeNode.GetName()+"_Crop")
+    engine = self.vsc.getElastixEngine()
+    fixedImg = self.vsc.croppedImage
+    if engine.needsFiles:
+       # elastix binaries need the cropped image as a file
+       intputCropPath = os.path.join(self.vsc.getWorkPath(), croppedNode.GetName()+self.vsc.vtVars['imgType'])
+       fixedImg = self.vsc.writeCroppedImage(self.vsc.croppedImage, intputCropPath)
+       self.vsc.vtVars['intputCropPath'] = fixedImg
+    # the in-process engine uses the cached model image
+    modelImg = modelPath if engine.needsFiles else self.vsc.getAtlasImage(modelPath)
+
+    # all point sets are warped together, Scala Tympani, Scala Vestibuli, A-value Scala Tempany Lateral,
+    # A-value Organ of Corti and A-value points
+    ptsNodeNames  = [stPtNodeName, svPtNodeName, stLtPtNodeName, stOcPtNodeName, avPtNodeName]
+    ptsModelPaths = [modelImgStPtPath, modelImgSvPtPath, modelImgStLtPtPath, modelImgStOcPtPath, modelImgAvPtPath]
+
+    # more than one atlas: multi-atlas segmentation
+    atlases = self.getCochleaAtlases(cochleaSide, Styp)[0:int(self.vsc.vtVars['atlasCount'])]
+    regCache = VisSimCommon.VisSimRegistrationCache(self.vsc)
+    cacheKey = self.getEarCacheKey(regCache, self.vsc.croppedImage, inputPoint, cochleaSide,
+                                   atlases if len(atlases) > 1 else [{'image': modelPath, 'seg': modelSegPath, 'points': ptsModelPaths}])
+    cachedPath = regCache.load(cacheKey) if self.vsc.s2b(self.vsc.vtVars['regCache']) else None
+    if cachedPath is not None:
+       print("=================== Registration (cached) =====================")
+       print("cachedPath            = ", cachedPath)
+       self.vsc.setProgress("registration", 10, 90)
+       cTInr = cTRnr = 0
+       [chSegNode, ptsNodes] = regCache.loadResult(cachedPath, segNodeName, ptsNodeNames, ptsModelPaths)
+    elif len(atlases) > 1:
+       print("=================== Multi-atlas Registration =====================")
+       # the labels and points are moved with transformix, no deformation fields
+       self.vsc.setProgress("registration", 10, 90)
+       [cTInr, chSegNode, ptsNodes, atlasResults] = self.runMultiAtlasRegistration(atlases, fixedImg, segNodeName, ptsNodeNames, node_name+"_atlasTimings.csv")
+       cTRnr = 0
+       if chSegNode is None:
+          return -1
+       if self.vsc.s2b(self.vsc.vtVars['regCache']):
+          transforms = [[r['engine'], r['transform']] for r in atlasResults if r['error'] == 0]
+          regCache.store(cacheKey, lambda entryPath: regCache.saveResult(entryPath, chSegNode, ptsNodes, transforms))
+    else:
+       print("=================== Registration =====================")
     
-    #genrates deformation field
-    cTRnr = self.vsc.runTransformix(self.vsc.vtVars['transformixBinPath'],resImgNRgPath, self.vsc.vtVars['outputPath'], resTransNRgPath, self.vsc.vtVars['noOutput'], "295")
-    # rename fthe file:
-    os.rename(resOldDefPath,resDefNRgPath)
-         
-    print ("************  Load deformation field Transforms  **********************")
-    vtRgTransformNode = slicer.util.loadTransform(resDefRgPath)
-    vtRgTransformNode.SetName(transRgNodeName)
-  
-    vtNRgTransformNode = slicer.util.loadTransform(resDefNRgPath)
-    vtNRgTransformNode.SetName(transNRgNodeName)
-  
-    #combine the transforms      
-    vtNRgTransformNode.SetAndObserveTransformNodeID(vtRgTransformNode.GetID())
-    slicer.vtkSlicerTransformLogic().hardenTransform(vtNRgTransformNode)    
-    chTransformNode = vtNRgTransformNode
-       
-    print ("************  Transform The Segmentation **********************")
-    chSegNode = slicer.util.loadSegmentation(modelSegPath)
-    chSegNode.SetName(segNodeName)
+       print ("************  Rigid and Non-Rigid Registeration: model to cropped input image **********************")
+       # the rigid stage is the initial transform of the non-rigid stage, the result is one composite
+       # transform, only the final result image is needed
+       rigidParsPath = self.vsc.writeTransformParameters(self.vsc.vtVars['parsPath'], os.path.join(self.vsc.getWorkPath(), "parsRigid.txt"), {"WriteResultImage": '"false"'})
+       self.vsc.setProgress("registration", 10, 75)
+       [cTInr, resImg, resTrans] = engine.register(fixedImg, modelImg, [rigidParsPath, self.vsc.vtVars['parsNRPath']], resRegPath, "292")
+       # no transform to warp the atlas with
+       if not cTInr == 0:
+          print("Error: registration failed")
+          return -1
+
+       if self.vsc.vtVars['warpMode'] == "field":
+          self.vsc.setProgress("warping", 75, 90)
+          [cTRnr, chSegNode, ptsNodes] = self.warpWithDeformationField(engine, modelImg, modelSegPath, ptsModelPaths, resTrans, resRegPath,
+                                                                       resDefPath, transNodeName, segNodeName, ptsNodeNames)
+          if not cTRnr == 0:
+             return -1
+       else:
+          # no deformation field: transformix moves the segmentation labels and the points
+          print ("************  Transform The Segmentation **********************")
+          self.vsc.setProgress("warping", 75, 80)
+          transPath = os.path.join(self.vsc.getWorkPath(), "Warp")
+          [cTRnr, chSegNode] = self.vsc.warpAtlasSegmentation(engine, modelSegPath, segNodeName, resTrans, transPath, "295")
+          if chSegNode is None:
+             print("Error: can not transform the segmentation")
+             return -1
+
+          print ("************  Transform The Landmarks: St, Sv, StLt, StOc and Av Points **********************")
+          self.vsc.setProgress("warping", 80, 90)
+          ptsNodes = self.vsc.loadInverseWarpedAtlasLandmarks(engine, ptsModelPaths, ptsNodeNames, resTrans, transPath)
+          if ptsNodes is None:
+             print("Error: can not transform the landmarks")
+             return -1
+
+       if self.vsc.s2b(self.vsc.vtVars['regCache']) and (cTInr==0) and (cTRnr==0):
+          regCache.store(cacheKey, lambda entryPath: regCache.saveResult(entryPath, chSegNode, ptsNodes, [[engine, resTrans]]))
+
+    self.exportEarResults(chSegNode, ptsNodes)
+
+    # Display the result if no error
+    # Clear cochlea location labels
+    if  (cTInr==0) and (cTRnr==0):
+        # change the model type from vtk to stl
+        msn=slicer.vtkMRMLModelStorageNode()
+        msn.SetDefaultWriteFileExtension('stl')
+        slicer.mrmlScene.AddDefaultNode(msn)
+        self.vsc.setProgress("stats", 90, 100)
+        spTblNode = self.createEarTable(chSegNode, croppedNode, inputVolumeNode.GetName()+"_tbl")
+        #spTblNode.RemoveRow(spTblNode.GetNumberOfRows())            
+        self.spTblNode=spTblNode
+        sR = self.vsc.saveResultNode(spTblNode, spTblNode.GetName()+".tsv")
+    else:
+         print("error happened during segmentation ")
+ 
+    self.vsc.setProgress("done", 100)
+    print("================= Cochlea analysis is complete  =====================")
+    return chSegNode
       
-    chSegNode.SetAndObserveTransformNodeID(chTransformNode.GetID())
-    slicer.vtkSlicerTransformLogic().hardenTransform(chSegNode)     # apply the transform
+ 
+  #--------------------------------------------------------------------------------------------
+  #                       Cochlea Localization
+  #--------------------------------------------------------------------------------------------
+  # Find the cochlea without a fiducial point, the default atlas images of both sides are the
+  # templates. Returns the candidates (ijk, ras, score and side) with the best first and the
+  # detected side.
+  def locateCochlea(self, inputVolumeNode, maxCandidates=3):
+      if not hasattr(self, 'vsc'):
+         self.vsc = VisSimCommon.VisSimCommonLogic()
+         self.vsc.setGlobalVariables(0)
+      templates = {}
+      for side in ["L", "R"]:
+          atlases = self.getCochleaAtlases(side)
+          if len(atlases) > 0:
+             templates[side] = self.vsc.getAtlasImage(atlases[0]['image'])
+      if len(templates) == 0:
+         print("ERROR: model is not found", file=sys.stderr)
+         return [], None
+      candidates = self.vsc.locateTemplates(inputVolumeNode, templates, float(self.vsc.vtVars['locatorSpacing']), maxCandidates)
+      for candidate in candidates:
+          candidate['side'] = candidate['template']
+      cochleaSide = candidates[0]['side'] if len(candidates) > 0 else None
+      print("detected cochlea side  = ", cochleaSide)
+      return candidates, cochleaSide
+
+  # the best candidate, or the best of each side for both cochleae, as a fiducial node
+  def createLocationNode(self, inputVolumeNode, candidates, bilateral=False):
+      if bilateral:
+         candidates = [[c for c in candidates if c['side'] == side][0] for side in ["L", "R"] if any(c['side'] == side for c in candidates)]
+      else:
+         candidates = candidates[0:1]
+      nodeName = inputVolumeNode.GetName() + "_CochleaLocation"
+      for node in slicer.util.getNodesByClass('vtkMRMLMarkupsFiducialNode'):
+          if node.GetName() == nodeName:
+             slicer.mrmlScene.RemoveNode(node)
+      inputFiducialNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
+      inputFiducialNode.CreateDefaultDisplayNodes()
+      inputFiducialNode.SetName(nodeName)
+      for candidate in candidates:
+          idx = inputFiducialNode.AddControlPoint(candidate['ras'].tolist())
+          inputFiducialNode.SetNthControlPointLabel(idx, "_CochleaLocation_" + candidate['side'])
+      return inputFiducialNode
+
+  #--------------------------------------------------------------------------------------------
+  #                       Bilateral Segmentation
+  #--------------------------------------------------------------------------------------------
+  # Both cochleae from one volume, the first two points of the fiducial node are the locations,
+  # the right cochlea has the larger RAS x. The volume array is taken once for both crops,
+  # the atlases of both sides are registered at the same time and one table is written.
+  # Each cochlea is looked up in the registration cache and warped as in runSegmentation,
+  # with one atlas and vtVars['warpMode'] = "field" the deformation field is computed after
+  # the registrations.
+  def runBilateralSegmentation(self, inputVolumeNode, inputFiducialNode):
+    print("inputVolumeNode       = ",inputVolumeNode.GetName())
+    print("inputFiducialNode     = ", inputFiducialNode.GetName())
+    print("outputPath            = ", self.vsc.vtVars['outputPath'])
+    print("workPath              = ", self.vsc.getWorkPath())
+
+    self.inputVolumeNode = inputVolumeNode
+    self.inputFiducialNode = inputFiducialNode
+    node_name = inputVolumeNode.GetName()
+
+    if inputFiducialNode.GetNumberOfControlPoints() < 2:
+       print("Error: select the locations of both cochleae")
+       return -1
+    ptsRAS = slicer.util.arrayFromMarkupsControlPoints(inputFiducialNode)
+    sides  = ["R","L"] if ptsRAS[0][0] > ptsRAS[1][0] else ["L","R"]
+    sR = self.vsc.saveResultNode(inputFiducialNode, node_name+"_Cochlea_Pos.fcsv")
+
+    print("=================== Cropping =====================")
+    self.vsc.setProgress("crop", 0, 10)
+    # both crops are copied from the same array
+    volumeArray = slicer.util.arrayFromVolume(inputVolumeNode)
+    engine = self.vsc.getElastixEngine()
+    self.vsc.setResamplingSpacing([inputVolumeNode], [a['image'] for side in sides for a in self.getCochleaAtlases(side)])
+    useCache = self.vsc.s2b(self.vsc.vtVars['regCache'])
+    regCache = VisSimCommon.VisSimRegistrationCache(self.vsc)
+    ears = []
+    for i in range(2):
+        earName = node_name + "_" + sides[i]
+        for node in slicer.util.getNodes():
+            if (node in [earName + "_S.Seg", earName + "_Transform"]): slicer.mrmlScene.RemoveNode(slicer.util.getNode(node))
+        inputPoint = self.vsc.ptRAS2IJK(inputFiducialNode, inputVolumeNode, i)
+        croppedNode = self.vsc.runCroppingInMemory(inputVolumeNode, self.vsc.v2t(inputPoint), self.vsc.vtVars['croppingLength'], self.vsc.vtVars['RSxyz'],
+                                                   self.vsc.vtVars['hrChk'], earName+"_Crop", volumeArray)
+        fixedImg = self.vsc.croppedImage
+        if engine.needsFiles:
+           fixedImg = self.vsc.writeCroppedImage(fixedImg, os.path.join(self.vsc.getWorkPath(), croppedNode.GetName()+self.vsc.vtVars['imgType']))
+        atlases = self.getCochleaAtlases(sides[i])[0:max(1, int(self.vsc.vtVars['atlasCount']))]
+        if len(atlases) == 0:
+           print("ERROR: model is not found", file=sys.stderr)
+           return -1
+        cacheKey = self.getEarCacheKey(regCache, self.vsc.croppedImage, inputPoint, sides[i], atlases)
+        ears.append({'side'       : sides[i],
+                     'name'       : earName,
+                     'croppedNode': croppedNode,
+                     'fixedImg'   : fixedImg,
+                     'atlases'    : atlases,
+                     'segmentIDs' : VisSimCommon.VisSimAtlasCache.instance().getLabelImage(atlases[0]['seg'])[1],
+                     'cacheKey'   : cacheKey,
+                     'cachedPath' : regCache.load(cacheKey) if useCache else None,
+                     'fieldWarp'  : len(atlases) == 1 and self.vsc.vtVars['warpMode'] == "field"})
+
+    print("=================== Registration =====================")
+    self.vsc.setProgress("registration", 10, 90)
+    # the atlases of both sides share the elastix threads, cached sides are not registered
+    regEars = [ear for ear in ears if ear['cachedPath'] is None]
+    atlasResults = []
+    if len(regEars) > 0:
+       jobThreads = self.getAtlasJobThreads(sum(len(ear['atlases']) for ear in regEars))
+       print("threads per atlas     = ", jobThreads)
+       jobs = []
+       for ear in regEars:
+           jobs += self.createAtlasJobs(ear['atlases'], ear['fixedImg'], ear['segmentIDs'], jobThreads, ear['name'], not ear['fieldWarp'])
+       t0 = time.time()
+       atlasResults = self.vsc.runInThreads(jobs)
+       print("bilateral registration: %.1f s" % (time.time() - t0))
+
+    self.vsc.setProgress("stats", 90, 100)
+    segNodes = []
+    earTables = []
+    ptsSuffixes = ["_StPts", "_SvPts", "_StLtPts", "_StOcPts", "_avPts"]
+    for ear in ears:
+        segNodeName  = ear['name'] + "_S.Seg"
+        ptsNodeNames = [ear['name'] + ptsSuffix for ptsSuffix in ptsSuffixes]
+        if ear['cachedPath'] is not None:
+           print("registration of the " + ear['side'] + " cochlea is taken from the cache: " + ear['cachedPath'])
+           [chSegNode, ptsNodes] = regCache.loadResult(ear['cachedPath'], segNodeName, ptsNodeNames, ear['atlases'][0]['points'])
+        else:
+           earResults   = atlasResults[0:len(ear['atlases'])]
+           atlasResults = atlasResults[len(ear['atlases']):]
+           self.writeAtlasTimings(earResults, ear['name']+"_atlasTimings.csv")
+           if ear['fieldWarp'] and earResults[0]['error'] == 0:
+              atlas  = ear['atlases'][0]
+              engine = earResults[0]['engine']
+              modelImg = atlas['image'] if engine.needsFiles else self.vsc.getAtlasImage(atlas['image'])
+              [cT, chSegNode, ptsNodes] = self.warpWithDeformationField(engine, modelImg, atlas['seg'], atlas['points'], earResults[0]['transform'],
+                                                                        os.path.join(self.vsc.getWorkPath(), ear['name'], "Field"),
+                                                                        os.path.join(self.vsc.getWorkPath(), ear['name']+"_dFld"+self.vsc.vtVars['imgType']),
+                                                                        ear['name']+"_Transform", segNodeName, ptsNodeNames)
+           elif ear['fieldWarp']:
+              print("Error: registration of the " + ear['side'] + " cochlea failed")
+              cT = 1
+           else:
+              [cT, chSegNode, ptsNodes] = self.fuseAtlasResults(earResults, ear['atlases'], ear['segmentIDs'], segNodeName, ptsNodeNames)
+           if not cT == 0:
+              print("error happened during segmentation of the " + ear['side'] + " cochlea")
+              return -1
+           if useCache:
+              transforms = [[r['engine'], r['transform']] for r in earResults if r['error'] == 0]
+              regCache.store(ear['cacheKey'], lambda entryPath: regCache.saveResult(entryPath, chSegNode, ptsNodes, transforms))
+        self.exportEarResults(chSegNode, ptsNodes)
+        earTables.append([ear['side'], self.createEarTable(chSegNode, ear['croppedNode'], ear['name']+"_tbl")])
+        segNodes.append(chSegNode)
+
+    # one table for both sides
+    tableName = node_name+"_tbl"
+    for node in slicer.util.getNodes():
+        if (tableName == node): slicer.mrmlScene.RemoveNode(slicer.util.getNode(node))
+    spTblNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
+    spTblNode.SetName(tableName)
+    for colName in ["Side", "Item", "Size (mm^3)", "Length (mm)"]:
+        spTblNode.AddColumn().SetName(colName)
+    for side, earTblNode in earTables:
+        for i in range(earTblNode.GetNumberOfRows()):
+            idx = spTblNode.AddEmptyRow()
+            spTblNode.SetCellText(idx, 0, side)
+            for j in range(3):
+                spTblNode.SetCellText(idx, j+1, earTblNode.GetCellText(i, j))
+        slicer.mrmlScene.RemoveNode(earTblNode)
+    spTblNode.SetColumnProperty('B','Width','250')
+    spTblNode.Modified()
+    self.spTblNode=spTblNode
+    sR = self.vsc.saveResultNode(spTblNode, spTblNode.GetName()+".tsv")
+
+    self.vsc.setProgress("done", 100)
+    print("================= Bilateral cochlea analysis is complete  =====================")
+    return segNodes
+
+  # surface, lengths and A-value of one cochlea, the segmentation and the landmarks are
+  # saved to the output folder, the lengths are kept in vtVars
+  def exportEarResults(self, chSegNode, ptsNodes):
     #export seg to lbl then export back with input image as reference
     chSegNode.CreateClosedSurfaceRepresentation()
-    fnm = os.path.join(self.vsc.vtVars['outputPath'] , chSegNode.GetName()+".nrrd")
-    sR = slicer.util.saveNode(chSegNode, fnm )
-
-    print ("************  Transform The Scala Tympani (St) Points **********************")
-    # transform the Scala Tympani Points for length Computation
-    chImgStPtNode = slicer.util.loadMarkupsFiducialList  (modelImgStPtPath, returnNode = True)
-    chImgStPtNode.GetDisplayNode().SetSelectedColor(1,1,0)
-    chImgStPtNode.GetDisplayNode().SetTextScale(0)
-    chImgStPtNode.GetDisplayNode().SetGlyphScale(0.1)
-    chImgStPtNode.SetName(stPtNodeName)
-# 
-# #     chTransformNode.Inverse()
-    chImgStPtNode.SetAndObserveTransformNodeID(chTransformNode.GetID())
-    slicer.vtkSlicerTransformLogic().hardenTransform(chImgStPtNode)     # apply the transform
-    fnm = os.path.join(self.vsc.vtVars['outputPath'] , chImgStPtNode.GetName()+".fcsv")
-    sP1 = slicer.util.saveNode(chImgStPtNode, fnm )
-    self.vsc.vtVars['StLength']  = str(self.vsc.getFiducilsDistance(chImgStPtNode ))
- 
-    print ("************  Transform The Scala Vestibuli (Sv) Points **********************")
-    chImgSvPtNode = slicer.util.loadMarkupsFiducialList  (modelImgSvPtPath, returnNode = True)
-    chImgSvPtNode.GetDisplayNode().SetSelectedColor(0,0,0)
-    chImgSvPtNode.GetDisplayNode().SetTextScale(0)
-    chImgSvPtNode.GetDisplayNode().SetGlyphScale(0.1)
-    chImgSvPtNode.SetName(svPtNodeName)
- 
-    chImgSvPtNode.SetAndObserveTransformNodeID(chTransformNode.GetID())
-    slicer.vtkSlicerTransformLogic().hardenTransform(chImgSvPtNode) # apply the transform
- 
-    fnm = os.path.join(self.vsc.vtVars['outputPath'] , chImgSvPtNode.GetName()+".fcsv")
-    sP2 = slicer.util.saveNode(chImgSvPtNode, fnm )
-    self.vsc.vtVars['SvLength']  = str(self.vsc.getFiducilsDistance(chImgSvPtNode ))
- 
-    print ("************  Transform The A-value Scala Tempany Lateral (StL) Points *******")
-    chImgStLtPtNode = slicer.util.loadMarkupsFiducialList  (modelImgStLtPtPath, returnNode = True)
-    chImgStLtPtNode.GetDisplayNode().SetSelectedColor(1,0,1)
-    chImgStLtPtNode.GetDisplayNode().SetTextScale(0)
-    chImgStLtPtNode.GetDisplayNode().SetGlyphScale(0.1)
-    chImgStLtPtNode.SetName(stLtPtNodeName)
-#       
-    chImgStLtPtNode.SetAndObserveTransformNodeID(chTransformNode.GetID())
-    slicer.vtkSlicerTransformLogic().hardenTransform(chImgStLtPtNode) # apply the transform
-       
-    fnm = os.path.join(self.vsc.vtVars['outputPath'] , chImgStLtPtNode.GetName()+".fcsv")
-    sP3 = slicer.util.saveNode(chImgStLtPtNode, fnm )
-    self.vsc.vtVars['StLtLength']  = str(self.vsc.getFiducilsDistance(chImgStLtPtNode ))
-
-    print ("************  Transform The A-value Organ od Corti (OC) Points ***************")
-    chImgStOcPtNode = slicer.util.loadMarkupsFiducialList  (modelImgStOcPtPath, returnNode = True)
-    chImgStOcPtNode.GetDisplayNode().SetSelectedColor(0,1,1)
-    chImgStOcPtNode.GetDisplayNode().SetTextScale(0)
-    chImgStOcPtNode.GetDisplayNode().SetGlyphScale(0.1)
-    chImgStOcPtNode.SetName(stOcPtNodeName)
-       
-    chImgStOcPtNode.SetAndObserveTransformNodeID(chTransformNode.GetID())
-    slicer.vtkSlicerTransformLogic().hardenTransform(chImgStOcPtNode) # apply the transform
-       
-    fnm = os.path.join(self.vsc.vtVars['outputPath'] , chImgStOcPtNode.GetName()+".fcsv")
-    sP4 = slicer.util.saveNode(chImgStOcPtNode, fnm )
-    self.vsc.vtVars['StOcLength']  = str(self.vsc.getFiducilsDistance(chImgStOcPtNode ))
-
-    print ("************  Transform The A-value (Av)Points **********************")
-    chImgAvPtNode = slicer.util.loadMarkupsFiducialList  (modelImgAvPtPath, returnNode = True)
-    chImgAvPtNode.GetDisplayNode().SetSelectedColor(1,0,0)
-    chImgAvPtNode.GetDisplayNode().SetTextScale(0)
-    chImgAvPtNode.GetDisplayNode().SetGlyphScale(0.1)
-    chImgAvPtNode.SetName(avPtNodeName)
-       
-    chImgAvPtNode.SetAndObserveTransformNodeID(chTransformNode.GetID())
-    slicer.vtkSlicerTransformLogic().hardenTransform(chImgAvPtNode) # apply the transform
- 
+    sR = self.vsc.saveResultNode(chSegNode, chSegNode.GetName()+".nrrd")
+
+    ptsColors     = [(1,1,0), (0,0,0), (1,0,1), (0,1,1), (1,0,0)]
+    for ptsNode, ptsColor in zip(ptsNodes, ptsColors):
+        ptsNode.GetDisplayNode().SetSelectedColor(*ptsColor)
+        ptsNode.GetDisplayNode().SetTextScale(0)
+        ptsNode.GetDisplayNode().SetGlyphScale(0.1)
+    [chImgStPtNode, chImgSvPtNode, chImgStLtPtNode, chImgStOcPtNode, chImgAvPtNode] = ptsNodes
+
+    # lengths of all point sets
+    ptsLengths = self.vsc.getFiducialsLengths(ptsNodes)
+    self.vsc.vtVars['StLength']    = str(ptsLengths[chImgStPtNode.GetID()]['length'])
+    self.vsc.vtVars['SvLength']    = str(ptsLengths[chImgSvPtNode.GetID()]['length'])
+    self.vsc.vtVars['StLtLength']  = str(ptsLengths[chImgStLtPtNode.GetID()]['length'])
+    self.vsc.vtVars['StOcLength']  = str(ptsLengths[chImgStOcPtNode.GetID()]['length'])
+
     print ("************  Computing information using A-value **********************")     
-    fnm = os.path.join(self.vsc.vtVars['outputPath'] , chImgAvPtNode.GetName()+".fcsv")
-    sP5 = slicer.util.saveNode(chImgAvPtNode, fnm )
-    aVal =  self.vsc.getFiducilsDistance(chImgAvPtNode)
+    aVal = ptsLengths[chImgAvPtNode.GetID()]['length']
+
+    # export all point sets
+    for ptsNode in ptsNodes:
+        self.vsc.saveResultNode(ptsNode, ptsNode.GetName()+".fcsv")
 
     print("A-value = " , aVal)
     aValLengths = self.getAvalueLengths(aVal )
@@ -482,89 +787,621 @@ class CochleaSegLogic(ScriptedLoadableModuleLogic):
     print("A-value Length Oc" , self.vsc.vtVars['AvalueStOcLength'])
     print("A-value Length Lt" , type(self.vsc.vtVars['AvalueStLtLength']))
     print("A-value Length Oc" , type(self.vsc.vtVars['AvalueStOcLength']))
+
+  # table of the scala volumes, lengths and A-value lengths of one cochlea, the lengths
+  # are from exportEarResults
+  def createEarTable(self, chSegNode, croppedNode, tableName):
+    print("get Cochlea information")
+    # create only if it does not exist
+    try:
+       spTblNode =  slicer.util.getNode(tableName)
+       print("found ", tableName)    
+    except Exception as e:
+       print(e)
+       print("creating  ", tableName)    
+       spTblNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
+       spTblNode.SetName(tableName)
+
+    spTblNode = self.vsc.getItemInfo( chSegNode, croppedNode, spTblNode,0)
+    # only the scala tympani and scala vestibuli rows are used
+    while spTblNode.GetNumberOfRows()>2:
+       spTblNode.RemoveRow(2)
+
+    stVol = spTblNode.GetCellText(0,1)
+    svVol = spTblNode.GetCellText(1,1)
+    spTblNode.AddEmptyRow();          spTblNode.AddEmptyRow()     
+    spTblNode.AddEmptyRow();          spTblNode.AddEmptyRow()
+    spTblNode.AddEmptyRow();          spTblNode.AddEmptyRow()
+                                
+    spTblNode.GetTable().GetColumn(1).SetName("Size (mm^3)")
+    spTblNode.GetTable().GetColumn(2).SetName("Length (mm)")
+    spTblNode.SetCellText(0,0,"Scala Tympani")
+    spTblNode.SetCellText(1,0,"Scala Vestibuli")
+    
+    # Lengths
+    spTblNode.SetCellText(2,0,"Length StLt")
+    spTblNode.SetCellText(3,0,"Length StOc")
+    spTblNode.SetCellText(4,0,"A-value Distance")
+    spTblNode.SetCellText(5,0,"A-value StLt")
+    spTblNode.SetCellText(6,0,"A-value StOc")
+    spTblNode.SetCellText(7,0,"Resampling (mm)")
+    
+    # volume 
+    spTblNode.SetCellText(0,1,stVol)
+    spTblNode.SetCellText(1,1,svVol)
+    spTblNode.SetCellText(2,1,"")
+    spTblNode.SetCellText(3,1,"")
  
-    # Display the result if no error
-    # Clear cochlea location labels
-    if  (cTInr==0) and (cTRnr==0):
-        # change the model type from vtk to stl
-        msn=slicer.vtkMRMLModelStorageNode()
-        msn.SetDefaultWriteFileExtension('stl')
-        slicer.mrmlScene.AddDefaultNode(msn)
-        print("get Cochlea information")
-        tableName =  inputVolumeNode.GetName()+"_tbl"
-        # create only if it does not exist
-        try:
-           spTblNode =  slicer.util.getNode(tableName)
-           print("found ", tableName)    
-        except Exception as e:
-           print(e)
-           print("creating  ", tableName)    
-           spTblNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
-           spTblNode.SetName(tableName)
-
-        spTblNode = self.vsc.getItemInfo( chSegNode, croppedNode, spTblNode,0)
-        for i in range (0,8):
-            spTblNode.RemoveColumn(3)
-
-        if spTblNode.GetNumberOfRows()>3:
-           spTblNode.RemoveRow(spTblNode.GetNumberOfRows()-2)
-           spTblNode.RemoveRow(spTblNode.GetNumberOfRows()-2)
-
-        stVol = spTblNode.GetCellText(0,1)
-        svVol = spTblNode.GetCellText(1,1)
-        spTblNode.AddEmptyRow();          spTblNode.AddEmptyRow()     
-        spTblNode.AddEmptyRow();          spTblNode.AddEmptyRow()
-        spTblNode.AddEmptyRow()     
-                                    
-        spTblNode.GetTable().GetColumn(1).SetName("Size (mm^3)")
-        spTblNode.GetTable().GetColumn(2).SetName("Length (mm)")
-        spTblNode.SetCellText(0,0,"Scala Tympani")
-        spTblNode.SetCellText(1,0,"Scala Vestibuli")
-        
-        # Lengths
-        spTblNode.SetCellText(2,0,"Length StLt")
-        spTblNode.SetCellText(3,0,"Length StOc")
-        spTblNode.SetCellText(4,0,"A-value Distance")
-        spTblNode.SetCellText(5,0,"A-value StLt")
-        spTblNode.SetCellText(6,0,"A-value StOc")
-        
-        # volume 
-        spTblNode.SetCellText(0,1,stVol)
-        spTblNode.SetCellText(1,1,svVol)
-        spTblNode.SetCellText(2,1,"")
-        spTblNode.SetCellText(3,1,"")
- 
-        #TODO: change column width
-        spTblNode.SetColumnProperty('A','Width','250')
-           
-        spTblNode.SetCellText(0,2,self.vsc.vtVars['StLength'])
-        spTblNode.SetCellText(1,2,self.vsc.vtVars['SvLength'])
-        spTblNode.SetCellText(2,2,self.vsc.vtVars['StLtLength'])          
-        spTblNode.SetCellText(3,2,self.vsc.vtVars['StOcLength'])
-        spTblNode.SetCellText(4,2, str( self.vsc.vtVars['AvalueDistance'] ) )
-        spTblNode.SetCellText(5,2, str( self.vsc.vtVars['AvalueStLtLength'] ) )
-        spTblNode.SetCellText(6,2, str( self.vsc.vtVars['AvalueStOcLength'] ) )          
-        
-        #spTblNode.RemoveRow(spTblNode.GetNumberOfRows())            
-        self.spTblNode=spTblNode
-        fnm = os.path.join(self.vsc.vtVars['outputPath'] , spTblNode.GetName()+".tsv")
-        sR = slicer.util.saveNode(spTblNode, fnm )
-    else:
-         print("error happened during segmentation ")
- 
-    #Remove temporary files and nodes:
-    self.vsc.removeTmpsFiles()
-    print("================= Cochlea analysis is complete  =====================")
-    logging.info('Processing completed')
-    return chSegNode
-      
- 
+    #TODO: change column width
+    spTblNode.SetColumnProperty('A','Width','250')
+       
+    spTblNode.SetCellText(0,2,self.vsc.vtVars['StLength'])
+    spTblNode.SetCellText(1,2,self.vsc.vtVars['SvLength'])
+    spTblNode.SetCellText(2,2,self.vsc.vtVars['StLtLength'])          
+    spTblNode.SetCellText(3,2,self.vsc.vtVars['StOcLength'])
+    spTblNode.SetCellText(4,2, str( self.vsc.vtVars['AvalueDistance'] ) )
+    spTblNode.SetCellText(5,2, str( self.vsc.vtVars['AvalueStLtLength'] ) )
+    spTblNode.SetCellText(6,2, str( self.vsc.vtVars['AvalueStOcLength'] ) )
+    # the spacing the segmentation was computed with
+    spTblNode.SetCellText(7,1, self.vsc.vtVars['RSxyz'] if self.vsc.s2b(self.vsc.vtVars['hrChk']) else "none")
+    return spTblNode
+
   def getAvalueLengths(self,Aval):
       #  L= 8.58; cl1=L*3.86+4.99; cl2=L*4.16-5.05; print("CL1 = :", cl1, "      CL2 = :", cl2); 
       l1 =  Aval * 3.86 + 4.99 # lateral length
       l2 =  Aval * 4.16 - 5.05 # organ of corti length
       return Aval, l1, l2
+
+  #--------------------------------------------------------------------------------------------
+  #                       Multi-atlas Segmentation
+  #--------------------------------------------------------------------------------------------
+  # atlases of one side in the model folder, the default atlas Mdl<Styp><side>c is the first,
+  # each atlas has an image Mdl*<side>c, a segmentation Mdl*<side>cS.seg and the five landmark lists
+  def getCochleaAtlases(self, cochleaSide, Styp="Dv"):
+      imgType = self.vsc.vtVars['imgType']
+      atlases = []
+      for imgPath in sorted(glob.glob(os.path.join(self.vsc.vtVars['modelPath'], "Mdl*" + cochleaSide + "c" + imgType))):
+          prefix = imgPath[:-len(imgType)]
+          atlas = {'name'  : os.path.basename(prefix),
+                   'image' : imgPath,
+                   'seg'   : prefix + "S.seg" + imgType,
+                   'points': [prefix + "_" + ptsName + ".fcsv" for ptsName in ["StPt", "SvPt", "StLtPt", "StOcPt", "AvPt"]]}
+          if all(os.path.isfile(p) for p in [atlas['seg']] + atlas['points']):
+             atlases.append(atlas)
+      atlases.sort(key=lambda atlas: not atlas['name'] == "Mdl" + Styp + cochleaSide + "c")
+      return atlases
+
+  # the same input, point, parameters and atlases give the same result, with one atlas it also
+  # depends on the warp mode, both cochleae of a bilateral run use the same keys as one cochlea
+  def getEarCacheKey(self, regCache, croppedImg, inputPoint, cochleaSide, atlases):
+      atlasPaths = sum([[atlas['image'], atlas['seg']] + atlas['points'] for atlas in atlases], [])
+      cacheOptions = ("multi-atlas " + self.vsc.vtVars['labelFusion']) if len(atlases) > 1 else self.vsc.vtVars['warpMode']
+      return regCache.getKey(croppedImg, inputPoint, cochleaSide, [self.vsc.vtVars['parsPath'], self.vsc.vtVars['parsNRPath']], atlasPaths, cacheOptions)
+
+  # vtVars['warpMode'] = "field": the atlas segmentation and landmarks are moved with the dense
+  # deformation field of the transform, it is kept in the output folder
+  def warpWithDeformationField(self, engine, modelImg, modelSegPath, ptsModelPaths, resTrans, resRegPath, resDefPath, transNodeName, segNodeName, ptsNodeNames):
+      #genrates deformation field
+      [cTR, resImgTmp, resDef] = engine.transform(modelImg, resTrans, resRegPath, "295", deformationField=True)
+      if not cTR == 0:
+         print("Error: can not compute the deformation field")
+         return cTR, None, None
+
+      # keep the deformation field written by the elastix binaries
+      if isinstance(resDef, str):
+         os.rename(resDef,resDefPath)
+         resDef = resDefPath
+
+      print ("************  Load deformation field Transform  **********************")
+      chTransformNode = self.vsc.loadDeformationField(resDef, transNodeName)
+      # keep the deformation field in the output folder
+      if isinstance(resDef, str):
+         self.vsc.publishFile(resDef)
+
+      print ("************  Transform The Segmentation **********************")
+      chSegNode = self.vsc.loadAtlasSegmentation(modelSegPath, segNodeName)
+      chSegNode.SetAndObserveTransformNodeID(chTransformNode.GetID())
+      with self.vsc.span("harden transform"):
+           slicer.vtkSlicerTransformLogic().hardenTransform(chSegNode)     # apply the transform
+
+      print ("************  Transform The Landmarks: St, Sv, StLt, StOc and Av Points **********************")
+      ptsNodes = self.vsc.loadWarpedAtlasLandmarks(ptsModelPaths, ptsNodeNames, chTransformNode)
+      return 0, chSegNode, ptsNodes
+
+  # Register one atlas to the cropped image, runs in a worker thread so the scene is not changed.
+  # The warped labels are renumbered to segmentIDs, the segments of the first atlas.
+  #  labelImg, atlasSegmentIDs: labelmap of the atlas segmentation, loaded by createAtlasJobs
+  #  warpAtlas: False gives only the transform, the atlas is warped on the GUI thread
+  def registerAtlas(self, jobVsc, atlas, fixedImg, segmentIDs, jobPath, labelImg, atlasSegmentIDs, warpAtlas=True):
+      result = {'atlas': atlas, 'error': 1, 'timings': collections.OrderedDict()}
+      try:
+         t0 = time.time()
+         engine = jobVsc.getElastixEngine()
+         modelImg = atlas['image'] if engine.needsFiles else jobVsc.getAtlasImage(atlas['image'])
+         rigidParsPath = jobVsc.writeTransformParameters(jobVsc.vtVars['parsPath'], os.path.join(jobPath, "parsRigid.txt"), {"WriteResultImage": '"false"'})
+         [cTI, resImg, resTrans] = engine.register(fixedImg, modelImg, [rigidParsPath, jobVsc.vtVars['parsNRPath']], os.path.join(jobPath, "Reg"), "292")
+         result['timings']['registration'] = time.time() - t0
+         if not cTI == 0:
+            return result
+         result['engine']    = engine
+         result['transform'] = resTrans
+         if not warpAtlas:
+            result['error'] = 0
+            return result
+
+         t0 = time.time()
+         [cTS, resLabelImg, resDef] = engine.transform(labelImg, resTrans, os.path.join(jobPath, "Warp"), "295", deformationField=False, labelImage=True)
+         if not cTS == 0:
+            return result
+         if isinstance(resLabelImg, str):
+            resLabelImg = sitk.ReadImage(resLabelImg)
+         labelLut = np.zeros(len(atlasSegmentIDs)+1, dtype=np.uint8)
+         for i in range(len(atlasSegmentIDs)):
+             if atlasSegmentIDs[i] in segmentIDs:
+                labelLut[i+1] = segmentIDs.index(atlasSegmentIDs[i]) + 1
+         result['labelImage'] = sitk.GetImageFromArray(labelLut[sitk.GetArrayViewFromImage(resLabelImg)])
+         result['labelImage'].CopyInformation(resLabelImg)
+         result['timings']['labels'] = time.time() - t0
+
+         t0 = time.time()
+         landmarks = [VisSimCommon.VisSimAtlasCache.instance().getLandmarks(ptsPath) for ptsPath in atlas['points']]
+         pts = jobVsc.inverseTransformPoints(engine, np.vstack([l[0] for l in landmarks]), resTrans, os.path.join(jobPath, "Warp"))
+         if pts is None:
+            return result
+         result['landmarks'] = np.split(pts, np.cumsum([len(l[0]) for l in landmarks])[:-1])
+         result['labels']    = [l[1] for l in landmarks]
+         result['timings']['landmarks'] = time.time() - t0
+         result['error'] = 0
+      except VisSimCommon.VisSimCancelledError:
+         raise
+      except Exception as e:
+         print("Error: atlas " + atlas['name'] + " failed")
+         print(e)
+      return result
+
+  # The atlases are registered at the same time, each with its share of the elastix threads.
+  # The warped labels are fused (vtVars['labelFusion']) and the warped landmarks are averaged,
+  # failed atlases are left out. Returns error code, segmentation node, landmark nodes and
+  # the results of the atlases, the timings are written to timingsFileName.
+  def runMultiAtlasRegistration(self, atlases, fixedImg, segNodeName, ptsNodeNames, timingsFileName):
+      jobThreads = self.getAtlasJobThreads(len(atlases))
+      print("atlases               = ", [atlas['name'] for atlas in atlases])
+      print("threads per atlas     = ", jobThreads)
+      segmentIDs = VisSimCommon.VisSimAtlasCache.instance().getLabelImage(atlases[0]['seg'])[1]
+      jobs = self.createAtlasJobs(atlases, fixedImg, segmentIDs, jobThreads, "Atlases")
+      t0 = time.time()
+      atlasResults = self.vsc.runInThreads(jobs)
+      print("multi-atlas registration: %.1f s" % (time.time() - t0))
+      self.writeAtlasTimings(atlasResults, timingsFileName)
+      [cT, segNode, ptsNodes] = self.fuseAtlasResults(atlasResults, atlases, segmentIDs, segNodeName, ptsNodeNames)
+      return cT, segNode, ptsNodes, atlasResults
+
+  # elastix threads of each of jobCount registrations that run at the same time
+  def getAtlasJobThreads(self, jobCount):
+      totalThreads = int(self.vsc.vtVars['elastixThreads']) if not self.vsc.vtVars['elastixThreads'] == "" else multiprocessing.cpu_count()
+      return max(1, totalThreads // jobCount)
+
+  # one registerAtlas job for each atlas, to run with runInThreads. The atlas labelmaps are
+  # loaded here, loading a segmentation uses the scene which the worker threads must not change.
+  def createAtlasJobs(self, atlases, fixedImg, segmentIDs, jobThreads, jobName, warpAtlas=True):
+      jobs = []
+      for i in range(len(atlases)):
+          jobVsc  = self.vsc.createJobLogic(jobThreads)
+          jobPath = os.path.join(self.vsc.getWorkPath(), jobName, "Atlas" + str(i))
+          os.makedirs(jobPath)
+          labelImg, atlasSegmentIDs = VisSimCommon.VisSimAtlasCache.instance().getLabelImage(atlases[i]['seg'])
+          jobs.append(lambda jobVsc=jobVsc, atlas=atlases[i], jobPath=jobPath, labelImg=labelImg, atlasSegmentIDs=atlasSegmentIDs:
+                      self.registerAtlas(jobVsc, atlas, fixedImg, segmentIDs, jobPath, labelImg, atlasSegmentIDs, warpAtlas))
+      return jobs
+
+  # segmentation node from the fused labels and landmark nodes from the averaged points
+  def fuseAtlasResults(self, atlasResults, atlases, segmentIDs, segNodeName, ptsNodeNames):
+      okResults = [r for r in atlasResults if r['error'] == 0]
+      if len(okResults) == 0:
+         print("Error: all atlases failed")
+         return 1, None, None
+
+      fusedImg = self.vsc.fuseLabelImages([r['labelImage'] for r in okResults], self.vsc.vtVars['labelFusion'])
+      segNode = self.vsc.loadAtlasSegmentation(atlases[0]['seg'], segNodeName)
+      self.vsc.updateSegmentsFromLabelImage(segNode, fusedImg, segmentIDs)
+
+      # landmark lists with another number of points than the first atlas are not averaged
+      ptsNodes = []
+      for j in range(len(ptsNodeNames)):
+          ptsList = [r['landmarks'][j] for r in okResults if r['landmarks'][j].shape == okResults[0]['landmarks'][j].shape]
+          ptsNodes.append(self.vsc.createMarkupsNode(ptsNodeNames[j], np.mean(ptsList, axis=0), okResults[0]['labels'][j]))
+      return 0, segNode, ptsNodes
+
+  # stage timings of each atlas, printed and written to the output folder
+  def writeAtlasTimings(self, atlasResults, fileName):
+      stages = ["registration", "labels", "landmarks"]
+      rows = []
+      for r in atlasResults:
+          row = [r['atlas']['name'], "ok" if r['error'] == 0 else "failed"] + ["%.2f" % r['timings'][s] if s in r['timings'] else "" for s in stages]
+          print("      atlas " + "  ".join(row))
+          rows.append(row)
+      csvPath = os.path.join(self.vsc.getWorkPath(), fileName)
+      with open(csvPath, 'w', newline='') as f:
+           writer = csv.writer(f)
+           writer.writerow(["atlas", "status"] + [s + " s" for s in stages])
+           writer.writerows(rows)
+      self.vsc.publishFile(csvPath)
  
+#===================================================================
+#                           Batch
+#===================================================================
+# Headless segmentation of many images, run as:
+#   Slicer --no-main-window --python-script CochleaSeg.py --manifest cases.csv --workers 4
+# The manifest is a CSV file with the columns image, side (L or R) and ijk or ras as "[x,y,z]",
+# an id column is optional. Without ijk and ras the cochlea is located automatically, and
+# without a side the detected side is used. The cases are divided between worker Slicer processes, each
+# worker uses its own workspace and a limited number of elastix threads.
+# A row with ijk or ras needs the side, such rows without it are not run.
+# One row per case is written to the results table.
+class CochleaSegBatch(object):
+  resultColumns = ["id","image","side","status","seconds","StVolume","SvVolume","StLength","SvLength",
+                   "StLtLength","StOcLength","AvalueDistance","AvalueStLtLength","AvalueStOcLength","RSxyz","outputPath","error"]
+
+  def readManifest(self, manifestPath):
+      with open(manifestPath) as f:
+           cases = [dict((k.strip(), (v or "").strip()) for k,v in row.items() if k is not None) for row in csv.DictReader(f)]
+      for case in cases:
+          if case.get('id', "") == "":
+             case['id'] = os.path.splitext(os.path.basename(case['image']))[0].replace(".nii","")
+          # the side is only detected when the cochlea is located automatically
+          case['side'] = case.get('side', "").upper()
+          if not case['side'] in ["", "L", "R"]:
+             case['error'] = "side must be L or R"
+          elif case['side'] == "" and not (case.get('ras', "") == "" and case.get('ijk', "") == ""):
+             case['error'] = "side required when a point is given"
+      return cases
+
+  # result row of a case that is not run
+  def getErrorRow(self, case, error):
+      return {'id': case['id'], 'image': case['image'], 'side': case.get('side', ""), 'status': "error", 'error': error}
+
+  def readRows(self, csvPath):
+      if not os.path.isfile(csvPath):
+         return []
+      with open(csvPath) as f:
+           return list(csv.DictReader(f))
+
+  # the table is replaced at once, it is never seen half written
+  def writeRows(self, rows, csvPath, columns=None):
+      columns = columns or self.resultColumns
+      with open(csvPath + ".tmp", 'w', newline='') as f:
+           writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+           writer.writeheader()
+           writer.writerows(rows)
+      os.replace(csvPath + ".tmp", csvPath)
+
+  # divide the cases between worker processes and collect their results in one table
+  def run(self, manifestPath, resultsPath, workers=1, threads=None, outputPath=None):
+      cases = self.readManifest(manifestPath)
+      for case in cases:
+          if 'error' in case:
+             print("Error: case " + case['id'] + ": " + case['error'])
+      runCases = [case for case in cases if not 'error' in case]
+      resultsPath = os.path.abspath(resultsPath)
+      outputPath  = outputPath or os.path.join(os.path.dirname(resultsPath), "outputs")
+      workers = max(0, min(int(workers), len(runCases)))
+      threads = threads or max(1, multiprocessing.cpu_count() // max(1, workers))
+      print("Batch segmentation: " + str(len(cases)) + " cases, " + str(workers) + " workers, " + str(threads) + " elastix threads each")
+
+      # download or check the VisSim data once before the workers start
+      VisSimCommon.VisSimCommonLogic().setGlobalVariables(0)
+
+      batchPath = tempfile.mkdtemp(prefix="CochleaSegBatch_")
+      manifestColumns = sorted(set(k for case in runCases for k in case))
+      workerProcs = []
+      for w in range(workers):
+          workerManifestPath = os.path.join(batchPath, "worker" + str(w) + ".csv")
+          workerResultsPath  = os.path.join(batchPath, "worker" + str(w) + "_results.csv")
+          self.writeRows(runCases[w::workers], workerManifestPath, manifestColumns)
+          env = dict(os.environ)
+          env["VISSIM_ELASTIX_THREADS"] = str(threads)
+          env["VISSIM_WORK_PATH"]       = os.path.join(batchPath, "work" + str(w))
+          cmd = [slicer.app.applicationFilePath(), "--no-main-window", "--no-splash", "--python-script", os.path.abspath(__file__),
+                 "--worker", "--manifest", workerManifestPath, "--results", workerResultsPath, "--output", outputPath]
+          logFile = open(os.path.join(batchPath, "worker" + str(w) + ".log"), 'w')
+          workerProcs.append([subprocess.Popen(cmd, env=env, stdout=logFile, stderr=subprocess.STDOUT), logFile, workerResultsPath])
+
+      rows = {}
+      for proc, logFile, workerResultsPath in workerProcs:
+          exitCode = proc.wait()
+          logFile.close()
+          for row in self.readRows(workerResultsPath):
+              rows[row['id']] = row
+          print("worker finished with exit code " + str(exitCode))
+
+      # cases without result row, the worker crashed
+      results = []
+      for case in cases:
+          if 'error' in case:
+             row = self.getErrorRow(case, case['error'])
+          else:
+             row = rows.get(case['id']) or self.getErrorRow(case, "worker failed, see " + batchPath)
+          results.append(row)
+      self.writeRows(results, resultsPath)
+      failed = len([r for r in results if not r['status'] == "ok"])
+      if failed == 0:
+         shutil.rmtree(batchPath, ignore_errors=True)
+      print("Batch segmentation done: " + str(len(results)-failed) + " ok, " + str(failed) + " failed, results: " + resultsPath)
+      return results
+
+  # runs the cases one by one in this process
+  def runWorker(self, manifestPath, resultsPath, outputPath):
+      rows = []
+      for case in self.readManifest(manifestPath):
+          rows.append(self.runCase(case, outputPath))
+          # finished cases are kept if a later case crashes the process
+          self.writeRows(rows, resultsPath)
+          slicer.mrmlScene.Clear(0)
+      return rows
+
+  def runCase(self, case, outputPath):
+      print("=================== Case " + case['id'] + " =====================")
+      stm = time.time()
+      row = {'id': case['id'], 'image': case['image'], 'side': case.get('side', ""), 'status': "error"}
+      if 'error' in case:
+         row['error'] = case['error']
+         return row
+      try:
+         vsc   = VisSimCommon.VisSimCommonLogic()
+         logic = CochleaSegLogic()
+         inputVolumeNode = slicer.util.loadVolume(case['image'])
+         inputVolumeNode.SetName(case['id'])
+         if case.get('ras', "") == "" and case.get('ijk', "") == "":
+            # no location: the cochlea and its side are found automatically
+            candidates, cochleaSide = logic.locateCochlea(inputVolumeNode)
+            if cochleaSide is None:
+               raise RuntimeError("cochlea is not found")
+            inputFiducialNode = logic.createLocationNode(inputVolumeNode, candidates)
+            case['side'] = case.get('side', "") or cochleaSide
+            row['side']  = case['side']
+         else:
+            if not case.get('ras', "") == "":
+               cochleaPointRAS = vsc.t2v(case['ras'])
+            else:
+               cochleaPointRAS = vsc.ptIJK2RAS(vsc.t2v(case['ijk']), inputVolumeNode)
+            inputFiducialNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
+            inputFiducialNode.CreateDefaultDisplayNodes()
+            inputFiducialNode.SetName(case['id'] + "_CochleaLocation")
+            inputFiducialNode.AddControlPoint(cochleaPointRAS)
+
+         row['outputPath'] = os.path.join(outputPath, case['id'])
+         logic.run(inputVolumeNode, inputFiducialNode, case['side'].upper(), row['outputPath'])
+         if getattr(logic, 'spTblNode', None) is None:
+            row['error'] = getattr(logic, 'errorMessage', None) or "segmentation failed"
+         else:
+            row['status']   = "ok"
+            row['StVolume'] = logic.spTblNode.GetCellText(0,1)
+            row['SvVolume'] = logic.spTblNode.GetCellText(1,1)
+            for key in ["StLength","SvLength","StLtLength","StOcLength","AvalueDistance","AvalueStLtLength","AvalueStOcLength"]:
+                row[key] = logic.vsc.vtVars[key]
+            row['RSxyz'] = logic.spTblNode.GetCellText(7,1)
+      except Exception as e:
+         print(e)
+         row['error'] = str(e)
+      row['seconds'] = "%.1f" % (time.time() - stm)
+      return row
+
+#===================================================================
+#                           Benchmark
+#===================================================================
+# Offline benchmark with synthetic cochlea phantoms, run as:
+#   Slicer --no-main-window --python-script CochleaSeg.py --benchmark benchDir --sizes 256,512,768
+# A phantom is a spiral with the two scalae in bone, with CBCT-like spacing and noise. A mini-atlas
+# of the same shape, slightly smaller and rotated, with its segmentation, landmarks and elastix
+# parameter files is written to benchDir/VisSimTools, nothing is downloaded. Each size is
+# segmented with each cropping and resampling setting, the stage timings and memory of the runs
+# are written to benchDir/CochleaSegBenchmark.json. The phantoms are the same for the same seed.
+class CochleaSegBenchmark(object):
+  settings = [{'name': "default",    'croppingLength': "[ 10 , 10 , 10 ]", 'resamplingMode': "fixed", 'RSxyz': "[ 0.125, 0.125 , 0.125 ]", 'hrChk': "True"},
+              {'name': "coarse",     'croppingLength': "[ 10 , 10 , 10 ]", 'resamplingMode': "fixed", 'RSxyz': "[ 0.25, 0.25 , 0.25 ]",    'hrChk': "True"},
+              {'name': "noResample", 'croppingLength': "[ 10 , 10 , 10 ]", 'resamplingMode': "fixed", 'RSxyz': "[ 0.125, 0.125 , 0.125 ]", 'hrChk': "False"},
+              {'name': "largeCrop",  'croppingLength': "[ 14 , 14 , 14 ]", 'resamplingMode': "fixed", 'RSxyz': "[ 0.25, 0.25 , 0.25 ]",    'hrChk': "True"},
+              {'name': "adaptive",   'croppingLength': "[ 10 , 10 , 10 ]", 'resamplingMode': "adaptive"},
+              {'name': "preview",    'croppingLength': "[ 10 , 10 , 10 ]", 'resamplingMode': "preview"},
+              {'name': "fastPreset", 'croppingLength': "[ 10 , 10 , 10 ]", 'resamplingMode': "adaptive", 'elastixPreset': "fast"},
+              {'name': "fieldWarp",  'croppingLength': "[ 10 , 10 , 10 ]", 'resamplingMode': "fixed", 'warpMode': "field"}]
+  spacing      = 0.2   # mm, phantom spacing
+  atlasSpacing = 0.125 # mm
+  atlasLength  = 12.0  # mm, atlas image size
+
+  rigidParameters = ['(Registration "MultiResolutionRegistration")', '(Transform "EulerTransform")',
+                     '(AutomaticTransformInitialization "true")', '(AutomaticScalesEstimation "true")',
+                     '(MaximumNumberOfIterations 200)']
+  nonRigidParameters = ['(Registration "MultiResolutionRegistration")', '(Transform "BSplineTransform")',
+                        '(FinalGridSpacingInPhysicalUnits 2.0)', '(HowToCombineTransforms "Compose")',
+                        '(MaximumNumberOfIterations 300)']
+  commonParameters = ['(FixedInternalImagePixelType "float")', '(MovingInternalImagePixelType "float")',
+                      '(FixedImagePyramid "FixedSmoothingImagePyramid")', '(MovingImagePyramid "MovingSmoothingImagePyramid")',
+                      '(Interpolator "BSplineInterpolator")', '(ResampleInterpolator "FinalBSplineInterpolator")',
+                      '(Resampler "DefaultResampler")', '(Optimizer "AdaptiveStochasticGradientDescent")',
+                      '(Metric "AdvancedMattesMutualInformation")', '(NumberOfHistogramBins 32)', '(NumberOfResolutions 2)',
+                      '(ImageSampler "RandomCoordinate")', '(NumberOfSpatialSamples 2048)', '(NewSamplesEveryIteration "true")',
+                      '(FinalBSplineInterpolationOrder 3)', '(DefaultPixelValue 0)', '(WriteResultImage "true")',
+                      '(ResultImagePixelType "short")', '(ResultImageFormat "nrrd")']
+
+  def __init__(self, benchPath, seed=0):
+      self.benchPath  = os.path.abspath(benchPath)
+      self.vissimPath = os.path.join(self.benchPath, "VisSimTools")
+      self.seed       = seed
+      self.vsc        = VisSimCommon.VisSimCommonLogic()
+
+  # Centre lines (LPS mm around the cochlea centre) of the scala tympani, scala vestibuli and the
+  # lateral wall and organ of Corti lines, 2.5 turns. The right cochlea is mirrored.
+  # Returns the centre lines and the tube radius at each sample.
+  def getScalaCenterlines(self, side, scale=1.0, angle=0.0, samples=400):
+      t      = np.linspace(0.0, 2.5, samples)
+      theta  = 2.0*np.pi*t + np.deg2rad(angle)
+      r      = 4.0 - 1.2*t
+      mirror = -1.0 if side == "R" else 1.0
+      centerlines = {}
+      for name, dz, dr in [["St", -0.4, 0.0], ["Sv", 0.4, 0.0], ["StLt", -0.4, 0.4], ["StOc", -0.4, -0.2]]:
+          centerlines[name] = scale * np.column_stack([mirror*(r+dr)*np.cos(theta), (r+dr)*np.sin(theta), 1.6*t - 2.0 + dz])
+      return centerlines, scale * 0.45 * (1.0 - 0.2*t)
+
+  # label 1 (scala tympani) and 2 (scala vestibuli) drawn as spheres along the centre lines,
+  # labelArray is zyx on an axis aligned grid with the given origin (LPS mm) and spacing
+  def drawScalae(self, labelArray, origin, spacing, center, centerlines, radii):
+      n = int(np.ceil(radii.max()/spacing))
+      offsets = np.argwhere(np.ones((2*n+1,)*3, dtype=bool)) - n
+      offsetLengths = np.linalg.norm(offsets*spacing, axis=1)
+      shape = np.array(labelArray.shape[::-1])
+      for label, name in [[1, "St"], [2, "Sv"]]:
+          centerIdx = np.round((centerlines[name] + center - origin)/spacing).astype(int)
+          for p, radius in zip(centerIdx, radii):
+              vox = p + offsets[offsetLengths <= radius]
+              vox = vox[np.all((vox >= 0) & (vox < shape), axis=1)]
+              labelArray[vox[:,2], vox[:,1], vox[:,0]] = label
+
+  # bone with fluid filled scalae, partial volume and noise, inside an air box of the given size
+  def makeImage(self, size, spacing, center, side, scale, angle, noise, rng, headRadius=None):
+      imgArray = np.empty(size[::-1], dtype=np.int16)
+      yy, xx = np.mgrid[0:size[1], 0:size[0]] * spacing
+      fovCenter = np.array(size) * spacing / 2.0
+      # filled slice by slice, a full float volume would need 4 times the memory
+      for z in range(size[2]):
+          boneSlice = np.full((size[1], size[0]), 1200.0)
+          if headRadius is not None:
+             r2 = (xx - fovCenter[0])**2 + (yy - fovCenter[1])**2 + (z*spacing - fovCenter[2])**2
+             boneSlice[r2 > headRadius**2] = -1000.0
+          imgArray[z] = boneSlice + rng.normal(0.0, noise, (size[1], size[0]))
+
+      # the scalae in a box around the cochlea
+      lo = np.maximum(((center - 7.0)/spacing).astype(int), 0)
+      hi = np.minimum(((center + 7.0)/spacing).astype(int), size)
+      labelArray = np.zeros((hi - lo)[::-1], dtype=np.uint8)
+      centerlines, radii = self.getScalaCenterlines(side, scale, angle)
+      self.drawScalae(labelArray, lo*spacing, spacing, center, centerlines, radii)
+      fluid = sitk.GetArrayFromImage(sitk.SmoothingRecursiveGaussian(sitk.GetImageFromArray((labelArray > 0).astype(np.float32)), 0.8))
+      box = imgArray[lo[2]:hi[2], lo[1]:hi[1], lo[0]:hi[0]]
+      box[:] = (box - fluid*(1200.0 - 150.0)).astype(np.int16)
+
+      img = sitk.GetImageFromArray(imgArray)
+      img.SetSpacing([spacing]*3)
+      labelImg = sitk.GetImageFromArray(labelArray)
+      labelImg.SetSpacing([spacing]*3)
+      labelImg.SetOrigin((lo*spacing).tolist())
+      return img, labelImg, centerlines
+
+  # phantom of size^3 voxels, returns the image and the cochlea centre (LPS mm)
+  def makePhantom(self, size, side):
+      rng = np.random.RandomState(self.seed + size)
+      fov = size * self.spacing
+      center = np.array([fov/2.0 + (12.0 if side == "L" else -12.0), fov/2.0 + 3.0, fov/2.0])
+      img, labelImg, centerlines = self.makeImage([size]*3, self.spacing, center, side, 1.05, 10.0, 60.0, rng, 0.45*fov)
+      return img, center
+
+  # atlas image, segmentation, landmarks and parameter files in the VisSimTools layout
+  def writeAtlas(self, side, Styp="Dv"):
+      modelPath = os.path.join(self.vissimPath, "models", "modelCochlea")
+      parsPath  = os.path.join(self.vissimPath, "pars")
+      for folderPath in [modelPath, parsPath]:
+          if not os.path.exists(folderPath):
+             os.makedirs(folderPath)
+      with open(os.path.join(parsPath, "parCochSeg.txt"), 'w') as f:
+           f.write("\n".join(self.commonParameters + self.rigidParameters) + "\n")
+      with open(os.path.join(parsPath, "parCochSegNR.txt"), 'w') as f:
+           f.write("\n".join(self.commonParameters + self.nonRigidParameters) + "\n")
+
+      rng = np.random.RandomState(self.seed)
+      size = [int(round(self.atlasLength/self.atlasSpacing))]*3
+      center = np.array(size) * self.atlasSpacing / 2.0
+      img, labelImg, centerlines = self.makeImage(size, self.atlasSpacing, center, side, 1.0, 0.0, 20.0, rng)
+      prefix = os.path.join(modelPath, "Mdl" + Styp + side + "c")
+      sitk.WriteImage(img, prefix + ".nrrd")
+
+      labelNode = sitkUtils.PushVolumeToSlicer(labelImg, None, "MdlLabel", "vtkMRMLLabelMapVolumeNode")
+      segNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+      slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelNode, segNode)
+      for i, segmentName in enumerate(["ScalaTympani", "ScalaVestibuli"]):
+          segNode.GetSegmentation().GetNthSegment(i).SetName(segmentName)
+      slicer.util.saveNode(segNode, prefix + "S.seg.nrrd")
+      slicer.mrmlScene.RemoveNode(segNode)
+      slicer.mrmlScene.RemoveNode(labelNode)
+
+      # landmarks in RAS, the A-value points are the round window and the opposite lateral wall
+      lps = np.array([-1.0, -1.0, 1.0])
+      ptsSets = {"StPt": centerlines["St"][::10], "SvPt": centerlines["Sv"][::10], "StLtPt": centerlines["StLt"][::10],
+                 "StOcPt": centerlines["StOc"][::10], "AvPt": centerlines["StLt"][[0, 80]]}
+      for ptsName in ptsSets:
+          ptsRAS = (ptsSets[ptsName] + center) * lps
+          ptsNode = self.vsc.createMarkupsNode("Mdl" + ptsName, ptsRAS, [ptsName + "-" + str(i) for i in range(len(ptsRAS))])
+          slicer.util.saveNode(ptsNode, prefix + "_" + ptsName + ".fcsv")
+          slicer.mrmlScene.RemoveNode(ptsNode)
+
+  def writeResults(self, results, resultsPath):
+      with open(resultsPath + ".tmp", 'w') as f:
+           json.dump(results, f, indent=1)
+      os.replace(resultsPath + ".tmp", resultsPath)
+
+  def run(self, sizes=[256, 512, 768], settings=None, side="L", resultsPath=None):
+      settings    = settings or self.settings
+      resultsPath = resultsPath or os.path.join(self.benchPath, "CochleaSegBenchmark.json")
+      # the mini-atlas replaces the VisSim data
+      os.environ["VISSIM_TOOLS_PATH"] = self.vissimPath
+      os.environ["VISSIM_OFFLINE"]    = "1"
+      self.writeAtlas(side)
+
+      results = {'platform': platform.platform(), 'cpus': multiprocessing.cpu_count(), 'seed': self.seed,
+                 'spacing': self.spacing, 'side': side, 'runs': []}
+      for size in sizes:
+          print("=================== Benchmark phantom " + str(size) + "^3 =====================")
+          stm = time.time()
+          img, center = self.makePhantom(size, side)
+          inputVolumeNode = sitkUtils.PushVolumeToSlicer(img, None, "Phantom" + str(size), "vtkMRMLScalarVolumeNode")
+          del img
+          phantomSeconds = time.time() - stm
+          inputFiducialNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
+          inputFiducialNode.SetName(inputVolumeNode.GetName() + "_CochleaLocation")
+          inputFiducialNode.AddControlPoint((center * np.array([-1.0, -1.0, 1.0])).tolist())
+
+          for setting in settings:
+              print("=================== Benchmark " + str(size) + "^3 " + setting['name'] + " =====================")
+              customisedVtVars = dict((k, setting[k]) for k in setting if not k == 'name')
+              customisedVtVars.update({'regCache': "False", 'atlasCount': "1"})
+              record = {'size': size, 'setting': setting['name'], 'vtVars': customisedVtVars, 'phantomSeconds': round(phantomSeconds, 2), 'status': "error"}
+              logic = CochleaSegLogic()
+              sceneNodeIDs = self.vsc.getSceneNodeIDs()
+              stm = time.time()
+              try:
+                 logic.run(inputVolumeNode, inputFiducialNode, side, os.path.join(self.benchPath, "outputs", str(size) + "_" + setting['name']),
+                           None, customisedVtVars)
+                 if getattr(logic, 'spTblNode', None) is None:
+                    record['status'] = "failed"
+                    record['error']  = logic.errorMessage
+                 else:
+                    record['status']   = "ok"
+                    record['StVolume'] = logic.spTblNode.GetCellText(0,1)
+                    record['SvVolume'] = logic.spTblNode.GetCellText(1,1)
+                    record['StLength'] = logic.vsc.vtVars['StLength']
+                    record['RSxyz']    = logic.spTblNode.GetCellText(7,1)
+              except Exception as e:
+                 print(e)
+                 record['error'] = str(e)
+              record['seconds'] = round(time.time() - stm, 2)
+              profiler = getattr(getattr(logic, 'vsc', None), 'profiler', None)
+              if profiler is not None:
+                 record['stages'] = profiler.getSummary()
+                 record['maxRSSMB']      = max([s['maxRSSMB'] for s in record['stages'].values()] + [0.0])
+                 record['childMaxRSSMB'] = max([s['childMaxRSSMB'] for s in record['stages'].values()] + [0.0])
+              # iterations and final metric of each resolution of each elastix parameter file
+              elastixRuns = getattr(getattr(logic, 'vsc', None), 'elastixRuns', [])
+              # cost of the inverse landmark transform of the points warp mode, compare with fieldWarp
+              record['inverseTransform'] = getattr(getattr(logic, 'vsc', None), 'inverseTransformStats', None)
+              record['elastix'] = [[[r['iterations'], r['finalMetric']] for r in p['resolutions']] for run in elastixRuns for p in run['parameterFiles']]
+              results['runs'].append(record)
+              # finished runs are kept if a later run crashes the process
+              self.writeResults(results, resultsPath)
+              self.vsc.removeNewNodes(sceneNodeIDs, inputVolumeNode.GetName())
+          slicer.mrmlScene.RemoveNode(inputFiducialNode)
+          slicer.mrmlScene.RemoveNode(inputVolumeNode)
+      print("Benchmark done, results: " + resultsPath)
+      return results
+
 #===================================================================
 #                           Test
 #===================================================================
@@ -669,3 +1506,43 @@ class CochleaSegTest(ScriptedLoadableModuleTest):
       tm=self.etm - self.stm
       print("Time: "+str(tm)+"  seconds")
       self.delayDisplay('Test testSlicerCochleaSegmentation passed!')
+
+# command line entry of CochleaSegBatch
+def main(argv):
+  parser = argparse.ArgumentParser(description="Batch cochlea segmentation")
+  parser.add_argument("--manifest", default=None, help="CSV file with the columns image, side and ijk or ras")
+  parser.add_argument("--results",  default="CochleaSegResults.csv", help="results table")
+  parser.add_argument("--output",   default=None, help="folder for the case results, default: outputs next to the results table")
+  parser.add_argument("--workers",  type=int, default=1, help="number of worker processes")
+  parser.add_argument("--threads",  type=int, default=None, help="elastix threads for each worker")
+  parser.add_argument("--preset",   default=None, choices=sorted(VisSimCommon.VisSimCommonLogic.elastixPresets), help="elastix parameter preset")
+  parser.add_argument("--auto-iterations", action="store_true", help="elastix iterations from the convergence of past runs")
+  parser.add_argument("--record-iterations", action="store_true", help="record the elastix convergence for --auto-iterations without using it")
+  parser.add_argument("--worker",   action="store_true", help=argparse.SUPPRESS)
+  parser.add_argument("--benchmark", default=None, help="run the phantom benchmark in this folder instead of a manifest")
+  parser.add_argument("--sizes",    default="256,512,768", help="benchmark phantom sizes in voxels")
+  parser.add_argument("--seed",     type=int, default=0, help="benchmark phantom seed")
+  args, unknownArgs = parser.parse_known_args(argv)
+
+  # the workers get the preset and the tuning from the environment
+  if args.preset is not None:
+     os.environ["VISSIM_ELASTIX_PRESET"] = args.preset
+  if args.auto_iterations:
+     os.environ["VISSIM_ITERATION_TUNING"] = "auto"
+  elif args.record_iterations:
+     os.environ["VISSIM_ITERATION_TUNING"] = "record"
+  if args.benchmark:
+     results = CochleaSegBenchmark(args.benchmark, args.seed).run([int(x) for x in args.sizes.split(",")])
+     return 0 if all(r['status'] == "ok" for r in results['runs']) else 1
+  if args.manifest is None:
+     parser.error("--manifest or --benchmark is required")
+
+  batch = CochleaSegBatch()
+  if args.worker:
+     rows = batch.runWorker(args.manifest, args.results, args.output)
+  else:
+     rows = batch.run(args.manifest, args.results, args.workers, args.threads, args.output)
+  return 0 if all(r['status'] == "ok" for r in rows) else 1
+
+if __name__ == "__main__":
+  slicer.util.exit(main(sys.argv[1:]))
@@ -25,19 +25,26 @@
 
 # Non Slicer libs
 from __future__ import print_function, unicode_literals
-import os, sys, glob, time, re, shutil,  math, unittest, logging, zipfile, platform, subprocess, hashlib
+import os, sys, glob, time, re, shutil,  math, unittest, logging, zipfile, platform, subprocess, hashlib, threading, json, struct, zlib, uuid, csv, collections
+import contextlib, functools
+try:
+   import resource
+except ImportError: # Windows
+   resource = None
 from shutil import copyfile
 
-from six.moves.urllib.request import urlretrieve
+from six.moves.urllib.request import urlopen, Request, url2pathname
+from six.moves.urllib.parse import urlparse
+from six.moves import queue
 import numpy as np
 import SimpleITK as sitk
 
 # Slicer related
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
+from vtk.util import numpy_support
 import sitkUtils
 import SampleData
-import SegmentStatistics
 import Elastix
 
 #===================================================================
@@ -64,6 +71,129 @@ class VisSimCommonWidget(ScriptedLoadableModuleWidget):
 #===================================================================
 #                           Logic Class
 #===================================================================
+# raised when the user cancels a running pipeline
+class VisSimCancelledError(Exception):
+  pass
+
+#===================================================================
+#                           Profiling
+#===================================================================
+# Spans of the stages of a run: wall time, CPU time and peak RSS of this process, the bytes
+# read and written by this process, and CPU time, peak RSS and bytes of the child processes
+# (elastix, transformix) that a span waited for. The I/O bytes are the read and write calls
+# of /proc/<pid>/io, so files on tmpfs are counted. The spans are written as a Chrome trace
+# (chrome://tracing or Perfetto).
+class VisSimProfiler(object):
+
+  def __init__(self):
+      self.events = []
+      self.lock   = threading.Lock()
+      self.local  = threading.local() # open spans of each thread
+      self.childIO = {'readBytes': 0, 'writtenBytes': 0}
+
+  # wall time, CPU time, peak RSS (MB) and I/O bytes of this process at this moment,
+  # cpu is the CPU time of all threads of the process
+  def getUsage(self):
+      usage = {'wall': time.time(), 'cpu': time.process_time(), 'maxRSS': 0.0}
+      if resource is not None:
+         usage['maxRSS'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * getRSSScale()
+      # the I/O of reaped children is added to /proc/self/io
+      io = readProcessIO("self")
+      with self.lock:
+           usage['readBytes']    = io['readBytes'] - self.childIO['readBytes']
+           usage['writtenBytes'] = io['writtenBytes'] - self.childIO['writtenBytes']
+      return usage
+
+  # usage of a finished child process, it is added to the open spans of this thread
+  def addChildUsage(self, childUsage):
+      with self.lock:
+           self.childIO['readBytes']    += childUsage['readBytes']
+           self.childIO['writtenBytes'] += childUsage['writtenBytes']
+      for childTotals in getattr(self.local, 'spans', []):
+          childTotals['cpu']          += childUsage['cpu']
+          childTotals['maxRSS']        = max(childTotals['maxRSS'], childUsage['maxRSS'])
+          childTotals['readBytes']    += childUsage['readBytes']
+          childTotals['writtenBytes'] += childUsage['writtenBytes']
+
+  @contextlib.contextmanager
+  def span(self, name, **args):
+      if not hasattr(self.local, 'spans'):
+         self.local.spans = []
+      childTotals = {'cpu': 0.0, 'maxRSS': 0.0, 'readBytes': 0, 'writtenBytes': 0}
+      self.local.spans.append(childTotals)
+      start = self.getUsage()
+      try:
+         yield
+      finally:
+         end = self.getUsage()
+         self.local.spans.remove(childTotals)
+         args.update({'cpuSeconds'        : round(end['cpu'] - start['cpu'], 3),
+                      'maxRSSMB'          : round(end['maxRSS'], 1),
+                      'readBytes'         : end['readBytes'] - start['readBytes'],
+                      'writtenBytes'      : end['writtenBytes'] - start['writtenBytes'],
+                      'childCpuSeconds'   : round(childTotals['cpu'], 3),
+                      'childMaxRSSMB'     : round(childTotals['maxRSS'], 1),
+                      'childReadBytes'    : childTotals['readBytes'],
+                      'childWrittenBytes' : childTotals['writtenBytes']})
+         event = {'name': name, 'ph': "X", 'ts': int(start['wall']*1e6), 'dur': int((end['wall'] - start['wall'])*1e6),
+                  'pid': os.getpid(), 'tid': threading.current_thread().ident, 'args': args}
+         with self.lock:
+              self.events.append(event)
+
+  def writeTrace(self, tracePath):
+      with self.lock:
+           events = list(self.events)
+      with open(tracePath, 'w') as f:
+           json.dump({'traceEvents': events, 'displayTimeUnit': "ms"}, f)
+      return tracePath
+
+  # totals of each span name in the order of the first call
+  def getSummary(self):
+      totals = collections.OrderedDict()
+      with self.lock:
+           for event in sorted(self.events, key=lambda e: e['ts']):
+               total = totals.setdefault(event['name'], {'calls': 0, 'wallSeconds': 0.0, 'cpuSeconds': 0.0, 'readBytes': 0, 'writtenBytes': 0,
+                                                         'maxRSSMB': 0.0, 'childCpuSeconds': 0.0, 'childMaxRSSMB': 0.0,
+                                                         'childReadBytes': 0, 'childWrittenBytes': 0})
+               total['calls']        += 1
+               total['wallSeconds']  += event['dur'] / 1e6
+               for key in ['cpuSeconds', 'readBytes', 'writtenBytes', 'childCpuSeconds', 'childReadBytes', 'childWrittenBytes']:
+                   total[key] += event['args'][key]
+               total['maxRSSMB']      = max(total['maxRSSMB'], event['args']['maxRSSMB'])
+               total['childMaxRSSMB'] = max(total['childMaxRSSMB'], event['args']['childMaxRSSMB'])
+      return totals
+
+  def printSummary(self):
+      totals = self.getSummary()
+      print("      %-28s %6s %10s %10s %11s" % ("stage", "calls", "wall s", "cpu s", "child cpu s"))
+      for name in totals:
+          print("      %-28s %6d %10.2f %10.2f %11.2f" % (name, totals[name]['calls'], totals[name]['wallSeconds'], totals[name]['cpuSeconds'],
+                                                         totals[name]['childCpuSeconds']))
+
+# ru_maxrss is in KB on Linux and in bytes on macOS, the scale gives MB
+def getRSSScale():
+  return 1.0/(1024*1024) if sys.platform == "darwin" else 1.0/1024
+
+# bytes of the read and write calls of a process, 0 if /proc/<pid>/io is not available
+def readProcessIO(pid):
+  try:
+     with open("/proc/" + str(pid) + "/io") as f:
+          io = dict(line.split(":") for line in f.read().splitlines())
+     return {'readBytes': int(io['rchar']), 'writtenBytes': int(io['wchar'])}
+  except (IOError, OSError, KeyError, ValueError):
+     return {'readBytes': 0, 'writtenBytes': 0}
+
+# Method decorator, the span is recorded by the logic of the object (self, or self.vsc for engines)
+def vsProfiled(name):
+  def decorator(func):
+      @functools.wraps(func)
+      def wrapper(self, *args, **kwargs):
+          with getattr(self, 'vsc', self).span(name):
+               return func(self, *args, **kwargs)
+      return wrapper
+  return decorator
+
+
 class VisSimCommonLogic(ScriptedLoadableModuleLogic):
 
   ElastixLogic = Elastix.ElastixLogic()
@@ -75,23 +205,16 @@ class VisSimCommonLogic(ScriptedLoadableModuleLogic):
       print("testing")
       return x+y
 
-  # Get slicer lib path automatically
-  def getSlicerLibPath(SlicerPath):
-      # Search for directories that match the "Slicer-*" pattern within the lib directory
-      slicer_dirs = glob.glob(os.path.join(os.path.join(SlicerPath, "lib"), "Slicer-*"))
-      
-      # Assuming there's only one Slicer directory per installation, take the first match
-      return slicer_dirs[0] 
-  
   # vsExtension = 0: Cochlea, vsExtension = 1: Spine
-  def setGlobalVariables(self,vsExtension):
+  # verifyFull: re-hash all model files, also enabled by --verify-full in the command line
+  def setGlobalVariables(self,vsExtension, verifyFull=False):
       # define global variables as a dictonary
       self.vtVars = {}
 
       #shared stuff
       self.elastixEnv                     = self.ElastixLogic.getElastixEnv()  # to load elastix libs
       self.elastixStartupInfo             = self.ElastixLogic.getStartupInfo() # to hide the console
-      self.vtVars['vissimPath']           = os.path.join(os.path.expanduser("~"),"VisSimTools")
+      self.vtVars['vissimPath']           = os.environ.get("VISSIM_TOOLS_PATH", os.path.join(os.path.expanduser("~"),"VisSimTools"))
       self.vtVars['elastixBinPath']       = os.path.join(self.ElastixBinFolder, "elastix")
       self.vtVars['transformixBinPath']   =  os.path.join(self.ElastixBinFolder, "transformix")
       self.vtVars['winOS']                = "False"
@@ -104,7 +227,17 @@ class VisSimCommonLogic(ScriptedLoadableModuleLogic):
       self.vtVars['outputPath']           = os.path.join(self.vtVars['vissimPath'],"outputs")
       self.vtVars['imgType']              = ".nrrd"
       self.vtVars['hrChk']                = "True"
+      self.vtVars['resamplingMode']       = "fixed" # fixed: RSxyz and hrChk, adaptive or preview, see setResamplingSpacing
       self.vtVars['fixedPoint']           = "[0,0,0]" # initial poisition = no position
+      self.vtVars['elastixEngine']        = "auto" # auto, inprocess or subprocess
+      self.vtVars['useTmpfs']             = "False" # run workspace in /dev/shm
+      self.vtVars['warpMode']             = "points" # points: transformix on labels and points, field: dense deformation fields
+      self.vtVars['regCache']             = "True"   # reuse registration results of the same input
+      self.vtVars['elastixThreads']       = os.environ.get("VISSIM_ELASTIX_THREADS", "") # empty: all cores
+      self.vtVars['elastixPreset']        = os.environ.get("VISSIM_ELASTIX_PRESET", "default") # fast, default or accurate
+      self.vtVars['elastixParameters']    = "" # overrides "key=value;key=value", a value *f scales the file value
+      self.vtVars['iterationTuning']      = os.environ.get("VISSIM_ITERATION_TUNING", "off") # record: keep the convergence, auto: also use it
+      self.vtVars['verifyFull']           = str(verifyFull or ("--verify-full" in sys.argv))
       self.vtVars['movingPoint']          = "[0,0,0]" # initial poisition = no position
       # change the model type from vtk to stl
       msn=slicer.vtkMRMLModelStorageNode()
@@ -118,11 +251,14 @@ class VisSimCommonLogic(ScriptedLoadableModuleLogic):
          self.vtVars['parsNRPath']          = os.path.join(self.vtVars['vissimPath'] , "pars","parCochSegNR.txt")        
          self.vtVars['modelPath']           = os.path.join(self.vtVars['vissimPath'] , "models","modelCochlea")
          self.vtVars['downSz']              = "500"
+         self.vtVars['locatorSpacing']      = "0.5" # finest spacing of the automatic cochlea localization
          self.vtVars['inputPoint']          = "[0,0,0]" # initial poisition = no position
          self.vtVars['croppingLength']      = "[ 10 , 10 , 10 ]"   #Cropping Parameters
          self.vtVars['RSxyz']               = "[ 0.125, 0.125 , 0.125 ]"  #Resampling parameters
          self.vtVars['dispViewTxt']         = "Green"
          self.vtVars['cochleaSide']         = "L" # default cochlea side is left
+         self.vtVars['atlasCount']          = "1" # number of atlases registered at the same time
+         self.vtVars['labelFusion']         = "vote" # multi-atlas label fusion: vote or staple
          self.vtVars['StLength']            = "0" # initial scala tympani central length
          self.vtVars['SvLength']            = "0" # initial scala vestibuli central length 
          self.vtVars['StLtLength']          = "0" # initial scala tympani lateral wall length
@@ -184,7 +320,6 @@ class VisSimCommonLogic(ScriptedLoadableModuleLogic):
       
       othersWebLink =  ""
       if vsExtension ==0: # cochlea
-         # TODO: optimise this part to download only the missing files
          print("      Cochlea Extension is selected")
       elif vsExtension ==1: # CervicalSpine
          print("      Spine Extension is selected")
@@ -192,7 +327,7 @@ class VisSimCommonLogic(ScriptedLoadableModuleLogic):
          print("   Wrong extension ID")
          return -1
       # check if model files exist
-      if  (os.path.exists(vtVars['modelPath'])) and (self.chkSHA256Sum(vtVars['modelPath'], self.OthersSHA256)):
+      if  (os.path.exists(vtVars['modelPath'])) and (self.chkModelManifest(vtVars['modelPath'], self.OthersSHA256, self.s2b(vtVars['verifyFull']))):
           print("      Model folder is found..." )
           print("      Parameter file: "  + vtVars['parsPath'])
           print("      Cropping Length: " + vtVars['croppingLength'] )
@@ -200,50 +335,359 @@ class VisSimCommonLogic(ScriptedLoadableModuleLogic):
           print("      Models or contents are wrong, trying to download ..." )
           othersWebLink = vtVars['othersWebLink']
 
+      # offline hosts use the local files as they are
+      if not othersWebLink=="" and not os.environ.get("VISSIM_OFFLINE", "") == "":
+         print("      VISSIM_OFFLINE is set, the download is skipped")
+         othersWebLink = ""
       if not othersWebLink=="":
          print("      Downloading VisSim Tools  ... ")
          try:
                 print("      Downloading VisSimTools others ...")
-                vissimZip = os.path.join(os.path.expanduser("~"),"VisSimToolsTmp.zip")
-                print("vissimZip: ",vissimZip)
-                uFile = urlretrieve(othersWebLink, vissimZip)
-                print ("     Extracting to user home ")
-                zip_ref = zipfile.ZipFile(vissimZip, 'r')
-                zip_ref.extractall(os.path.expanduser("~"))
-                zip_ref.close()
-                #remove the downloaded zip file
-                os.remove(vissimZip)
+                # only the changed files are downloaded and extracted to user home
+                updatedFiles = self.downloadVisSimData(self.getDataLink(othersWebLink), os.path.expanduser("~"))
+                # the old manifest does not describe the new model files
+                modelPath = os.path.normpath(vtVars['modelPath']) + os.sep
+                updatedModelFiles = [f for f in updatedFiles if f.startswith(modelPath)]
+                print("      " + str(len(updatedModelFiles)) + " of " + str(len(updatedFiles)) + " updated files are model files")
+                if len(updatedModelFiles) > 0 and os.path.exists(self.getModelManifestPath(vtVars['modelPath'])):
+                   os.remove(self.getModelManifestPath(vtVars['modelPath']))
                 print ("     Extracting to user home ... done! ")
          except Exception as e:
                 print("      Error: can not download and extract VisSimTools ...")
                 print(e)
                 return -1
 
+  #--------------------------------------------------------------------------------------------
+  #                        Atlas files
+  #--------------------------------------------------------------------------------------------
+  # model files are loaded once and kept in VisSimAtlasCache
+  def getAtlasImage(self, imgPath):
+      return VisSimAtlasCache.instance().getImage(imgPath)
+
+  def loadAtlasSegmentation(self, segPath, nodeName):
+      return VisSimAtlasCache.instance().getSegmentationNode(segPath, nodeName)
+
+  def loadAtlasLandmarks(self, fcsvPath, nodeName):
+      pts, labels = VisSimAtlasCache.instance().getLandmarks(fcsvPath)
+      return self.createMarkupsNode(nodeName, pts, labels)
+
+  # Several landmark files are warped together with one evaluation of the transform,
+  # the points are split back into one node for each file
+  def loadWarpedAtlasLandmarks(self, fcsvPaths, nodeNames, transformNode):
+      landmarks = [VisSimAtlasCache.instance().getLandmarks(fcsvPath) for fcsvPath in fcsvPaths]
+      pts = self.warpPoints(np.vstack([l[0] for l in landmarks]), transformNode)
+      splitIdx = np.cumsum([len(l[0]) for l in landmarks])[:-1]
+      return [self.createMarkupsNode(nodeName, nodePts, l[1]) for nodeName, nodePts, l in zip(nodeNames, np.split(pts, splitIdx), landmarks)]
+
+  # Nx3 RAS points moved by the transform of the node, the same as hardening the transform
+  def warpPoints(self, ptsRAS, transformNode):
+      inPts = vtk.vtkPoints()
+      inPts.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(ptsRAS, dtype=float), deep=True))
+      outPts = vtk.vtkPoints()
+      transformNode.GetTransformToParent().TransformPoints(inPts, outPts)
+      return numpy_support.vtk_to_numpy(outPts.GetData()).reshape(-1,3).copy()
+
+  def createMarkupsNode(self, nodeName, pts, labels):
+      markupsNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", nodeName)
+      markupsNode.CreateDefaultDisplayNodes()
+      wasModifying = markupsNode.StartModify()
+      slicer.util.updateMarkupsControlPointsFromArray(markupsNode, pts)
+      for i in range(len(labels)):
+          markupsNode.SetNthControlPointLabel(i, labels[i])
+      markupsNode.EndModify(wasModifying)
+      return markupsNode
+
+  #--------------------------------------------------------------------------------------------
+  #                        Incremental download of the VisSim data
+  #--------------------------------------------------------------------------------------------
+  # The central directory of the remote zip file is read with HTTP range requests and
+  # compared with the local files (size and CRC32, the manifest is used when possible).
+  # Only the changed files are downloaded. Each file is decompressed while it is downloaded,
+  # the compressed bytes are kept in a .part file so an interrupted transfer continues where
+  # it stopped. Servers without range support, file:// links and local mirror folders work too.
+  # The environment variable VISSIM_DATA_MIRROR replaces the download location.
+  def getDataLink(self, webLink):
+      mirror = os.environ.get("VISSIM_DATA_MIRROR", "").strip()
+      if mirror == "":
+         return webLink
+      if os.path.isdir(mirror):
+         return os.path.join(mirror, os.path.basename(webLink))
+      return mirror.rstrip("/") + "/" + os.path.basename(webLink)
+
+  # returns a list of the updated files
+  def downloadVisSimData(self, webLink, destFolder):
+      print("      Downloading from: " + webLink)
+      fallbackZip = None
+      try:
+         remote = VisSimRemoteFile(webLink)
+      except VisSimRangeError:
+         # no random access, download the whole file once
+         fallbackZip = os.path.join(destFolder, "VisSimToolsTmp.zip")
+         self.downloadWithResume(webLink, fallbackZip)
+         remote = VisSimRemoteFile(fallbackZip)
+      updatedFiles = []
+      try:
+         zf = zipfile.ZipFile(remote)
+         for info in zf.infolist():
+             if info.filename.endswith("/"):
+                continue
+             targetPath = os.path.normpath(os.path.join(destFolder, info.filename))
+             if not targetPath.startswith(os.path.normpath(destFolder) + os.sep):
+                print("      skipping unsafe path: " + info.filename)
+                continue
+             if self.isLocalFileUpToDate(targetPath, info):
+                continue
+             print("      updating: " + info.filename)
+             self.extractZipMember(remote, zf, info, targetPath)
+             updatedFiles.append(targetPath)
+         zf.close()
+      finally:
+         remote.close()
+      if fallbackZip is not None:
+         os.remove(fallbackZip)
+      print("      " + str(len(updatedFiles)) + " files are updated")
+      return updatedFiles
+
+  # same size and CRC32 as the zip entry, the CRC32 from the model manifest is used
+  # if the file did not change since the manifest was written
+  def isLocalFileUpToDate(self, targetPath, info):
+      if not os.path.isfile(targetPath):
+         return False
+      st = os.stat(targetPath)
+      if not (st.st_size == info.file_size):
+         return False
+      if hasattr(self, 'vtVars') and targetPath.startswith(os.path.normpath(self.vtVars['modelPath']) + os.sep):
+         manifest = self.readModelManifest(self.vtVars['modelPath'])
+         if manifest is not None:
+            relPath = os.path.relpath(targetPath, self.vtVars['modelPath']).replace(os.sep, "/")
+            entry = manifest['files'].get(relPath)
+            if (entry is not None) and ('crc32' in entry) and (entry['size'] == st.st_size) and (entry['mtime'] == st.st_mtime):
+               return entry['crc32'] == info.CRC
+      crc = 0
+      with open(targetPath, 'rb') as f:
+           for buf in iter(lambda: f.read(1 << 20), b""):
+               crc = zlib.crc32(buf, crc)
+      return (crc & 0xffffffff) == info.CRC
+
+  # download and decompress one zip entry, the compressed bytes are checkpointed in targetPath.part
+  def extractZipMember(self, remote, zf, info, targetPath):
+      targetFolder = os.path.dirname(targetPath)
+      if not os.path.exists(targetFolder):
+         os.makedirs(targetFolder)
+      tmpPath  = targetPath + ".tmp"
+      partPath = targetPath + ".part"
+      if info.compress_type not in [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED]:
+         # other compressions can not be resumed
+         with zf.open(info) as src, open(tmpPath, 'wb') as dst:
+              shutil.copyfileobj(src, dst, 1 << 20)
+         os.replace(tmpPath, targetPath)
+         return
+      # local file header: the name and extra field lengths are at bytes 26 and 28
+      localHeader = remote.readRange(info.header_offset, info.header_offset + 30)
+      nameLength, extraLength = struct.unpack("<HH", localHeader[26:30])
+      dataStart = info.header_offset + 30 + nameLength + extraLength
+      dataEnd   = dataStart + info.compress_size
+
+      decompressor = zlib.decompressobj(-15) if info.compress_type == zipfile.ZIP_DEFLATED else None
+      crc = [0]
+      def extract(buf, dst, decompress=True):
+          if decompress and decompressor is not None:
+             buf = decompressor.decompress(buf)
+          crc[0] = zlib.crc32(buf, crc[0])
+          dst.write(buf)
+
+      done = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+      if done > info.compress_size:
+         done = 0
+      try:
+         with open(tmpPath, 'wb') as dst:
+              if done > 0:
+                 print("      resuming " + info.filename + " at " + str(done) + " bytes")
+                 with open(partPath, 'rb') as part:
+                      for buf in iter(lambda: part.read(1 << 20), b""):
+                          extract(buf, dst)
+              with open(partPath, 'ab' if done > 0 else 'wb') as part:
+                   for buf in remote.iterRange(dataStart + done, dataEnd):
+                       part.write(buf)
+                       part.flush()
+                       extract(buf, dst)
+                       self.processEvents()
+              if decompressor is not None:
+                 extract(decompressor.flush(), dst, decompress=False)
+      except zlib.error:
+         # a corrupt part file would fail every resume, it is removed like a CRC error
+         crc[0] = ~info.CRC
+      if not ((crc[0] & 0xffffffff) == info.CRC):
+         os.remove(tmpPath)
+         os.remove(partPath)
+         raise IOError("CRC error in " + info.filename)
+      os.replace(tmpPath, targetPath)
+      os.remove(partPath)
+
+  # download a whole file, an existing .part file is continued if the server supports it
+  def downloadWithResume(self, url, filePath):
+      partPath = filePath + ".part"
+      done = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+      if done > 0:
+         # a complete part file gets HTTP 416 for its range, a longer one is not from this file
+         remoteSize = self.getRemoteFileSize(url)
+         if remoteSize == done:
+            os.replace(partPath, filePath)
+            return filePath
+         if remoteSize is not None and done > remoteSize:
+            done = 0
+      headers = {"Range": "bytes=%d-" % done} if done > 0 else {}
+      response = urlopen(Request(url, headers=headers), timeout=60)
+      mode = 'ab'
+      if not (response.getcode() == 206):
+         # the server sends the whole file
+         mode = 'wb'
+      with open(partPath, mode) as part:
+           for buf in iter(lambda: response.read(1 << 20), b""):
+               part.write(buf)
+               self.processEvents()
+      response.close()
+      os.replace(partPath, filePath)
+      return filePath
+
+  # Content-Length of a HEAD request, None if the server does not send it
+  def getRemoteFileSize(self, url):
+      try:
+         request = Request(url)
+         request.get_method = lambda: "HEAD"
+         response = urlopen(request, timeout=60)
+         contentLength = response.headers.get("Content-Length")
+         response.close()
+         return int(contentLength) if contentLength is not None else None
+      except Exception as e:
+         print(e)
+         return None
+
+  #--------------------------------------------------------------------------------------------
+  #                        Model integrity check
+  #--------------------------------------------------------------------------------------------
+  # The checksum of the whole model folder is computed from the sha256 of each 4 KB chunk
+  # of each file in os.walk order. The files are hashed in parallel, the chunk digests are
+  # combined in the same order.
   def chkSHA256Sum(self, folderPath, sha256Sum):
+      filePaths = self.getModelFiles(folderPath)
+      fileHashes = self.hashModelFiles(filePaths)
       sha256_hash = hashlib.sha256()
-      for root, dirs, files in os.walk(folderPath):
-         for names in files:
-            f1 = open(os.path.join(root,names), 'rb')
-            while 1:
-               # Read file in as little chunks
-               buf = f1.read(4096)
-               if not buf : break
-            
-               #Python2 and Python3 compitiblity
-               if sys.version_info[0] < 3:  #Python2
-                  sha256_hash.update(hashlib.sha256(buf).hexdigest())
-               else                           :  #Python3
-                  sha256_hash.update(hashlib.sha256(buf).digest())
-
-            f1.close()
-
+      for filePath in filePaths:
+          sha256_hash.update(fileHashes[filePath][1])
       sha256computedCheckSum = sha256_hash.hexdigest()
       updatedModel = False
       print("      sha256computedCheckSum: " +sha256computedCheckSum)
       if sha256computedCheckSum == sha256Sum:
          updatedModel = True
+         # the folder is verified, remember the files for the next check
+         self.writeModelManifest(folderPath, sha256Sum, fileHashes)
       return updatedModel
 
+  # all files of a folder in os.walk order
+  def getModelFiles(self, folderPath):
+      filePaths = []
+      for root, dirs, files in os.walk(folderPath):
+         for names in files:
+            filePaths.append(os.path.join(root,names))
+      return filePaths
+
+  # returns sha256 of the file, the concatenated sha256 digests of its 4 KB chunks
+  # and the CRC32 used to compare with zip entries
+  def hashModelFile(self, filePath):
+      file_hash = hashlib.sha256()
+      chunkDigests = []
+      crc = 0
+      with open(filePath, 'rb') as f1:
+          while 1:
+             # Read file in as little chunks
+             buf = f1.read(4096)
+             if not buf : break
+             file_hash.update(buf)
+             crc = zlib.crc32(buf, crc)
+             chunkDigests.append(hashlib.sha256(buf).digest())
+      return file_hash.hexdigest(), b"".join(chunkDigests), crc & 0xffffffff
+
+  # hash files in parallel, hashlib releases the GIL while hashing
+  def hashModelFiles(self, filePaths):
+      from concurrent.futures import ThreadPoolExecutor
+      nThreads = max(1, min(8, os.cpu_count() or 1, len(filePaths)))
+      with ThreadPoolExecutor(max_workers=nThreads) as executor:
+           fileHashes = dict(zip(filePaths, executor.map(self.hashModelFile, filePaths)))
+      return fileHashes
+
+  # the manifest is stored next to the model folder e.g. models/modelCochlea.manifest.json
+  # so it does not change the folder checksum
+  def getModelManifestPath(self, folderPath):
+      return os.path.normpath(folderPath) + ".manifest.json"
+
+  def readModelManifest(self, folderPath):
+      try:
+         with open(self.getModelManifestPath(folderPath)) as f:
+              return json.load(f)
+      except (IOError, ValueError):
+         return None
+
+  def writeModelManifest(self, folderPath, sha256Sum, fileHashes):
+      manifest = {'folderSHA256': sha256Sum, 'files': {}}
+      for filePath in fileHashes:
+          st = os.stat(filePath)
+          relPath = os.path.relpath(filePath, folderPath).replace(os.sep, "/")
+          manifest['files'][relPath] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha256': fileHashes[filePath][0], 'crc32': fileHashes[filePath][2]}
+      manifestPath = self.getModelManifestPath(folderPath)
+      try:
+         with open(manifestPath + ".tmp", "w") as f:
+              json.dump(manifest, f, indent=1, sort_keys=True)
+         os.replace(manifestPath + ".tmp", manifestPath)
+      except (IOError, OSError) as e:
+         print("      can not write the model manifest: " + str(e))
+
+  # Fast check: files with the same size and mtime as in the manifest are not hashed again,
+  # changed files are hashed in parallel and compared with the manifest sha256.
+  # If a file has different contents, the full check decides.
+  # A full check is done if there is no manifest, the expected checksum changed,
+  # files were added or removed, or verifyFull is true.
+  def chkModelManifest(self, folderPath, sha256Sum, verifyFull=False):
+      manifest = self.readModelManifest(folderPath)
+      if verifyFull or (manifest is None) or not (manifest.get('folderSHA256') == sha256Sum):
+         print("      full model check ...")
+         return self.chkSHA256Sum(folderPath, sha256Sum)
+
+      filePaths = self.getModelFiles(folderPath)
+      relPaths  = dict([(os.path.relpath(p, folderPath).replace(os.sep, "/"), p) for p in filePaths])
+      if not (set(relPaths.keys()) == set(manifest['files'].keys())):
+         print("      model files are added or removed, full model check ...")
+         return self.chkSHA256Sum(folderPath, sha256Sum)
+
+      changedFiles = []
+      for relPath, filePath in relPaths.items():
+          st = os.stat(filePath)
+          entry = manifest['files'][relPath]
+          if not ((st.st_size == entry['size']) and (st.st_mtime == entry['mtime'])):
+             changedFiles.append(filePath)
+      if len(changedFiles) == 0:
+         print("      model manifest: all files are unchanged")
+         return True
+
+      print("      model manifest: hashing " + str(len(changedFiles)) + " changed files ...")
+      fileHashes = self.hashModelFiles(changedFiles)
+      for filePath in changedFiles:
+          relPath = os.path.relpath(filePath, folderPath).replace(os.sep, "/")
+          if not (fileHashes[filePath][0] == manifest['files'][relPath]['sha256']):
+             # the folder checksum decides, the manifest is rewritten if it is still valid
+             print("      model file is changed: " + relPath + ", full model check ...")
+             return self.chkSHA256Sum(folderPath, sha256Sum)
+          # same contents, only the time stamp changed
+          manifest['files'][relPath]['mtime'] = os.stat(filePath).st_mtime
+      manifestPath = self.getModelManifestPath(folderPath)
+      try:
+         with open(manifestPath + ".tmp", "w") as f:
+              json.dump(manifest, f, indent=1, sort_keys=True)
+         os.replace(manifestPath + ".tmp", manifestPath)
+      except (IOError, OSError) as e:
+         print("      can not update the model manifest: " + str(e))
+      return True
+
   # string to boolean converter
   def s2b(self,s):
         return s.lower() in ("yes", "true", "t", "1")
@@ -263,66 +707,89 @@ class VisSimCommonLogic(ScriptedLoadableModuleLogic):
 
       return vector
 
+#------------------------------------------------------
+#                  IJK to RAS matrices
+#------------------------------------------------------
+# The 4x4 IJK to RAS matrix of a volume node or an image path as numpy array.
+# Matrices are cached for each node and its modified time, for a path the
+# image header is read without loading the voxels. Only the last used
+# ijk2rasCacheSize nodes and paths are kept.
+  ijk2rasCache = collections.OrderedDict() # key: (modified time, ijk2ras, ras2ijk)
+  ijk2rasCacheSize = 64
+  ijk2rasLock = threading.Lock()
+  def getIJKToRASArray(self, inputImg):
+      return self.getIJKToRASMatrices(inputImg)[0]
+
+  def getRASToIJKArray(self, inputImg):
+      return self.getIJKToRASMatrices(inputImg)[1]
+
+  def getIJKToRASMatrices(self, inputImg):
+      if (isinstance(inputImg, str)):
+         key = os.path.abspath(inputImg)
+         mTime = os.path.getmtime(key)
+      else:
+         key = inputImg.GetID()
+         mTime = inputImg.GetMTime()
+      with self.ijk2rasLock:
+           cached = self.ijk2rasCache.get(key)
+           if (cached is not None) and (cached[0] == mTime):
+              self.ijk2rasCache.move_to_end(key)
+              return cached[1:3]
+      if (isinstance(inputImg, str)):
+         reader = sitk.ImageFileReader()
+         reader.SetFileName(inputImg)
+         reader.ReadImageInformation()
+         ijk2lps = np.eye(4)
+         ijk2lps[0:3,0:3] = np.array(reader.GetDirection()).reshape(3,3).dot(np.diag(reader.GetSpacing()))
+         ijk2lps[0:3,3]   = reader.GetOrigin()
+         ijk2ras = np.diag([-1.0,-1.0,1.0,1.0]).dot(ijk2lps)
+      else:
+         ijk2rasM = vtk.vtkMatrix4x4()
+         inputImg.GetIJKToRASMatrix(ijk2rasM)
+         ijk2ras = slicer.util.arrayFromVTKMatrix(ijk2rasM)
+      ras2ijk = np.linalg.inv(ijk2ras)
+      with self.ijk2rasLock:
+           self.ijk2rasCache[key] = (mTime, ijk2ras, ras2ijk)
+           self.ijk2rasCache.move_to_end(key)
+           while len(self.ijk2rasCache) > self.ijk2rasCacheSize:
+                 self.ijk2rasCache.popitem(last=False)
+      return ijk2ras, ras2ijk
+
 #------------------------------------------------------
 #                  IJK to RAS
 #------------------------------------------------------
+# These functions convert Nx3 arrays of points
+#  input:  Nx3 points and a volume node or image path
+#  output: Nx3 float array
+  def ptsIJK2RAS(self, ptsIJK, inputImg):
+      ptsIJK = np.asarray(ptsIJK, dtype=float).reshape(-1,3)
+      M = self.getIJKToRASArray(inputImg)
+      return ptsIJK.dot(M[0:3,0:3].T) + M[0:3,3]
+
+  def ptsRAS2IJK(self, ptsRAS, inputImg):
+      ptsRAS = np.asarray(ptsRAS, dtype=float).reshape(-1,3)
+      M = self.getRASToIJKArray(inputImg)
+      return ptsRAS.dot(M[0:3,0:3].T) + M[0:3,3]
+
 # This function convert an IJK point to RAS point
 #  input:  a point vector and volume node
 #  output: a point vector
   def ptIJK2RAS(self,ptIJK, inputImg): # imgPath or imgNode are supported
-        #TODO: add option for printing
-        # create a IJK2RAs transformation matrix
-        inputImgNode =inputImg
-        if (isinstance(inputImg, str)):
-            inputImgNode = slicer.util.loadVolume( inputImg)
-        ijk2rasM = vtk.vtkMatrix4x4()
-        inputImgNode.GetIJKToRASMatrix(ijk2rasM)
-        ptRAS=np.zeros((len(ptIJK),3))
-        ijk= ptIJK
-        # create a 4 elements array to get the converted values
-        ijkv=[ijk[0],ijk[1],ijk[2],1]
-        rasPt=ijk2rasM.MultiplyDoublePoint(ijkv)
-        ptRAS=rasPt[0:3]
-        if (isinstance(inputImg, str)):
-           slicer.mrmlScene.RemoveNode(inputImgNode )
- 
-        return  ptRAS
+      return self.ptsIJK2RAS([ptIJK[0:3]], inputImg)[0]
 
 #------------------------------------------------------
 #                 RAS  to IJK
 #------------------------------------------------------
 # This function convert RAS ro an IJK point
-#  input:  a point vector and volume node
+#  input:  a fiducial node (the ith point is used) or a point string, and a volume node
 #  output: a point vector
   def ptRAS2IJK(self,ptRAS,inputImg,i):
-      inputImgNode =inputImg
-      if (isinstance(inputImg, str)):
-            inputImgNode = slicer.util.loadVolume( inputImg, returnNode=True)
-
-      # create a RAS2IJK transformation matrix
-      ras2ijkM = vtk.vtkMatrix4x4()
-      inputImgNode.GetRASToIJKMatrix(ras2ijkM)
       ras=[0,0,0]
-      #'vtkSlicerMarkupsModuleMRMLPython.vtkMRMLMarkupsFiducialNode'
-      if not type(ptRAS) =='str':
-         #TODO: add option for printing
-         if not i is None:
-            print(i)
-            print(type(ptRAS))
-            ptRAS.GetNthControlPointPosition(i,ras)
-         else:
-            ptRAS.GetNthControlPointPosition(0,ras)
-         
+      if not isinstance(ptRAS, str):
+         ptRAS.GetNthControlPointPosition(0 if i is None else i,ras)
       else:
-            ras=self.t2v(ptRAS)
-      
-      # create a 4 elements array to get the converted values
-      rasv=[ras[0],ras[1],ras[2],1]
-      ptIJKf=np.zeros(3);
-      ijkPt=ras2ijkM.MultiplyPoint(rasv)
-      ptIJKf[0]=ijkPt[0];ptIJKf [1]=ijkPt[1];ptIJKf [2]=ijkPt[2];
-      ptIJK = ptIJKf.astype(np.int64)
-      #print("RAS= " + str(ras)+ "   IJK= " + str(ptIJK))
+         ras=self.t2v(ptRAS)
+      ptIJK = self.ptsRAS2IJK([ras], inputImg)[0].astype(np.int64)
       return  ptIJK
 
   #------------------------------------------------------
@@ -337,35 +804,27 @@ class VisSimCommonLogic(ScriptedLoadableModuleLogic):
         print("====================================================")
         print("=                Image to Points                  =")
         print("====================================================")
-        # clone the input image
-        nimg = sitkUtils.PullVolumeFromSlicer(inputImgNode.GetID())
-        sz= inputImgNode.GetImageData().GetDimensions()
-        tmpImgArray = slicer.util.array(inputImgNode.GetID())
+        tmpImgArray = slicer.util.arrayFromVolume(inputImgNode)
         nimgMax = tmpImgArray.max()
-        nimgMin = tmpImgArray.min()
 
-        b= list(zip( *np.where(tmpImgArray > (nimgMax/2 ) ) ))
-        NoPts = len(b)
-        ptsIJK   =np.zeros((NoPts,4))
-        ptsIJKtmp=np.zeros((NoPts,4))
+        # voxels above half max in (k,j,i) order, sorted by intensity
+        ptsKJI = np.argwhere(tmpImgArray > (nimgMax/2))
+        NoPts = len(ptsKJI)
         print("Number of points imported: " + str(NoPts))
-        for j in range (0,NoPts):
-               x= b[j][2] ; y= b[j][1] ; z= b[j][0]
-               ptsIJK[j][0:3] =[ x ,y, z ]
-               ptsIJKtmp[j][0:3]   =[ x ,y, z ]
-               ptsIJKtmp[j][3]     = tmpImgArray[z][y][x]
-
-        ptsIJKtmp=  sorted(ptsIJKtmp, key = lambda t: t[-1])
-
-        self.markupsNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
-        self.markupsNode.CreateDefaultDisplayNodes()
-        self.markupsNode.SetName("P")
-        ptsRAS   =np.zeros((NoPts,3))
-        for j in range (0,NoPts):
-           ptsIJK[j][0:3] = ptsIJKtmp[j][0:3]
-           ptsRAS[j]=  self.ptIJK2RAS(ptsIJK[j],inputImgNode)
-           x = ptsRAS[j][0]; y = ptsRAS[j][1] ; z = ptsRAS[j][2]
-           self.markupsNode.AddFiducial(x,y,z)
+        ptsKJI = ptsKJI[np.argsort(tmpImgArray[tuple(ptsKJI.T)], kind='stable')]
+
+        # all points are converted with one matrix multiplication
+        ptsRAS = self.ptsIJK2RAS(ptsKJI[:,::-1], inputImgNode)
+
+        # add all points at once, no event for each point
+        slicer.mrmlScene.StartState(slicer.mrmlScene.BatchProcessState)
+        try:
+           self.markupsNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode")
+           self.markupsNode.CreateDefaultDisplayNodes()
+           self.markupsNode.SetName("P")
+           slicer.util.updateMarkupsControlPointsFromArray(self.markupsNode, ptsRAS)
+        finally:
+           slicer.mrmlScene.EndState(slicer.mrmlScene.BatchProcessState)
 
         # get the file name at the first of the plugin
         # this keeps the fiducials with short name
@@ -379,241 +838,957 @@ class VisSimCommonLogic(ScriptedLoadableModuleLogic):
   # Using the location as a center point, we cropp around it using the defined cropLength
   # point must be a string in IJK format e.g. "[190,214,92]"
   # this is useful to call the function from console with some arguments
+  # The cropped (and resampled) image is also written to disk, use
+  # runCroppingInMemory if no file is needed.
   def runCropping(self, inputVolume, pointT,croppingLengthT, samplingLengthT, hrChkT,  vtIDt):
 
         print("================= Begin cropping  ... =====================")
-        # Create a temporary node as workaround for bad path or filename
-        #TODO: create a temp folder and remove temp node before display
-        print(" location: " + pointT + "   cropping length: " + str(croppingLengthT) )
         nodeName    = inputVolume.GetName() +"_Crop"
         nodeNameIso = inputVolume.GetName() +"_CropIso"
-        inputCropPath = self.vtVars['vissimPath']+","+nodeName +".nrrd"
-        inputCropPath = os.path.join(*inputCropPath.split(","))
-        inputCropIsoPath = self.vtVars['vissimPath']+","+nodeNameIso +".nrrd"
-        inputCropIsoPath = os.path.join(*inputCropIsoPath.split(","))
-
         #for Spine
         if not vtIDt == 0:
            print("Vertebra "+vtIDt+ " location: " + pointT + "   cropping length: " + str(croppingLengthT) )
            nodeName    = inputVolume.GetName() +"_C" + vtIDt
            nodeNameIso = inputVolume.GetName() +"_C" + vtIDt +"_iso"
-           inputCropPath = self.vtVars['vissimPath']+","+nodeName  +".nrrd"
-           inputCropPath = os.path.join(*inputCropPath.split(","))
-           inputCropIsoPath = self.vtVars['vissimPath']+","+nodeNameIso  +".nrrd"
-           inputCropIsoPath = os.path.join(*inputCropIsoPath.split(","))
 
+        hrChk = self.s2b(hrChkT)
+        croppedNode = self.runCroppingInMemory(inputVolume, pointT, croppingLengthT, samplingLengthT, hrChkT, nodeName)
+
+        # only the final image is written, the un-resampled crop is not needed anymore
+        inputCropPath = os.path.join(self.getWorkPath(), (nodeNameIso if hrChk else nodeName) +".nrrd")
+        self.writeCroppedImage(self.croppedImage, inputCropPath)
+        print(" Cropped image is saved in : [%s]" % inputCropPath)
+        print(" Cropping is done !!! ")
+        # so we can remove these files later
+        return inputCropPath
+
+  #--------------------------------------------------------------------------------------------
+  #                       In-memory Cropping Process
+  #--------------------------------------------------------------------------------------------
+  # Same as runCropping but nothing is written to disk. Only the voxels inside the ROI
+  # are copied from the volume, then resampled with SimpleITK if hrChkT is true.
+  #  output: a volume node, the SimpleITK image is kept in self.croppedImage
+  #  volumeArray: the array of the volume, to take it once for several crops
+  @vsProfiled("cropping")
+  def runCroppingInMemory(self, inputVolume, pointT, croppingLengthT, samplingLengthT, hrChkT, nodeName=None, volumeArray=None):
         croppingLength =   self.t2v(croppingLengthT)
         samplingLength =   self.t2v(samplingLengthT)
         hrChk          =   self.s2b(hrChkT)
         point          =   self.t2v(pointT)
         print("location: " + str(point) + "   cropping length: " + str(croppingLength) )
-        #Remove old cropping node
-        nodes = slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")
-        for f in nodes:
-            if ("_Crop" in f.GetName()):
-                slicer.mrmlScene.RemoveNode(f )
-  
+        if nodeName is None:
+           nodeName = inputVolume.GetName() +"_Crop"
+
         # resampling spacing
         self.RSx= samplingLength[0] ; self.RSy=samplingLength[1];     self.RSz= samplingLength[2]
 
-        #Get input image information
-        spacing = inputVolume.GetSpacing()
-        imgData = inputVolume.GetImageData()
-        dimensions = imgData.GetDimensions()
+        croppedImage = self.cropVolumeROI(inputVolume, point, croppingLength, volumeArray)
+        if hrChk:
+           # Resampling: this produces better looking models
+           croppedImage = self.resampleImage(croppedImage, samplingLength)
+           print(" Cropping and resampling are done !!! ")
+        self.croppedImage = croppedImage
 
-        # compute cropping bounds from image information and cropping parameters
-        croppingBounds = [[0,0,0],[0,0,0]];   size = [0,0,0];    lower = [0,0,0] ;     upper = [0,0,0]
+        #Remove old cropping node with the same name
+        nodes = slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")
+        for f in nodes:
+            if (f.GetName() == nodeName):
+                slicer.mrmlScene.RemoveNode(f )
+        croppedNode = sitkUtils.PushVolumeToSlicer(croppedImage, None, nodeName , 'vtkMRMLScalarVolumeNode' )
+        croppedNode.SetName(nodeName)
+        self.addRunNode(croppedNode)
+        return croppedNode
+
+  # compute cropping bounds from image information and cropping parameters
+  #  output: lower and upper IJK index, upper is exclusive
+  def getCroppingBounds(self, inputVolume, point, croppingLength):
+        spacing = inputVolume.GetSpacing()
+        dimensions = inputVolume.GetImageData().GetDimensions()
+        lower = [0,0,0] ;     upper = [0,0,0]
         for i in range(0,3):
-            size[i] = int((croppingLength[i]/spacing[i])/2)
-            lower[i] = int(point[i]) - int(size[i])
-            upper[i] = dimensions[i] - int(point[i]+size[i])
+            size = int((croppingLength[i]/spacing[i])/2)
             # Check if calculated boundaries exceed image dimensions
-            if lower[i] < 0:
-                    lower[i] = 0
-  
-            if upper[i] > dimensions[i]:
-                   upper[i] = int(dimensions[i])
-        croppingBounds = [lower,upper]
-        # Call SimpleITK CropImageFilter
-        inputImage = sitkUtils.PullVolumeFromSlicer(inputVolume.GetID())
-        cropper = sitkUtils.sitk.CropImageFilter()
-        cropper.SetLowerBoundaryCropSize(croppingBounds[0])
-        cropper.SetUpperBoundaryCropSize(croppingBounds[1])
-        print("Cropping with " + str(croppingBounds[0]) + " and " + str(croppingBounds[1]) + ".")
-        croppedImage = cropper.Execute(inputImage)
-        # Make a node with cropped image
-        sitkUtils.PushVolumeToSlicer(croppedImage, None, nodeName , 'vtkMRMLScalarVolumeNode' )
-        crNodes = slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")
-        for f in crNodes:
-            if nodeName in f.GetName():
-                 f.SetName(nodeName)
-                 break
-        croppedNode = slicer.util.getNode(nodeName)
-        print("cropped:     "+inputCropPath)
-        slicer.util.saveNode( croppedNode, inputCropPath)
-        #-------------------------------------------------------
-        # Resampling: this produces better looking models
-        #-------------------------------------------------------
-        #TODO: separate this in  a new function
-        if hrChk:
-           # remove the old cropped node
-           nodes = slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode")
-           for f in nodes:
-               if ("_Crop" in f.GetName()):
-                  slicer.mrmlScene.RemoveNode(f )
-  
-           #Run slicer cli module: resample scalar volume
-           #inputCropIsoPath = os.path.splitext(inputVolume.GetStorageNode().GetFileName())[0] +"_C"+str(vtID) +"_crop_iso.nrrd"
-           print("iso cropped: "+inputCropIsoPath)
-           resampleSpacing = " ["+ str(self.RSx) + "," + str(self.RSy) + "," + str(self.RSz) + "] "
-           SlicerBinPath=""
-           ResampleBinPath=""
-           ## this produces error in windows
-           SlicerPath      =  os.path.abspath(os.path.join(os.path.abspath(os.path.join(os.sys.executable, os.pardir)), os.pardir))
-           SlicerBinPath   =  os.path.join(SlicerPath,"Slicer")
-           SlicerLibPath = VisSimCommonLogic.getSlicerLibPath(SlicerPath)
-           #ResampleBinPath =  os.path.join(SlicerPath,"lib","Slicer-5.4" , "cli-modules","ResampleScalarVolume" )
-           ResampleBinPath =  os.path.join(SlicerLibPath, "cli-modules","ResampleScalarVolume" )           
-           #ResampleBinPath =  os.path.join(SlicerPath,"lib","Slicer-5.6" , "cli-modules","ResampleScalarVolume" )
-           resamplingCommand = ResampleBinPath 
-           if sys.platform == 'win32':
-               ResampleBinPath + ".exe"
-               resamplingCommand = f'"{SlicerBinPath}" --launch "{ResampleBinPath}"'
-  
-           print(resamplingCommand)
-           si = None
-           currentOS = sys.platform
-           cmdPars = " -i linear -s "+ resampleSpacing + inputCropPath +" "+inputCropIsoPath
-           Cmd = resamplingCommand  + cmdPars
-           if sys.platform == 'win32':
-              #note: in windows, no need to use --launch
-              SlicerBinPath = SlicerBinPath +".exe"
-              resamplingCommand = ResampleBinPath + ".exe"
-              print(os.path.getsize(resamplingCommand))
-              si = subprocess.STARTUPINFO()
-              si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-              Cmd = resamplingCommand  + cmdPars
-              print("Executing ... "+Cmd)
-              cRs = subprocess.call(Cmd , shell = (sys.platform == currentOS) , startupinfo=si )
-           else:
-              print(currentOS)
-              print("Executing ... "+Cmd)
-              cRs = subprocess.call(Cmd , shell = (sys.platform == currentOS) , startupinfo=si )
-  
-           #inputCropPath = inputCropIsoPath
-           print(" Cropping and resampling are done !!! ")
+            lower[i] = min(max(int(point[i]) - size, 0), dimensions[i])
+            upper[i] = max(min(int(point[i]) + size, dimensions[i]), lower[i])
+        return lower, upper
+
+  # Copy only the ROI voxels of a volume node to a SimpleITK image.
+  # The geometry is converted from Slicer RAS to ITK LPS as sitkUtils does.
+  def cropVolumeROI(self, inputVolume, point, croppingLength, volumeArray=None):
+        lower, upper = self.getCroppingBounds(inputVolume, point, croppingLength)
+        print("Cropping with " + str(lower) + " and " + str(upper) + ".")
+        # arrayFromVolume returns a view, slicing it does not copy the whole volume
+        if volumeArray is None:
+           volumeArray = slicer.util.arrayFromVolume(inputVolume)
+        roiArray    = volumeArray[lower[2]:upper[2], lower[1]:upper[1], lower[0]:upper[0]]
+        croppedImage = sitk.GetImageFromArray(np.ascontiguousarray(roiArray))
 
-        #inputCropPath    = inputCropPath.strip("'")
-        print(" Cropped image is saved in : [%s]" % inputCropPath)
-        print(" Cropping is done !!! ")
-        # so we can remove these files later
-        return inputCropPath
+        ijk2rasM = vtk.vtkMatrix4x4()
+        inputVolume.GetIJKToRASMatrix(ijk2rasM)
+        ijk2ras = slicer.util.arrayFromVTKMatrix(ijk2rasM)
+        spacing = np.array(inputVolume.GetSpacing())
+        ras2lps = np.diag([-1.0,-1.0,1.0])
+        direction = ras2lps.dot(ijk2ras[0:3,0:3] / spacing)
+        origin    = ras2lps.dot(ijk2ras[0:3,0:3].dot(np.array(lower, dtype=float)) + ijk2ras[0:3,3])
+        croppedImage.SetSpacing(spacing.tolist())
+        croppedImage.SetOrigin(origin.tolist())
+        croppedImage.SetDirection(direction.flatten().tolist())
+        return croppedImage
+
+  # linear resampling of a SimpleITK image to a new spacing, the physical extent is kept
+  def resampleImage(self, img, samplingLength, interpolator=sitk.sitkLinear):
+        inSpacing = img.GetSpacing()
+        inSize    = img.GetSize()
+        outSize   = [max(int(round(inSize[i]*inSpacing[i]/samplingLength[i])),1) for i in range(3)]
+        resampler = sitk.ResampleImageFilter()
+        resampler.SetOutputSpacing([float(s) for s in samplingLength])
+        resampler.SetSize(outSize)
+        resampler.SetOutputOrigin(img.GetOrigin())
+        resampler.SetOutputDirection(img.GetDirection())
+        resampler.SetOutputPixelType(img.GetPixelID())
+        resampler.SetDefaultPixelValue(0)
+        resampler.SetInterpolator(interpolator)
+        return resampler.Execute(img)
+
+  # set vtVars['RSxyz'] and vtVars['hrChk'] of the cropping from vtVars['resamplingMode']:
+  #  fixed   : RSxyz and hrChk are used as they are
+  #  preview : 0.25 mm, 8 times fewer voxels than 0.125 mm
+  #  adaptive: the finest axis spacing of the coarsest input, no input is upsampled beyond
+  #            its own resolution, but not finer than the finest spacing of the reference
+  #            images e.g. the atlases, they have no details below it. Inputs that already
+  #            have this isotropic spacing are not resampled. Without reference images
+  #            RSxyz is used.
+  #  inputVolumes: volume nodes, referencePaths: image files, only their header is read
+  def setResamplingSpacing(self, inputVolumes, referencePaths=[]):
+      mode = self.vtVars.get('resamplingMode', "fixed")
+      if mode == "adaptive" and len(referencePaths) == 0:
+         print("WARNING: adaptive resampling needs reference images, RSxyz is used")
+      elif mode == "preview":
+         self.vtVars['RSxyz'] = self.v2t([0.25, 0.25, 0.25])
+         self.vtVars['hrChk'] = "True"
+      elif mode == "adaptive":
+         inputSpacings = [np.array(inputVolume.GetSpacing()) for inputVolume in inputVolumes]
+         spacing = max(inputSpacing.min() for inputSpacing in inputSpacings)
+         reader = sitk.ImageFileReader()
+         for referencePath in referencePaths:
+             reader.SetFileName(referencePath)
+             reader.ReadImageInformation()
+             spacing = max(spacing, min(reader.GetSpacing()))
+         spacing = round(float(spacing), 4)
+         self.vtVars['RSxyz'] = self.v2t([spacing, spacing, spacing])
+         self.vtVars['hrChk'] = str(not all(np.allclose(inputSpacing, spacing, rtol=0.01) for inputSpacing in inputSpacings))
+      elif not mode == "fixed":
+         print("WARNING: unknown resampling mode " + mode + ", RSxyz is used")
+      print("resampling            = ", self.vtVars['RSxyz'] if self.s2b(self.vtVars['hrChk']) else "none")
+      return self.vtVars['RSxyz']
+
+  # write the cropped image only when a file is needed e.g. by elastix binaries
+  @vsProfiled("save cropped image")
+  def writeCroppedImage(self, img, imgPath):
+        print("cropped:     "+imgPath)
+        sitk.WriteImage(img, imgPath)
+        return imgPath
+
+  #--------------------------------------------------------------------------------------------
+  #                       Template localization
+  #--------------------------------------------------------------------------------------------
+  # Find an item without a fiducial point. The volume is downsampled to at most vtVars['downSz']
+  # voxels along each axis but not finer than minSpacing mm, then the normalized cross-correlation
+  # with each template is computed with FFT.
+  #  templates: dictionary of SimpleITK images, e.g. one for each side
+  #  output: candidates with the best score first, each a dictionary with ijk, ras, score and the
+  #          template name, the candidates are at least minDistance mm apart
+  @vsProfiled("localization")
+  def locateTemplates(self, inputVolume, templates, minSpacing=0.5, maxCandidates=3, minDistance=10.0):
+        img = sitkUtils.PullVolumeFromSlicer(inputVolume)
+        spacing = np.array(img.GetSpacing())
+        locSpacing = max(np.max(spacing * np.array(img.GetSize())) / float(self.vtVars['downSz']), minSpacing)
+        shrink = [max(1, int(round(locSpacing / s))) for s in spacing]
+        smallImg = sitk.Cast(sitk.BinShrink(img, shrink), sitk.sitkFloat32)
+        print("localization spacing: " + str(smallImg.GetSpacing()) + "   size: " + str(smallImg.GetSize()))
+
+        # the best positions of each template
+        peaks = []
+        for name in templates:
+            templateImg = self.resampleTemplate(templates[name], smallImg)
+            # only positions where the template is inside the volume are valid
+            ncc = sitk.FFTNormalizedCorrelation(smallImg, templateImg, 0, 0.95)
+            nccArray = sitk.GetArrayViewFromImage(ncc).ravel()
+            n = min(len(nccArray), 1000 * maxCandidates)
+            idx = np.argpartition(nccArray, -n)[-n:]
+            # output index of the template corner to the template center in the volume
+            outIdx = np.column_stack(np.unravel_index(idx, ncc.GetSize()[::-1])[::-1])
+            tSize  = np.array(templateImg.GetSize())
+            centerIdx = outIdx - (tSize - 1) + tSize // 2
+            peaks += [[float(nccArray[i]), name, c] for i, c in zip(idx, centerIdx)]
+        peaks.sort(key=lambda p: -p[0])
+
+        # LPS to RAS and the IJK of the input volume
+        direction = np.array(smallImg.GetDirection()).reshape(3,3)
+        lps = np.array([-1.0,-1.0,1.0])
+        candidates = []
+        for score, name, centerIdx in peaks:
+            ras = (np.array(smallImg.GetOrigin()) + direction.dot(np.array(smallImg.GetSpacing()) * centerIdx)) * lps
+            if any(np.linalg.norm(ras - c['ras']) < minDistance for c in candidates):
+               continue
+            candidates.append({'ijk': self.ptsRAS2IJK([ras], inputVolume)[0].astype(np.int64), 'ras': ras, 'score': score, 'template': name})
+            print("candidate " + name + "  score: %.3f" % score + "  IJK: " + str(candidates[-1]['ijk']))
+            if len(candidates) == maxCandidates:
+               break
+        return candidates
+
+  # template with the spacing and direction of img, the template center is kept
+  def resampleTemplate(self, template, img):
+        tSize     = np.array(template.GetSize())
+        tCenter   = np.array(template.TransformContinuousIndexToPhysicalPoint(((tSize - 1) / 2.0).tolist()))
+        spacing   = np.array(img.GetSpacing())
+        direction = np.array(img.GetDirection()).reshape(3,3)
+        size      = np.maximum(np.round(tSize * np.array(template.GetSpacing()) / spacing).astype(int), 1)
+        # smoothing before downsampling
+        smoothedImg = sitk.SmoothingRecursiveGaussian(sitk.Cast(template, sitk.sitkFloat32), (spacing / 2.0).tolist())
+        resampler = sitk.ResampleImageFilter()
+        resampler.SetOutputSpacing(spacing.tolist())
+        resampler.SetSize([int(s) for s in size])
+        resampler.SetOutputOrigin((tCenter - direction.dot(spacing * (size - 1) / 2.0)).tolist())
+        resampler.SetOutputDirection(img.GetDirection())
+        resampler.SetInterpolator(sitk.sitkLinear)
+        return resampler.Execute(smoothedImg)
 
   #--------------------------------------------------------------------------------------------
   #                        run elastix
   #--------------------------------------------------------------------------------------------
+  # parameters can be a single parameter file or a list of parameter files
+  @vsProfiled("elastix")
   def runElastix(self, elastixBinPath, fixed, moving, output, parameters, verbose, line):
       print ("************  Compute the Transform **********************")
       currentOS = sys.platform
       print("currentOS: ",currentOS)
-      Cmd = elastixBinPath + " -f " +fixed+" -m "+ moving +" -out "+ output +" -p "+ parameters
+      if not isinstance(parameters, (list, tuple)):
+         parameters = [parameters]
+      Cmd = elastixBinPath + " -f " +fixed+" -m "+ moving +" -out "+ output + "".join([" -p "+ p for p in parameters]) + self.getElastixThreadsArg()
+      # used to report the progress of the iterations
+      self.expectedIterations = self.getExpectedIterations(parameters)
 
       errStr="No error!"
       if currentOS in ["win32","msys","cygwin"]:
          print(" elastix is running in Windows :( !!!")
-         Cmd = f'"{elastixBinPath}" -f "{fixed}" -m "{moving}" -out "{output}" -p "{parameters}"'
-
+         Cmd = f'"{elastixBinPath}" -f "{fixed}" -m "{moving}" -out "{output}"' + "".join([f' -p "{p}"' for p in parameters]) + self.getElastixThreadsArg()
          print(Cmd)
-         Cmd = f'"{elastixBinPath}" -f "{fixed}" -m "{moving}" -out "{output}" -p "{parameters}"'
          si = subprocess.STARTUPINFO()
          si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-         process = subprocess.Popen(Cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, startupinfo=si)
-         stdout, stderr = process.communicate()
-         cTI = process.returncode
-        #  print(f"STDOUT: {stdout.decode()}")
-        #  print(f"STDERR: {stderr.decode()}")
-      
+         cTI = self.runCommand(Cmd, shell=True, startupinfo=si)
       elif currentOS in ["linux","linux2"]:
           print(" elastix is running in Linux :) !!!")
           CmdList = Cmd.split()
           print(CmdList)
-          cTI=  subprocess.Popen(CmdList, env=self.elastixEnv,  stdout=subprocess.PIPE, universal_newlines=True)
-          cTI.wait()
-          out, err = cTI.communicate()
-          cTI=int(not err==None)
+          cTI = self.runCommand(CmdList, env=self.elastixEnv)
       elif currentOS in ["darwin","os2","os2emx"]:
           print(" elastix is running in Mac :( !!!")
           CmdList = Cmd.split()
           print(CmdList)
-          cTI=  subprocess.Popen(CmdList, env=self.elastixEnv,  stdout=subprocess.PIPE, universal_newlines=True)
-          cTI.wait()
-          out, err = cTI.communicate()
-          cTI=int(not err==None)
+          cTI = self.runCommand(CmdList, env=self.elastixEnv)
       else:
             print(" elastix is running in Unknown system :( !!!")
             cTI=1
-            errStr="elastix error at line"+ line +", check the log files"
-  
+      # the exit code, the log and the written files give the error
+      cTI, errStr = self.checkElastixRun(output, parameters, cTI, line)
+
       print(cTI)
-      #time.sleep(5)
       self.chkElxER(cTI,errStr) # Check if errors happen during elastix execution
 
       return cTI
 
+  # limits the elastix threads, used when several runs share the cores
+  def getElastixThreadsArg(self):
+      threads = self.vtVars.get('elastixThreads', "") if hasattr(self, 'vtVars') else ""
+      return (" -threads " + str(threads)) if not str(threads) == "" else ""
+
+  #--------------------------------------------------------------------------------------------
+  #                        Elastix log
+  #--------------------------------------------------------------------------------------------
+  # Convergence of an elastix run from its elastix.log, the metric curves are taken from the
+  # IterationInfo.<p>.R<r>.txt files if elastix wrote them
+  #  output: {'parameterFiles': [{'finalMetric', 'resolutions': [{'resolution', 'iterations', 'metric',
+  #          'finalMetric', 'seconds', 'stoppingCondition'}]}], 'seconds', 'errors'}
+  def readElastixLog(self, outputPath, logName="elastix.log"):
+      stats = {'parameterFiles': [], 'seconds': None, 'errors': []}
+      logPath = os.path.join(outputPath, logName)
+      lines = []
+      if os.path.isfile(logPath):
+         with open(logPath, errors='replace') as f:
+              lines = f.read().splitlines()
+      parsStats = None ; resStats = None ; inTable = False
+      for line in lines:
+          if inTable:
+             tokens = line.split()
+             try:
+                itr, value = int(tokens[0]), float(tokens[1])
+             except (ValueError, IndexError):
+                inTable = False
+             else:
+                resStats['metric'].append(value)
+                resStats['iterations'] = itr + 1
+                continue
+          m = re.match(r'^Running elastix with parameter file (\d+)', line)
+          if m:
+             parsStats = {'finalMetric': None, 'resolutions': []}
+             stats['parameterFiles'].append(parsStats)
+             resStats = None
+             continue
+          m = re.match(r'^Resolution:\s*(\d+)', line)
+          if m and parsStats is not None:
+             resStats = {'resolution': int(m.group(1)), 'iterations': 0, 'metric': [], 'finalMetric': None, 'seconds': None, 'stoppingCondition': ""}
+             parsStats['resolutions'].append(resStats)
+             continue
+          if line.startswith("1:ItNr"):
+             inTable = resStats is not None
+             continue
+          m = re.search(r'Time spent in resolution \d+ \(ITK initiali[sz]ation and iterating\):\s*([0-9.]+)', line)
+          if m and resStats is not None:
+             resStats['seconds'] = float(m.group(1))
+          m = re.match(r'^Stopping condition:\s*(.*)', line)
+          if m and resStats is not None:
+             resStats['stoppingCondition'] = m.group(1).strip()
+          m = re.search(r'Final metric value\s*=\s*(\S+)', line)
+          if m and resStats is not None:
+             resStats['finalMetric'] = parsStats['finalMetric'] = float(m.group(1))
+          m = re.search(r'Total time elapsed:\s*([0-9.]+)', line)
+          if m:
+             stats['seconds'] = float(m.group(1))
+          if re.search(r'ERROR|Errors occurred|ExceptionObject', line):
+             stats['errors'].append(line.strip())
+
+      for infoPath in sorted(glob.glob(os.path.join(outputPath, "IterationInfo.*.R*.txt"))):
+          m = re.match(r'^IterationInfo\.(\d+)\.R(\d+)\.txt$', os.path.basename(infoPath))
+          if m is None:
+             continue
+          p, r = int(m.group(1)), int(m.group(2))
+          while len(stats['parameterFiles']) <= p:
+                stats['parameterFiles'].append({'finalMetric': None, 'resolutions': []})
+          resolutions = stats['parameterFiles'][p]['resolutions']
+          resStats = ([s for s in resolutions if s['resolution'] == r] or [None])[0]
+          if resStats is None:
+             resStats = {'resolution': r, 'iterations': 0, 'metric': [], 'finalMetric': None, 'seconds': None, 'stoppingCondition': ""}
+             resolutions.append(resStats)
+             resolutions.sort(key=lambda s: s['resolution'])
+          with open(infoPath) as f:
+               rows = [row.split() for row in f.read().splitlines()[1:]]
+          resStats['metric'] = [float(row[1]) for row in rows if len(row) > 1]
+          resStats['iterations'] = len(resStats['metric'])
+      return stats
+
+  # Check a finished elastix run from its output folder, the log is parsed before the
+  # workspace is removed. A run that did not write its last transform parameters file
+  # failed even if the exit code is 0.
+  #  output: the error code and the error text
+  def checkElastixRun(self, outputPath, parameterPaths, cTI, line, checkFiles=True):
+      stats = self.readElastixLog(outputPath)
+      stats['line']       = line
+      stats['parameters'] = [os.path.basename(p) for p in parameterPaths]
+      lastTpPath = os.path.join(outputPath, "TransformParameters." + str(len(parameterPaths)-1) + ".txt")
+      if cTI == 0 and checkFiles and not os.path.isfile(lastTpPath):
+         stats['errors'].append("missing " + os.path.basename(lastTpPath))
+         cTI = 1
+      stats['exitCode'] = cTI
+      errStr = "No error!"
+      if not cTI == 0:
+         errStr = "elastix error at line" + line + ", check the log files" + ((": " + stats['errors'][-1]) if stats['errors'] else "")
+      elif len(stats['parameterFiles']) > 0 and self.vtVars.get('iterationTuning', "off") in ["record", "auto"]:
+         VisSimElastixHistory(self).add(parameterPaths, stats)
+      for i, parsStats in enumerate(stats['parameterFiles']):
+          for resStats in parsStats['resolutions']:
+              print("      elastix " + str(i) + " R" + str(resStats['resolution']) + ": " + str(resStats['iterations']) + " iterations, final metric "
+                    + str(resStats['finalMetric']) + ", " + str(resStats['seconds']) + " s, " + resStats['stoppingCondition'])
+      self.recordElastixRun(stats)
+      return cTI, errStr
+
+  # keep the convergence of the elastix runs for the output, job logics keep it in their parent
+  def recordElastixRun(self, stats):
+      if self.parentLogic is not None:
+         return self.parentLogic.recordElastixRun(stats)
+      if not hasattr(self, 'elastixRuns'):
+         self.elastixRuns = []
+      self.elastixRuns.append(stats)
+
+  # the convergence of the elastix runs as json in the output folder
+  def writeElastixRuns(self):
+      if len(getattr(self, 'elastixRuns', [])) == 0:
+         return None
+      runsPath = os.path.join(self.getWorkPath(), "elastix_" + self.vtVars.get('runID', str(os.getpid())) + ".json")
+      with open(runsPath, 'w') as f:
+           json.dump({'runs': self.elastixRuns}, f, indent=1)
+      return self.publishFile(runsPath)
+
   #--------------------------------------------------------------------------------------------
   #                        run transformix
   #--------------------------------------------------------------------------------------------
-  def runTransformix(self,transformixBinPath, img, output, parameters, verbose, line):
+  # img: image to transform or None, deformation: "all" for the deformation field,
+  # a points file to transform points or None
+  @vsProfiled("transformix")
+  def runTransformix(self,transformixBinPath, img, output, parameters, verbose, line, deformation="all"):
       print ("************  Apply transform **********************")
       currentOS = sys.platform
-      Cmd = transformixBinPath + " -tp " + parameters + " -in " + img +" -out " + output + " -def all "
+      inArg  = (" -in " + img) if img else ""
+      defArg = (" -def " + deformation) if deformation else ""
+      Cmd = transformixBinPath + " -tp " + parameters + inArg +" -out " + output + defArg + " " + self.getElastixThreadsArg()
+      self.expectedIterations = 0
 
       #if subprocess.mswindows:
       errStr="No error!"
       if currentOS in ["win32","msys","cygwin"]:
          print(" transformix is running in Windows :( !!!")
-         Cmd = f'"{transformixBinPath}" -tp "{parameters}" -in "{img}" -out "{output}" -def all '
+         inArg  = f' -in "{img}"' if img else ""
+         defArg = (' -def all' if deformation == "all" else f' -def "{deformation}"') if deformation else ""
+         Cmd = f'"{transformixBinPath}" -tp "{parameters}"{inArg} -out "{output}"{defArg} ' + self.getElastixThreadsArg()
          print(Cmd)
          si = subprocess.STARTUPINFO()
          si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-         cTS = subprocess.call(Cmd , shell = (sys.platform == currentOS) , startupinfo=si )
+         cTS = self.runCommand(Cmd, shell=True, startupinfo=si)
       elif currentOS in ["linux","linux2"]:
           print(" transformix is running in Linux :) !!!")
           CmdList = Cmd.split()
           print(CmdList)
-          cTS=  subprocess.Popen(CmdList, env=self.elastixEnv,  stdout=subprocess.PIPE, universal_newlines=True)
-          cTS.wait()
-          out, err = cTS.communicate()
-          cTS=int(not err==None)
+          cTS = self.runCommand(CmdList, env=self.elastixEnv)
       elif currentOS in ["darwin","os2","os2emx"]:
           print(" transformix is running in Mac :( !!!")
           CmdList = Cmd.split()
           print(CmdList)
-          cTS=  subprocess.Popen(CmdList, env=self.elastixEnv,  stdout=subprocess.PIPE, universal_newlines=True)
-          cTS.wait()
-          out, err = cTS.communicate()
-          cTS=int(not err==None)
+          cTS = self.runCommand(CmdList, env=self.elastixEnv)
       else:
             print(" elastix is running in Unknown system :( !!!")
             cTS=1
+      if not cTS == 0:
             errStr="transformix error at line"+ line +", check the log files"
   
       print(cTS)
       self.chkElxER(cTS,errStr) # Check if errors happen during elastix execution
       return cTS
 
+  #--------------------------------------------------------------------------------------------
+  #                        Elastix parameters
+  #--------------------------------------------------------------------------------------------
+  # Named presets of the registration parameters. A value is written as given, a value that
+  # starts with * scales the numbers of the base file e.g. "*0.25" of
+  # (MaximumNumberOfIterations 500 250) is (MaximumNumberOfIterations 125 62)
+  elastixPresets = {"fast"    : collections.OrderedDict([("MaximumNumberOfIterations", "*0.25"), ("NumberOfSpatialSamples", "*0.5"),
+                                                         ("NumberOfHistogramBins", "32")]),
+                    "default" : collections.OrderedDict(),
+                    "accurate": collections.OrderedDict([("MaximumNumberOfIterations", "*2"), ("NumberOfSpatialSamples", "*2")])}
+
+  # parameter file as an ordered dictionary of parameter name and value text, comments are dropped
+  def readParameterFile(self, parsPath):
+      parameters = collections.OrderedDict()
+      with open(parsPath) as f:
+           for line in f:
+               m = re.match(r'^\s*\((\w+)\s+(.*?)\)\s*(//.*)?$', line)
+               if m:
+                  parameters[m.group(1)] = m.group(2).strip()
+      return parameters
+
+  def writeParameterFile(self, parameters, parsPath):
+      with open(parsPath, 'w') as f:
+           for key in parameters:
+               f.write("(" + key + " " + parameters[key] + ")\n")
+      return parsPath
+
+  # overrides as text "key=value;key=value" e.g. "MaximumNumberOfIterations=*0.5;NumberOfResolutions=3",
+  # or already a dictionary
+  def parseParameterOverrides(self, overrides):
+      if isinstance(overrides, dict):
+         return collections.OrderedDict(overrides)
+      parsed = collections.OrderedDict()
+      for item in (overrides or "").split(";"):
+          if "=" in item:
+             key, value = item.split("=", 1)
+             parsed[key.strip()] = value.strip()
+      return parsed
+
+  # change the parameters, returns what was changed as [key, base value, new value]
+  def applyParameterChanges(self, parameters, changes):
+      applied = []
+      for key in changes:
+          value = changes[key]
+          baseValue = parameters.get(key)
+          if value.startswith("*"):
+             if baseValue is None:
+                print("WARNING: " + key + " is not in the parameter file, " + value + " is ignored")
+                continue
+             factor = float(value[1:])
+             try:
+                value = " ".join(str(max(1, int(float(v)*factor))) if re.match(r'^[0-9]+$', v) else repr(float(v)*factor)
+                                 for v in baseValue.split())
+             except ValueError:
+                print("WARNING: " + key + " " + baseValue + " can not be scaled")
+                continue
+          if not value == baseValue:
+             parameters[key] = value
+             applied.append([key, baseValue, value])
+      return applied
+
+  # Copy the parameter files of the run to the workspace with vtVars['elastixPreset'], the
+  # overrides of vtVars['elastixParameters'] and with vtVars['iterationTuning'] = "auto" the
+  # iterations of VisSimElastixHistory applied, the vtVars of parsKeys then point to the copies.
+  # The changes are written to recordName in the output folder.
+  #  parsKeys: vtVars keys of the parameter files e.g. ['parsPath', 'parsNRPath']
+  def createRunParameterFiles(self, parsKeys, recordName=None):
+      preset = self.vtVars.get('elastixPreset', "default")
+      if preset not in self.elastixPresets:
+         print("WARNING: unknown elastix preset " + preset + ", default is used")
+         preset = "default"
+      overrides = self.parseParameterOverrides(self.vtVars.get('elastixParameters', ""))
+      record = {'preset': preset, 'overrides': overrides, 'files': []}
+      for parsKey in parsKeys:
+          basePath = self.vtVars.get(parsKey, "")
+          if not os.path.isfile(basePath):
+             print("WARNING: parameter file is not found: " + basePath)
+             continue
+          parameters = self.readParameterFile(basePath)
+          changes  = [c + ["preset"]   for c in self.applyParameterChanges(parameters, self.elastixPresets[preset])]
+          changes += [c + ["override"] for c in self.applyParameterChanges(parameters, overrides)]
+          if self.vtVars.get('iterationTuning', "off") == "auto":
+             itrs = VisSimElastixHistory(self).getIterations(parameters)
+             if itrs is not None:
+                changes += [c + ["tuning"] for c in self.applyParameterChanges(parameters, {"MaximumNumberOfIterations": itrs})]
+          self.vtVars[parsKey] = self.writeParameterFile(parameters, os.path.join(self.getWorkPath(), "run_" + os.path.basename(basePath)))
+          for key, baseValue, value, source in changes:
+              print("      " + os.path.basename(basePath) + ": (" + key + " " + value + ")  was " + str(baseValue) + ", " + source)
+          record['files'].append({'base': basePath, 'changes': [dict(zip(['parameter', 'base', 'value', 'source'], c)) for c in changes]})
+      if recordName is not None:
+         recordPath = os.path.join(self.getWorkPath(), recordName)
+         with open(recordPath, 'w') as f:
+              json.dump(record, f, indent=1)
+         self.publishFile(recordPath)
+      return record
+
+  #--------------------------------------------------------------------------------------------
+  #                        Transform parameters and points
+  #--------------------------------------------------------------------------------------------
+  # copy a transform parameters file with some parameters changed, values are written as
+  # given e.g. {"FinalBSplineInterpolationOrder": "0", "ResultImagePixelType": '"unsigned char"'}
+  def writeTransformParameters(self, tpPath, newTpPath, parameters):
+      with open(tpPath) as f:
+           txt = f.read()
+      for key in parameters:
+          line = "(" + key + " " + parameters[key] + ")"
+          pattern = re.compile(r"^\(" + key + r"\s.*\)\s*$", re.MULTILINE)
+          if pattern.search(txt):
+             txt = pattern.sub(lambda m: line, txt)
+          else:
+             txt = txt.rstrip("\n") + "\n" + line + "\n"
+      with open(newTpPath, 'w') as f:
+           f.write(txt)
+      return newTpPath
+
+  # Nx3 physical points (LPS) in the transformix input format
+  def writePointsFile(self, pts, ptsPath):
+      with open(ptsPath, 'w') as f:
+           f.write("point\n" + str(len(pts)) + "\n")
+           np.savetxt(f, pts, fmt="%.6f")
+      return ptsPath
+
+  # OutputPoint of each line of transformix outputpoints.txt
+  def readOutputPoints(self, outputPointsPath):
+      with open(outputPointsPath) as f:
+           pts = re.findall(r"OutputPoint\s*=\s*\[([^\]]*)\]", f.read())
+      return np.array([[float(v) for v in p.split()] for p in pts]).reshape(-1,3)
+
+  # Transformix maps points from the fixed to the moving image, atlas points are in the
+  # moving image so they are moved with the inverse transform. There are two transformix
+  # calls: the first moves the points with finite difference probes for one Newton step, the
+  # second moves a small patch of patchSize^3 grid points around each estimate. The Newton
+  # iterations then run on the sampled displacement of each patch (trilinear interpolation)
+  # without transformix. Points that leave their patch or do not converge get Newton steps
+  # with transformix, at most maxFallbackCalls calls. If they still do not converge the
+  # result is None. The tolerance is checked on the sampled displacement, with the 0.1 mm patch
+  # spacing the interpolation error is below the tolerance. The cost is kept in self.inverseTransformStats.
+  @vsProfiled("inverse transform points")
+  def inverseTransformPoints(self, engine, ptsRAS, transformParameters, outputPath, maxIterations=20, tolerance=1e-3, h=0.05,
+                             gridSpacing=0.1, patchSize=4, maxFallbackCalls=3):
+      lps = np.array([-1.0,-1.0,1.0])
+      targetPts = np.asarray(ptsRAS, dtype=float).reshape(-1,3) * lps
+      n = len(targetPts)
+      if n == 0:
+         return targetPts
+      # one Newton step of the points to their targets, with finite difference probes,
+      # returns the new points and the error of the given points
+      def newtonStep(pts, targets, transformFunc):
+          m = len(pts)
+          movedPts = transformFunc(np.vstack([pts] + [pts + h*np.eye(3)[d] for d in range(3)]))
+          if movedPts is None or not len(movedPts) == 4*m:
+             return None, None
+          err = movedPts[0:m] - targets
+          J = np.stack([(movedPts[m*(d+1):m*(d+2)] - movedPts[0:m]) / h for d in range(3)], axis=2)
+          try:
+             return pts - np.linalg.solve(J, err[:,:,None])[:,:,0], np.linalg.norm(err, axis=1)
+          except np.linalg.LinAlgError:
+             # a folded transform, the points stay and do not converge
+             return pts.copy(), np.linalg.norm(err, axis=1)
+      transformixFunc = lambda P: engine.transformPoints(P, transformParameters, outputPath)
+
+      self.checkCancel()
+      pts, err = newtonStep(targetPts, targetPts, transformixFunc)
+      if pts is None:
+         print("Error: can not transform the points")
+         return None
+
+      # displacement of a patch around each estimate
+      self.checkCancel()
+      offsets = gridSpacing * np.stack(np.meshgrid(*[np.arange(patchSize)]*3, indexing='ij'), axis=-1).reshape(-1,3)
+      origins = pts - gridSpacing*(patchSize-1)/2.0
+      gridPts = (origins[:,None,:] + offsets[None,:,:]).reshape(-1,3)
+      movedGridPts = transformixFunc(gridPts)
+      if movedGridPts is None or not len(movedGridPts) == len(gridPts):
+         print("Error: can not transform the grid points")
+         return None
+      field = (movedGridPts - gridPts).reshape(n, patchSize, patchSize, patchSize, 3)
+      corners = np.stack(np.meshgrid([0,1], [0,1], [0,1], indexing='ij'), axis=-1).reshape(-1,3)
+      # the points P of the patches idx (repeated for the probes) moved with the trilinear
+      # displacement of their patch, outside the patch it is extrapolated
+      def transformPatches(P, idx):
+          patchIdx = np.tile(idx, len(P) // len(idx))
+          u = (P - origins[patchIdx]) / gridSpacing
+          i0 = np.clip(np.floor(u).astype(int), 0, patchSize-2)
+          f = u - i0
+          disp = np.zeros_like(P)
+          for c in corners:
+              w = np.prod(np.where(c == 1, f, 1-f), axis=1)
+              disp += w[:,None] * field[patchIdx, i0[:,0]+c[0], i0[:,1]+c[1], i0[:,2]+c[2]]
+          return P + disp
+
+      converged = np.zeros(n, dtype=bool)
+      iterations = 0
+      for i in range(maxIterations):
+          active = np.nonzero(~converged)[0]
+          if len(active) == 0:
+             break
+          newPts, err = newtonStep(pts[active], targetPts[active], lambda P: transformPatches(P, active))
+          converged[active[err < tolerance]] = True
+          pts[active[err >= tolerance]] = newPts[err >= tolerance]
+          iterations = i+1
+      # the patch displacement is only valid inside the patch
+      u = (pts - origins) / gridSpacing
+      converged &= np.all((u >= 0) & (u <= patchSize-1), axis=1)
+
+      fallbackPoints = int(np.count_nonzero(~converged))
+      fallbackCalls = 0
+      while not np.all(converged) and fallbackCalls < maxFallbackCalls:
+            self.checkCancel()
+            active = np.nonzero(~converged)[0]
+            newPts, err = newtonStep(pts[active], targetPts[active], transformixFunc)
+            fallbackCalls += 1
+            if newPts is None:
+               print("Error: can not transform the points")
+               return None
+            converged[active[err < tolerance]] = True
+            pts[active[err >= tolerance]] = newPts[err >= tolerance]
+      self.inverseTransformStats = {'points': n, 'gridPoints': len(gridPts), 'transformixCalls': 2 + fallbackCalls, 'iterations': iterations,
+                                    'fallbackPoints': fallbackPoints, 'converged': bool(np.all(converged))}
+      print("inverse transform: " + str(iterations) + " iterations, " + str(len(gridPts)) + " grid points, " + str(2 + fallbackCalls) + " transformix calls")
+      if not np.all(converged):
+         print("Error: the inverse transform of " + str(np.count_nonzero(~converged)) + " points did not converge")
+         return None
+      return pts * lps
+
+  # the atlas segmentation is moved to the fixed image with transformix, nearest neighbour
+  # resampling of its labelmap, no deformation field is needed
+  def warpAtlasSegmentation(self, engine, segPath, nodeName, transformParameters, outputPath, line=""):
+      labelImg, segmentIDs = VisSimAtlasCache.instance().getLabelImage(segPath)
+      [cTS, resLabelImg, resDef] = engine.transform(labelImg, transformParameters, outputPath, line, deformationField=False, labelImage=True)
+      if not cTS == 0:
+         return cTS, None
+      if isinstance(resLabelImg, str):
+         resLabelImg = sitk.ReadImage(resLabelImg)
+      segNode = self.loadAtlasSegmentation(segPath, nodeName)
+      self.updateSegmentsFromLabelImage(segNode, resLabelImg, segmentIDs)
+      return cTS, segNode
+
+  # label i+1 of the label image becomes the segment segmentIDs[i], on the label image grid
+  def updateSegmentsFromLabelImage(self, segNode, labelImg, segmentIDs):
+      labelNode = sitkUtils.PushVolumeToSlicer(labelImg, None, segNode.GetName() + "_lbl", "vtkMRMLLabelMapVolumeNode")
+      try:
+         labelArray = slicer.util.arrayFromVolume(labelNode)
+         segNode.SetReferenceImageGeometryParameterFromVolumeNode(labelNode)
+         for i in range(len(segmentIDs)):
+             slicer.util.updateSegmentBinaryLabelmapFromArray((labelArray == i+1).astype(np.uint8), segNode, segmentIDs[i], labelNode)
+      finally:
+         slicer.mrmlScene.RemoveNode(labelNode)
+
+  # label images of several atlases on the same grid fused to one label image
+  #   vote  : the most frequent label of each voxel, ties go to the lower label
+  #   staple: SimpleITK multi-label STAPLE, undecided voxels are background
+  def fuseLabelImages(self, labelImgs, method="vote"):
+      if len(labelImgs) == 1:
+         return labelImgs[0]
+      if method == "staple":
+         staple = sitk.MultiLabelSTAPLEImageFilter()
+         staple.SetLabelForUndecidedPixels(0)
+         return sitk.Cast(staple.Execute([sitk.Cast(img, sitk.sitkUInt8) for img in labelImgs]), sitk.sitkUInt8)
+      labels = np.stack([sitk.GetArrayViewFromImage(img) for img in labelImgs])
+      votes = np.stack([np.count_nonzero(labels == l, axis=0) for l in range(int(labels.max())+1)])
+      fusedImg = sitk.GetImageFromArray(np.argmax(votes, axis=0).astype(np.uint8))
+      fusedImg.CopyInformation(labelImgs[0])
+      return fusedImg
+
+  # atlas landmarks moved with the inverse of the transform, see inverseTransformPoints
+  def loadInverseWarpedAtlasLandmarks(self, engine, fcsvPaths, nodeNames, transformParameters, outputPath):
+      landmarks = [VisSimAtlasCache.instance().getLandmarks(fcsvPath) for fcsvPath in fcsvPaths]
+      pts = self.inverseTransformPoints(engine, np.vstack([l[0] for l in landmarks]), transformParameters, outputPath)
+      if pts is None:
+         return None
+      splitIdx = np.cumsum([len(l[0]) for l in landmarks])[:-1]
+      return [self.createMarkupsNode(nodeName, nodePts, l[1]) for nodeName, nodePts, l in zip(nodeNames, np.split(pts, splitIdx), landmarks)]
+
+  #--------------------------------------------------------------------------------------------
+  #                        Background execution and progress
+  #--------------------------------------------------------------------------------------------
+  # Long steps (elastix, transformix, in-process registration) run outside the
+  # GUI thread while the Qt events are processed, so Slicer stays usable and the
+  # user can cancel. The scene is only changed from the GUI thread.
+  cancelRequested    = False
+  currentProcess     = None
+  parentLogic        = None # job logics are cancelled with their parent
+  progressCallback   = None # function(stage, percent)
+  expectedIterations = 0
+
+  # report the current stage, percent of the stage start and where the stage ends
+  def setProgress(self, stage, percent, nextPercent=None):
+      # a finished run can not be cancelled anymore
+      if percent < 100:
+         self.checkCancel()
+      self.progressStage = stage
+      self.progressRange = [percent, percent if nextPercent is None else nextPercent]
+      self.processedIterations = 0
+      print("      progress: " + stage + " " + str(percent) + "%")
+      if self.progressCallback is not None:
+         self.progressCallback(stage, percent)
+      self.processEvents()
+
+  def requestCancel(self):
+      print("      cancel is requested ...")
+      self.cancelRequested = True
+      if self.currentProcess is not None and self.currentProcess.poll() is None:
+         self.currentProcess.kill()
+
+  def isCancelRequested(self):
+      return self.cancelRequested or (self.parentLogic is not None and self.parentLogic.isCancelRequested())
+
+  def checkCancel(self):
+      if self.isCancelRequested():
+         raise VisSimCancelledError("cancelled by the user")
+
+  # only the GUI thread processes the events
+  def processEvents(self):
+      if slicer.app is not None and self.parentLogic is None:
+         slicer.app.processEvents()
+
+  # a logic with the same settings for a job in a worker thread, it has its own process
+  # and progress and does not touch the GUI, threads limits the elastix threads of the job
+  def createJobLogic(self, threads=None):
+      jobVsc = VisSimCommonLogic()
+      jobVsc.vtVars      = dict(self.vtVars)
+      jobVsc.elastixEnv  = self.elastixEnv
+      jobVsc.parentLogic = self
+      if threads is not None:
+         jobVsc.vtVars['elastixThreads'] = str(threads)
+      return jobVsc
+
+  # run a process and stream its output line by line,
+  # stdout and stderr are merged so the pipe can not fill up
+  def runCommand(self, Cmd, env=None, shell=False, startupinfo=None):
+      self.checkCancel()
+      process = subprocess.Popen(Cmd, env=env, shell=shell, startupinfo=startupinfo, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1)
+      self.currentProcess = process
+      outputLines = queue.Queue()
+      def readOutput():
+          for outLine in iter(process.stdout.readline, ''):
+              outputLines.put(outLine)
+          process.stdout.close()
+      reader = threading.Thread(target=readOutput)
+      reader.daemon = True
+      reader.start()
+      try:
+         while reader.is_alive() or not outputLines.empty():
+               while not outputLines.empty():
+                     self.onProcessOutput(outputLines.get_nowait().rstrip())
+               self.checkCancel()
+               self.processEvents()
+               reader.join(0.02)
+         self.waitForChild(process)
+      finally:
+         self.currentProcess = None
+         if process.poll() is None:
+            process.kill()
+            process.wait()
+      self.checkCancel()
+      return process.returncode
+
+  # Wait for a finished child and add its CPU time, peak RSS and I/O to the open spans.
+  # The child is not reaped until its /proc/<pid>/io is read, wait4 gives its own rusage.
+  def waitForChild(self, process):
+      if not (hasattr(os, "wait4") and hasattr(os, "waitid")):
+         return process.wait()
+      os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+      childUsage = readProcessIO(process.pid)
+      pid, status, rusage = os.wait4(process.pid, 0)
+      process.returncode = os.waitstatus_to_exitcode(status)
+      childUsage['cpu']    = rusage.ru_utime + rusage.ru_stime
+      childUsage['maxRSS'] = rusage.ru_maxrss * getRSSScale()
+      self.addChildUsage(childUsage)
+      return process.returncode
+
+  def addChildUsage(self, childUsage):
+      if self.parentLogic is not None:
+         return self.parentLogic.addChildUsage(childUsage)
+      if getattr(self, 'profiler', None) is None:
+         self.profiler = VisSimProfiler()
+      self.profiler.addChildUsage(childUsage)
+
+  # elastix prints one line per iteration starting with the iteration number
+  def onProcessOutput(self, outLine):
+      tokens = outLine.split()
+      if len(tokens) > 1 and tokens[0].isdigit() and self.expectedIterations > 0 and self.progressCallback is not None:
+         self.processedIterations = getattr(self, 'processedIterations', 0) + 1
+         [p0, p1] = getattr(self, 'progressRange', [0,0])
+         fraction = min(float(self.processedIterations)/self.expectedIterations, 1.0)
+         self.progressCallback(self.progressStage, int(p0 + (p1-p0)*fraction))
+
+  # sum of MaximumNumberOfIterations over all resolutions of all parameter files
+  def getExpectedIterations(self, parameters):
+      expectedIterations = 0
+      for parsPath in parameters:
+          try:
+             parsTxt = open(parsPath).read()
+          except IOError:
+             continue
+          itrs = re.search(r'^\s*\(MaximumNumberOfIterations\s+([0-9 ]+)\)', parsTxt, re.M)
+          resolutions = re.search(r'^\s*\(NumberOfResolutions\s+([0-9]+)\)', parsTxt, re.M)
+          if itrs:
+             itrs = [int(i) for i in itrs.group(1).split()]
+             n = int(resolutions.group(1)) if resolutions else 1
+             expectedIterations += sum(itrs) if len(itrs) > 1 else itrs[0]*n
+      return expectedIterations
+
+  # run a function in a worker thread, e.g. in-process registration, while Slicer stays responsive
+  # abortFunc is called if the user cancels
+  def runInThread(self, func, abortFunc=None):
+      return self.runInThreads([func], abortFunc)[0]
+
+  # run functions in worker threads at the same time, the results are in the same order,
+  # the first error is raised when all are finished
+  def runInThreads(self, funcs, abortFunc=None):
+      results = [{} for func in funcs]
+      def target(func, result):
+          try:
+             result['value'] = func()
+          except Exception as e:
+             result['error'] = e
+      workers = [threading.Thread(target=target, args=(func, result)) for func, result in zip(funcs, results)]
+      for worker in workers:
+          worker.daemon = True
+          worker.start()
+      aborted = False
+      while any(worker.is_alive() for worker in workers):
+            if self.isCancelRequested() and not aborted and abortFunc is not None:
+               abortFunc()
+               aborted = True
+            self.processEvents()
+            [worker for worker in workers if worker.is_alive()][0].join(0.02)
+      self.checkCancel()
+      for result in results:
+          if 'error' in result:
+             raise result['error']
+      return [result.get('value') for result in results]
+
+  # nodes added to the scene since nodeIDs were taken, used to clean up after a cancel
+  def getSceneNodeIDs(self):
+      return set([slicer.mrmlScene.GetNthNode(i).GetID() for i in range(slicer.mrmlScene.GetNumberOfNodes())])
+
+  # a temporary node of the current run, job logics add it to the run of their parent
+  def addRunNode(self, node):
+      if self.parentLogic is not None:
+         return self.parentLogic.addRunNode(node)
+      if hasattr(self, 'runNodeIDs'):
+         self.runNodeIDs.append(node.GetID())
+
+  def removeNewNodes(self, nodeIDs, namePrefix):
+      for nodeID in self.getSceneNodeIDs() - nodeIDs:
+          node = slicer.mrmlScene.GetNodeByID(nodeID)
+          if (node is not None) and (node.GetName() or "").startswith(namePrefix):
+             slicer.mrmlScene.RemoveNode(node)
+
   #--------------------------------------------------------------------------------------------
   #                       Check Elastix error
   #--------------------------------------------------------------------------------------------
-  # This method checks if errors happen during elastix execution
+  # This method checks if errors happen during elastix execution,
+  # the text of the last error is kept in self.lastError for the caller, job logics also keep it in their parent
   def chkElxER(self,c, s):
-        if c>0:
+        if not c==0:
            #qt.QMessageBox.critical(slicer.util.mainWindow(),'segmentation', s)
            print(s)
+           self.lastError = s
+           if self.parentLogic is not None:
+              self.parentLogic.lastError = s
            return False
         else:
             print("done !!!")
 
+  #--------------------------------------------------------------------------------------------
+  #                       Registration engine
+  #--------------------------------------------------------------------------------------------
+  # vtVars['elastixEngine']:
+  #   inprocess : SimpleITK (SimpleElastix) or ITKElastix, images stay in memory
+  #   subprocess: elastix and transformix binaries from SlicerElastix
+  #   auto      : inprocess if available, otherwise subprocess
+  def getElastixEngine(self):
+      engineName = self.vtVars.get('elastixEngine', "auto") if hasattr(self, 'vtVars') else "auto"
+      backend = VisSimElastixInProcessEngine.getBackend()
+      if engineName in ["auto", "inprocess"] and backend is not None:
+         engine = VisSimElastixInProcessEngine(self, backend)
+      else:
+         if engineName == "inprocess":
+            print("      in-process elastix is not available, using elastix binaries ...")
+         engine = VisSimElastixSubprocessEngine(self)
+      print("      registration engine: " + engine.name)
+      return engine
+
+  # load a deformation field as a transform node
+  # field is a file path (subprocess engine) or a SimpleITK vector image (in-process engine)
+  @vsProfiled("load transform")
+  def loadDeformationField(self, field, nodeName):
+      if isinstance(field, str):
+         transformNode = slicer.util.loadTransform(field)
+         transformNode.SetName(nodeName)
+      else:
+         transformNode = self.pushDeformationFieldToSlicer(field, nodeName)
+      return transformNode
+
+  # SimpleITK displacement field (LPS) to a grid transform node (RAS)
+  # as slicer.util.loadTransform does, the field is used as the transform from parent
+  def pushDeformationFieldToSlicer(self, field, nodeName):
+      ras2lps = np.diag([-1.0,-1.0,1.0])
+      fieldArray = sitk.GetArrayFromImage(field).astype(np.float64)
+      fieldArray[...,0:2] = -fieldArray[...,0:2]
+      displacementGrid = vtk.vtkImageData()
+      displacementGrid.SetDimensions(field.GetSize())
+      displacementGrid.SetSpacing(field.GetSpacing())
+      displacementGrid.SetOrigin(ras2lps.dot(np.array(field.GetOrigin())).tolist())
+      vtkArray = numpy_support.numpy_to_vtk(fieldArray.reshape(-1,3), deep=True, array_type=vtk.VTK_DOUBLE)
+      displacementGrid.GetPointData().SetScalars(vtkArray)
+
+      gridDirection = ras2lps.dot(np.array(field.GetDirection()).reshape(3,3))
+      gridDirectionM = vtk.vtkMatrix4x4()
+      for i in range(3):
+          for j in range(3):
+              gridDirectionM.SetElement(i, j, gridDirection[i,j])
+      gridTransform = slicer.vtkOrientedGridTransform()
+      gridTransform.SetDisplacementGridData(displacementGrid)
+      gridTransform.SetGridDirectionMatrix(gridDirectionM)
+      transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLGridTransformNode")
+      transformNode.SetName(nodeName)
+      transformNode.SetAndObserveTransformFromParent(gridTransform)
+      return transformNode
+
   def openResultsFolder(self):
       if not hasattr(self, 'vtVars'):
          self.setGlobalVariables(1)
@@ -629,51 +1804,152 @@ class VisSimCommonLogic(ScriptedLoadableModuleLogic):
       else:
          print("uknown system")
 
-  # segmenteditor effect on the resulted segmentations
-  # this function is called by functions like doSmoothing and doMargining
-  def getSegmentationEditor(self,segNode,masterNode):
-            # Create segment editor to get access to effects
-           segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-           segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-           segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
-           segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
-           segmentEditorWidget.setSegmentationNode(segNode)
-           segmentEditorWidget.setMasterVolumeNode(masterNode)
-           return segmentEditorWidget, segmentEditorNode
-
-  # smoothing segmentation effect
-  #TODO: add more options
+  # smoothing segmentation, median filter of all segments
   def runSmoothing(self,segNode,masterNode,KernelSizeMm):
-           # Smoothing
-           [segEditorW,segEditorN]= self.getSegmentationEditor(segNode,masterNode)
-           for i in range (0,segNode.GetSegmentation().GetNumberOfSegments()):
-               segmentID = segNode.GetSegmentation().GetNthSegmentID(i)
-               segEditorW.setActiveEffectByName("Smoothing")
-               segEditorW.setCurrentSegmentID(segmentID)
-               effect = segEditorW.activeEffect()
-               effect.setParameter("SmoothingMethod", "MEDIAN")
-               effect.setParameter("KernelSizeMm", KernelSizeMm)
-               effect.self().onApply()
-  
-           # Clean up
-           segEditorW = None
-           slicer.mrmlScene.RemoveNode(segEditorN)
-  
-  # Margin segmentation effect
+           self.runSegmentsMorphology(segNode, masterNode, "median", float(KernelSizeMm))
+
+  # Margin segmentation
   # MarginSizeMm>0 Grow, else Shrink
   def runMargining(self,segNode,masterNode,MarginSizeMm):
-           #Dilation and Eroding
-           [segEditorW,segEditorN]= self.getSegmentationEditor(segNode,masterNode)
-           for i in range (0,segNode.GetSegmentation().GetNumberOfSegments()):
-               segmentID = segNode.GetSegmentation().GetNthSegmentID(i)
-               segEditorW.setActiveEffectByName("Margin")
-               segEditorW.setCurrentSegmentID(segmentID)
-               effect = segEditorW.activeEffect()
-               effect.setParameter("MarginSizeMm", MarginSizeMm)
-               effect.self().onApply()
-           # Clean up
-           segEditorW = None
-           slicer.mrmlScene.RemoveNode(segEditorN)
+           MarginSizeMm = float(MarginSizeMm)
+           self.runSegmentsMorphology(segNode, masterNode, "dilate" if MarginSizeMm > 0 else "erode", abs(MarginSizeMm))
+
+  #--------------------------------------------------------------------------------------------
+  #                        Headless segmentation morphology
+  #--------------------------------------------------------------------------------------------
+  # All segments are exported to one labelmap, processed together and imported back.
+  # No Qt objects are created so it works without main window and in worker processes.
+  # operation: median, opening, closing, dilate or erode, sizeMm is the kernel size for
+  # median and the margin for the others. Overlapping segments are not supported.
+  def runSegmentsMorphology(self, segNode, masterNode, operation, sizeMm):
+      segmentIDs = vtk.vtkStringArray()
+      segNode.GetSegmentation().GetSegmentIDs(segmentIDs)
+      if segmentIDs.GetNumberOfValues() == 0:
+         return
+      labelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+      try:
+         slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(segNode, segmentIDs, labelNode, masterNode)
+         labelImg = sitkUtils.PullVolumeFromSlicer(labelNode)
+         labelImg = self.runLabelMorphology(labelImg, operation, sizeMm)
+         sitkUtils.PushVolumeToSlicer(labelImg, labelNode)
+         labelArray = slicer.util.arrayFromVolume(labelNode)
+         # label i+1 is the ith exported segment
+         for i in range(segmentIDs.GetNumberOfValues()):
+             slicer.util.updateSegmentBinaryLabelmapFromArray((labelArray == i+1).astype(np.uint8), segNode, segmentIDs.GetValue(i), labelNode)
+      finally:
+         slicer.mrmlScene.RemoveNode(labelNode)
+
+  # multi-label morphology of a SimpleITK label image, sizes are in mm
+  def runLabelMorphology(self, labelImg, operation, sizeMm):
+      spacing = labelImg.GetSpacing()
+      if operation == "median":
+         # odd kernel size in voxels as the segment editor smoothing effect
+         radius = [max(int(round((sizeMm/sp + 1) / 2)) - 1, 0) for sp in spacing]
+         return self.getLabelMajority(labelImg, radius)
+      radius = [sizeMm] * labelImg.GetDimension()
+      if operation == "dilate":
+         return sitk.LabelSetDilate(labelImg, radius, True)
+      elif operation == "erode":
+         return sitk.LabelSetErode(labelImg, radius, True)
+      elif operation == "opening":
+         return sitk.LabelSetDilate(sitk.LabelSetErode(labelImg, radius, True), radius, True)
+      elif operation == "closing":
+         return sitk.LabelSetErode(sitk.LabelSetDilate(labelImg, radius, True), radius, True)
+      print("Error: unknown morphology operation " + operation)
+      return labelImg
+
+  # Each voxel gets the most frequent label of its box kernel, a tie keeps the voxel label.
+  # The median of the label values is not a vote where three labels meet. The labelmap is
+  # read once, the votes of each label are box sums from cumulative sums.
+  def getLabelMajority(self, labelImg, radius):
+      labels = sitk.GetArrayFromImage(labelImg)
+      radiusKJI = list(radius)[::-1]
+      fused = labels.copy()
+      bestVotes = np.full(labels.shape, -1, dtype=np.int32)
+      for label in np.unique(labels):
+          votes = (labels == label).astype(np.int32)
+          for axis in range(votes.ndim):
+              r = radiusKJI[axis]
+              if r == 0:
+                 continue
+              # voxels outside the image do not vote
+              c = np.cumsum(np.pad(np.moveaxis(votes, axis, 0), [(r+1, r)] + [(0,0)]*(votes.ndim-1)), axis=0)
+              votes = np.moveaxis(c[2*r+1:] - c[:-(2*r+1)], 0, axis)
+          better = (votes > bestVotes) | ((votes == bestVotes) & (labels == label))
+          fused[better] = label
+          bestVotes[better] = votes[better]
+      fusedImg = sitk.GetImageFromArray(fused)
+      fusedImg.CopyInformation(labelImg)
+      return fusedImg
+
+  #--------------------------------------------------------------------------------------------
+  #                        Run workspace
+  #--------------------------------------------------------------------------------------------
+  # Each run writes its temporary files to its own folder so several runs can work at the
+  # same time. The folder is created in VISSIM_WORK_PATH if defined, in /dev/shm if
+  # vtVars['useTmpfs'] is True, otherwise in VisSimTools/work.
+  def createWorkspace(self):
+      self.profiler = VisSimProfiler()
+      basePath = os.environ.get("VISSIM_WORK_PATH", "")
+      if basePath == "":
+         basePath = os.path.join(self.vtVars['vissimPath'], "work")
+         if self.s2b(self.vtVars['useTmpfs']) and os.path.isdir("/dev/shm"):
+            basePath = os.path.join("/dev/shm", "VisSimTools")
+      self.vtVars['runID']    = time.strftime("%Y%m%d%H%M%S") + "_" + str(os.getpid()) + "_" + uuid.uuid4().hex[0:8]
+      self.vtVars['workPath'] = os.path.join(basePath, "run_" + self.vtVars['runID'])
+      self.elastixRuns = []
+      self.runNodeIDs  = [] # temporary nodes of this run, removed by removeTmpsFiles
+      os.makedirs(self.vtVars['workPath'])
+      if not os.path.exists(self.vtVars['outputPath']):
+         os.makedirs(self.vtVars['outputPath'])
+      print("      Run workspace     : " + self.vtVars['workPath'])
+      return self.vtVars['workPath']
+
+  # stage span of the run, job logics record to the profiler of their parent
+  def span(self, name, **args):
+      if self.parentLogic is not None:
+         return self.parentLogic.span(name, **args)
+      if getattr(self, 'profiler', None) is None:
+         self.profiler = VisSimProfiler()
+      return self.profiler.span(name, **args)
+
+  # the spans of the run as a Chrome trace in the output folder
+  def writeTrace(self):
+      if getattr(self, 'profiler', None) is None:
+         return None
+      self.profiler.printSummary()
+      tracePath = self.profiler.writeTrace(os.path.join(self.getWorkPath(), "trace_" + self.vtVars.get('runID', str(os.getpid())) + ".json"))
+      return self.publishFile(tracePath)
+
+  # temporary files go to the run workspace, or to VisSimTools if there is no workspace
+  def getWorkPath(self):
+      return self.vtVars.get('workPath', self.vtVars['vissimPath'])
+
+  # move a file from the workspace to the output folder, readers never see a partial file
+  def publishFile(self, filePath, fileName=None):
+      if fileName is None:
+         fileName = os.path.basename(filePath)
+      resultPath = os.path.join(self.vtVars['outputPath'], fileName)
+      tmpPath = resultPath + "." + self.vtVars.get('runID', str(os.getpid())) + ".tmp"
+      shutil.move(filePath, tmpPath)
+      os.replace(tmpPath, resultPath)
+      return resultPath
+
+  # save a node in the workspace and publish it to the output folder, returns the result path
+  @vsProfiled("save result")
+  def saveResultNode(self, node, fileName):
+      filePath = os.path.join(self.getWorkPath(), fileName)
+      if not slicer.util.saveNode(node, filePath):
+         print("Error: can not save " + fileName)
+         return None
+      storageNode = node.GetStorageNode()
+      # tables have a schema file next to the data
+      if hasattr(storageNode, 'GetSchemaFileName') and os.path.isfile(storageNode.GetSchemaFileName() or ""):
+         self.publishFile(storageNode.GetSchemaFileName())
+      resultPath = self.publishFile(filePath)
+      if storageNode is not None:
+         storageNode.SetFileName(resultPath)
+      return resultPath
 
   def removeOtputsFolderContents(self):
       try:
@@ -685,46 +1961,53 @@ class VisSimCommonLogic(ScriptedLoadableModuleLogic):
             print("nothing to delete ...")
             print(e)
 
-  def removeTmpsFiles(self):
-      #remove old files
-      outputPath = self.vtVars['outputPath']
-      print("removing temp output files!")
-      fds=[]
-      outoutputFolders = os.listdir(outputPath)
-      for fd in outoutputFolders:
-          if os.path.isdir(os.path.join(outputPath,fd)):
-             fds.append(fd)
-      fds.append(".")
-      for fd in fds:
-          print(os.path.join(outputPath,fd) )
-          resfiles = os.listdir(os.path.join(outputPath,fd) )
-          for fnm in resfiles:
-              if "IterationInfo" in fnm:
-                 os.remove(os.path.join(outputPath,fd,fnm))
-              elif  "result" in fnm:
-                 os.remove(os.path.join(outputPath,fd,fnm))
-              elif  ".log" in fnm:
-                 os.remove(os.path.join(outputPath,fd,fnm))
-              elif  "TransformParameters" in fnm:
-                 os.remove(os.path.join(outputPath,fd,fnm))
-      vissimPath = self.vtVars['vissimPath']
-      cropfiles = os.listdir(vissimPath)
-      try:
-         for fnm in cropfiles:
-             if "Crop" in fnm:
-                 os.remove(os.path.join(vissimPath, fnm))
-             if re.search('[C][1-7]', fnm):
-                 os.remove(os.path.join(vissimPath, fnm))
-      except Exception as e:
-             print(" Error: can not remove " + fnm)
-             print(e)
+  # locationNodes: location markups of this run, they are hidden
+  def removeTmpsFiles(self, locationNodes=[]):
+      if 'workPath' in self.vtVars:
+         # only the workspace of this run is removed
+         print("removing run workspace: " + self.vtVars['workPath'])
+         shutil.rmtree(self.vtVars['workPath'], ignore_errors=True)
+      else:
+         #remove old files
+         outputPath = self.vtVars['outputPath']
+         print("removing temp output files!")
+         fds=[]
+         outoutputFolders = os.listdir(outputPath)
+         for fd in outoutputFolders:
+             if os.path.isdir(os.path.join(outputPath,fd)):
+                fds.append(fd)
+         fds.append(".")
+         for fd in fds:
+             print(os.path.join(outputPath,fd) )
+             resfiles = os.listdir(os.path.join(outputPath,fd) )
+             for fnm in resfiles:
+                 if "IterationInfo" in fnm:
+                    os.remove(os.path.join(outputPath,fd,fnm))
+                 elif  "result" in fnm:
+                    os.remove(os.path.join(outputPath,fd,fnm))
+                 elif  ".log" in fnm:
+                    os.remove(os.path.join(outputPath,fd,fnm))
+                 elif  "TransformParameters" in fnm:
+                    os.remove(os.path.join(outputPath,fd,fnm))
+         vissimPath = self.vtVars['vissimPath']
+         cropfiles = os.listdir(vissimPath)
+         try:
+            for fnm in cropfiles:
+                if "Crop" in fnm:
+                    os.remove(os.path.join(vissimPath, fnm))
+                if re.search('[C][1-7]', fnm):
+                    os.remove(os.path.join(vissimPath, fnm))
+         except Exception as e:
+                print(" Error: can not remove " + fnm)
+                print(e)
+      # only the nodes of this run, other runs can still use theirs
       print("removing temp nodes ...!")
-      nodes = slicer.util.getNodesByClass('vtkMRMLScalarVolumeNode')
-      for f in nodes:
-          if "_Crop"  in f.GetName(): slicer.mrmlScene.RemoveNode(f)
-      nodes = slicer.util.getNodesByClass('vtkMRMLMarkupsFiducialNode')
-      for f in nodes:
-          if "Location" in f.GetName(): f.GetDisplayNode().SetVisibility(False)
+      for nodeID in getattr(self, 'runNodeIDs', []):
+          node = slicer.mrmlScene.GetNodeByID(nodeID)
+          if node is not None: slicer.mrmlScene.RemoveNode(node)
+      self.runNodeIDs = []
+      for f in locationNodes:
+          if (f is not None) and (f.GetDisplayNode() is not None): f.GetDisplayNode().SetVisibility(False)
 
   def rmvSlicerNode(self,node):
     slicer.mrmlScene.RemoveNode(node)
@@ -925,17 +2208,70 @@ class VisSimCommonLogic(ScriptedLoadableModuleLogic):
   #--------------------------------------------------------------------------------------------
   #                        Calculate Segmentation Information
   #--------------------------------------------------------------------------------------------
+  # Statistics of all segments from one pass over their labelmap, only the requested measures
+  # are computed: voxelCount, volume (mm3), centroid (RAS), boundingBox (IJK min and max of the
+  # labelmap) and the intensity measures mean, min, max and std of the master volume.
+  # The result is a dictionary with the segment ID as key, overlapping segments are not supported.
+  def getSegmentsStatistics(self, segNode, masterNode=None, measures=["voxelCount","volume"]):
+        segmentIDs = vtk.vtkStringArray()
+        segNode.GetSegmentation().GetSegmentIDs(segmentIDs)
+        nLabels = segmentIDs.GetNumberOfValues() + 1
+        stats = {}
+        labelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+        try:
+           slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(segNode, segmentIDs, labelNode, masterNode)
+           labelArray = slicer.util.arrayFromVolume(labelNode)
+           # only the segmented voxels are used, label i+1 is the ith segment
+           voxelIdx = np.flatnonzero(labelArray)
+           labels = labelArray.ravel()[voxelIdx].astype(np.intp)
+           counts = np.bincount(labels, minlength=nLabels)
+           voxelVolume = float(np.prod(labelNode.GetSpacing()))
+           if ("centroid" in measures) or ("boundingBox" in measures):
+              ptsKJI = np.stack(np.unravel_index(voxelIdx, labelArray.shape), axis=1)
+           if "centroid" in measures:
+              sumsKJI = np.stack([np.bincount(labels, weights=ptsKJI[:,d], minlength=nLabels) for d in range(3)], axis=1)
+              centroids = self.ptsIJK2RAS((sumsKJI / np.maximum(counts, 1)[:,None])[:,::-1], labelNode)
+           if "boundingBox" in measures:
+              bbMin = np.full((nLabels,3), np.iinfo(np.intp).max) ; bbMax = np.full((nLabels,3), -1)
+              np.minimum.at(bbMin, labels, ptsKJI[:,::-1]) ; np.maximum.at(bbMax, labels, ptsKJI[:,::-1])
+           if any(m in measures for m in ["mean","min","max","std"]):
+              values = slicer.util.arrayFromVolume(masterNode).ravel()[voxelIdx].astype(float)
+              sums   = np.bincount(labels, weights=values, minlength=nLabels)
+              sqSums = np.bincount(labels, weights=values**2, minlength=nLabels)
+              vMin = np.full(nLabels, np.inf)  ; np.minimum.at(vMin, labels, values)
+              vMax = np.full(nLabels, -np.inf) ; np.maximum.at(vMax, labels, values)
+           for i in range(nLabels-1):
+               segID = segmentIDs.GetValue(i) ; label = i+1
+               n = max(int(counts[label]), 1)
+               st = {'name': segNode.GetSegmentation().GetSegment(segID).GetName()}
+               if "voxelCount" in measures: st['voxelCount'] = int(counts[label])
+               if "volume" in measures:     st['volume'] = counts[label] * voxelVolume
+               if "centroid" in measures:   st['centroid'] = list(centroids[label])
+               if "boundingBox" in measures:st['boundingBox'] = [list(bbMin[label]), list(bbMax[label])]
+               if "mean" in measures:       st['mean'] = sums[label] / n
+               if "min" in measures:        st['min'] = vMin[label]
+               if "max" in measures:        st['max'] = vMax[label]
+               if "std" in measures:        st['std'] = math.sqrt(max(sqSums[label]/n - (sums[label]/n)**2, 0))
+               stats[segID] = st
+        finally:
+           slicer.mrmlScene.RemoveNode(labelNode)
+        return stats
+
+  @vsProfiled("statistics")
   def getItemInfo(self, segNode, masterNode, tblNode, vtID):
-        segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
-        segStatLogic.getParameterNode().SetParameter("Segmentation", segNode.GetID())
-        segStatLogic.getParameterNode().SetParameter("ScalarVolume", masterNode.GetID())
-        segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.enabled","False")
-        segStatLogic.getParameterNode().SetParameter("ScalarVolumeSegmentStatisticsPlugin.voxel_count.enabled","False")
-        segStatLogic.computeStatistics()
+        # C7 centre of mass is needed for testing
+        getCoM = (vtID ==7) and (self.vtVars['vtMethodID']== "0")
+        stats = self.getSegmentsStatistics(segNode, masterNode, ["volume","centroid"] if getCoM else ["volume"])
         if vtID == 0:  
            print(vtID," getItemInfo Cochlea")
-           # compute the fiducial length
-           segStatLogic.exportToTable(tblNode)
+           # one row for each segment: name, volume and the fiducial length
+           tblNode.RemoveAllColumns()
+           for colName in ["Segment","Volume mm3","Length mm"]:
+               tblNode.AddColumn().SetName(colName)
+           for st in stats.values():
+               idx = tblNode.AddEmptyRow()
+               tblNode.SetCellText(idx,0,st['name'])
+               tblNode.SetCellText(idx,1,str(st['volume']))
            tblNode.SetCellText(0,2,self.vtVars['StLength'])
            tblNode.SetCellText(1,2,"0")
         else:
@@ -965,32 +2301,24 @@ class VisSimCommonLogic(ScriptedLoadableModuleLogic):
                   print( "C"+str(vtID) + " table row exists, old values will be removed in row." + str(i))
                   tblNode.RemoveRow(i)
       
-           tblNode.AddEmptyRow() # empty row for current vertebra info
-
-           spTmpTblNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
-           spTmpTblNode.SetName("tmpTable")
-           segStatLogic.exportToTable(spTmpTblNode)
-           idx = tblNode.GetNumberOfRows()-1 # this should be the empty row we added
+           idx = tblNode.AddEmptyRow() # empty row for current vertebra info
            print(" last row index: "+ str(idx))
-           tblNode.GetTable().SetRow(  idx  ,  spTmpTblNode.GetTable().GetRow(0)  )
+           st = list(stats.values())[0]
+           tblNode.SetCellText(idx,0,st['name'])
+           tblNode.SetCellText(idx,1,str(st['volume']))
            tblNode.SetCellText(idx,2," ")
            tblNode.SetCellText(idx,3," ")
            tblNode.SetCellText(idx,4," ")
-           slicer.mrmlScene.RemoveNode(spTmpTblNode )
 
-           # if this is C7 compute center of mass
-           if (vtID ==7) and (self.vtVars['vtMethodID']== "0"): # for testing
+           # if this is C7 use the center of mass from the same pass
+           if getCoM:
               print("updating COM in table ..............")
               segID = segNode.GetSegmentation().GetSegmentIdBySegmentName("C"+str(vtID))
-              #modelNode = segNode.GetClosedSurfaceRepresentation(segID)
-              modelNode = segNode.GetClosedSurfaceInternalRepresentation(segID)
-              
-              com = vtk.vtkCenterOfMass(); com.SetInputData(modelNode);   com.Update()
-              segNodeCoM = com.GetCenter()
+              segNodeCoM = stats[segID]['centroid']
               tblNode.SetCellText(idx,2,str(segNodeCoM[0]))
               tblNode.SetCellText(idx,3,str(segNodeCoM[1]))
               tblNode.SetCellText(idx,4,str(segNodeCoM[2]))
-              self.vtVars['segNodeCoM']=str(segNodeCoM)
+              self.vtVars['segNodeCoM']=str(tuple(segNodeCoM))
 
         # update table and set it the active table in slicer
         print("updating table ..............")
@@ -1004,16 +2332,40 @@ class VisSimCommonLogic(ScriptedLoadableModuleLogic):
   #--------------------------------------------------------------------------------------------
   # This function compute the distance between all the fiducials in a markupnode
   def getFiducilsDistance(self, markupsNode):
-        markupsDistance = 0 ; rasPt0 = [0,0,0] ; rasPt1 = [0,0,0] ;
-
-        for i in range(0, markupsNode.GetNumberOfControlPoints()):
-            markupsNode.GetNthControlPointPosition(i,rasPt1)
-            if (i>0) :
-                markupsNode.GetNthControlPointPosition(i-1,rasPt0)
-                x0 =rasPt0[0]  ; y0= rasPt0[1]  ; z0=rasPt0[2]
-                x1 =rasPt1[0]  ; y1= rasPt1[1]  ; z1=rasPt1[2]
-                markupsDistance = markupsDistance +  math.sqrt( (x1-x0)**2 + (y1-y0)**2 + (z1-z0)**2 )
-        return markupsDistance
+        return self.getFiducialsLengths([markupsNode])[markupsNode.GetID()]['length']
+
+  # Lengths of many markups nodes in one call, the result is a dictionary with the node ID as key:
+  #   length:       total polyline length
+  #   arcLength:    cumulative length at each point
+  #   smoothLength: length of a Catmull-Rom spline through the points (only if smooth is True)
+  def getFiducialsLengths(self, markupsNodes, smooth=False, samplesPerSegment=10):
+        lengths = {}
+        for markupsNode in markupsNodes:
+            pts = slicer.util.arrayFromMarkupsControlPoints(markupsNode)
+            length, arcLength = self.getPolylineLengths(pts)
+            lengths[markupsNode.GetID()] = {'length': length, 'arcLength': arcLength}
+            if smooth:
+               lengths[markupsNode.GetID()]['smoothLength'] = self.getPolylineLengths(self.getCatmullRomPoints(pts, samplesPerSegment))[0]
+        return lengths
+
+  # total and cumulative length of Nx3 points
+  def getPolylineLengths(self, pts):
+        pts = np.asarray(pts, dtype=float).reshape(-1,3)
+        if len(pts) < 2:
+           return 0.0, np.zeros(len(pts))
+        arcLength = np.concatenate(([0.0], np.cumsum(np.linalg.norm(np.diff(pts, axis=0), axis=1))))
+        return float(arcLength[-1]), arcLength
+
+  # samples a uniform Catmull-Rom spline through the points, the end points are repeated
+  def getCatmullRomPoints(self, pts, samplesPerSegment=10):
+        pts = np.asarray(pts, dtype=float).reshape(-1,3)
+        if len(pts) < 3:
+           return pts
+        p = np.vstack((pts[0], pts, pts[-1]))
+        p0 = p[:-3,None,:] ; p1 = p[1:-2,None,:] ; p2 = p[2:-1,None,:] ; p3 = p[3:,None,:]
+        t = np.linspace(0.0, 1.0, samplesPerSegment, endpoint=False)[None,:,None]
+        curve = 0.5 * ( 2*p1 + (p2-p0)*t + (2*p0-5*p1+4*p2-p3)*t**2 + (3*p1-p0-3*p2+p3)*t**3 )
+        return np.vstack((curve.reshape(-1,3), pts[-1]))
 
   def fitAllSlicesViews(self):
       sliceNodes = slicer.util.getNodes('vtkMRMLSliceNode*')
@@ -1085,14 +2437,1191 @@ class VisSimCommonLogic(ScriptedLoadableModuleLogic):
         v3DDWidgetV.zoomIn()
         v3DDWidgetV.zoomFactor =0.05 # back to default value
 
+#===================================================================
+#                     Atlas cache
+#===================================================================
+# Model images, segmentations and landmark lists kept in memory between runs.
+# Entries are keyed by the file path and modification time so a changed model file is
+# loaded again, the least recently used entries are removed above the memory limit
+# (VISSIM_ATLAS_CACHE_MB, default 1024). Each run gets its own copy.
+class VisSimAtlasCache(object):
+  _instance = None
+
+  def __init__(self, maxBytes=None):
+      if maxBytes is None:
+         maxBytes = int(os.environ.get("VISSIM_ATLAS_CACHE_MB", "1024")) * 1024 * 1024
+      self.maxBytes = maxBytes
+      self.entries = collections.OrderedDict() # key: (value, size in bytes)
+      self.lock = threading.Lock()
+
+  # one cache for all runs in this process
+  @classmethod
+  def instance(cls):
+      if cls._instance is None:
+         cls._instance = cls()
+      return cls._instance
+
+  def get(self, kind, path, loader):
+      path = os.path.abspath(path)
+      key = (kind, path, os.path.getmtime(path))
+      with self.lock:
+           if key in self.entries:
+              self.entries.move_to_end(key)
+              return self.entries[key][0]
+      value, nBytes = loader(path)
+      with self.lock:
+           # older versions of the same file are not needed anymore
+           for oldKey in [k for k in self.entries if k[0:2] == key[0:2]]:
+               del self.entries[oldKey]
+           self.entries[key] = (value, nBytes)
+           while len(self.entries) > 1 and sum(e[1] for e in self.entries.values()) > self.maxBytes:
+                 self.entries.popitem(last=False)
+      return value
+
+  def clear(self):
+      with self.lock:
+           self.entries.clear()
+
+  # SimpleITK image, the copy shares the buffer until one of them is changed
+  def getImage(self, path):
+      def load(path):
+          img = sitk.ReadImage(path)
+          return img, img.GetNumberOfPixels() * img.GetSizeOfPixelComponent() * img.GetNumberOfComponentsPerPixel()
+      return sitk.Image(self.get("image", path, load))
+
+  # new segmentation node with a copy of the cached segmentation
+  def getSegmentationNode(self, path, nodeName):
+      def load(path):
+          segNode = slicer.util.loadSegmentation(path)
+          segmentation = slicer.vtkSegmentation()
+          segmentation.DeepCopy(segNode.GetSegmentation())
+          slicer.mrmlScene.RemoveNode(segNode)
+          nBytes = 0
+          for i in range(segmentation.GetNumberOfSegments()):
+              labelmap = segmentation.GetNthSegment(i).GetRepresentation(slicer.vtkSegmentationConverter.GetBinaryLabelmapRepresentationName())
+              if labelmap is not None:
+                 nBytes += labelmap.GetActualMemorySize() * 1024
+          return segmentation, nBytes
+      segNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", nodeName)
+      segNode.CreateDefaultDisplayNodes()
+      segNode.GetSegmentation().DeepCopy(self.get("segmentation", path, load))
+      return segNode
+
+  # labelmap of a segmentation file as SimpleITK image, label i+1 is the ith segment ID
+  def getLabelImage(self, path):
+      def load(path):
+          segNode = slicer.util.loadSegmentation(path)
+          labelNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+          segmentIDs = vtk.vtkStringArray()
+          segNode.GetSegmentation().GetSegmentIDs(segmentIDs)
+          slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(segNode, segmentIDs, labelNode)
+          labelImg = sitkUtils.PullVolumeFromSlicer(labelNode)
+          slicer.mrmlScene.RemoveNode(labelNode)
+          slicer.mrmlScene.RemoveNode(segNode)
+          segmentIDs = [segmentIDs.GetValue(i) for i in range(segmentIDs.GetNumberOfValues())]
+          return (labelImg, segmentIDs), labelImg.GetNumberOfPixels() * labelImg.GetSizeOfPixelComponent()
+      labelImg, segmentIDs = self.get("labelmap", path, load)
+      return sitk.Image(labelImg), list(segmentIDs)
+
+  # Nx3 RAS points and their labels from a Slicer fcsv file
+  def getLandmarks(self, path):
+      def load(path):
+          columns = ["id","x","y","z","ow","ox","oy","oz","vis","sel","lock","label","desc","associatedNodeID"]
+          lps = False
+          pts = [] ; labels = []
+          with open(path) as f:
+               for line in f:
+                   line = line.strip()
+                   if line.startswith("#"):
+                      if "CoordinateSystem" in line:
+                         lps = line.split("=")[-1].strip() in ["LPS","1"]
+                      elif "columns" in line:
+                         columns = [c.strip() for c in line.split("=")[-1].split(",")]
+                      continue
+                   if line == "":
+                      continue
+                   values = next(csv.reader([line]))
+                   pts.append([float(values[columns.index(c)]) for c in ["x","y","z"]])
+                   labels.append(values[columns.index("label")] if "label" in columns else "")
+          pts = np.array(pts, dtype=float).reshape(-1,3)
+          if lps:
+             pts[:,0:2] = -pts[:,0:2]
+          return (pts, labels), pts.nbytes
+      pts, labels = self.get("landmarks", path, load)
+      return pts.copy(), list(labels)
+
+#===================================================================
+#                     Registration cache
+#===================================================================
+# Registration results on disk, keyed by the cropped input voxels, the cochlea point, the side,
+# the parameter files and the atlas files. An entry has the transform parameters, the warped
+# segmentation and the warped landmarks. The least recently used entries are removed above
+# VISSIM_REG_CACHE_MB (default 2048).
+class VisSimRegistrationCache(object):
+
+  def __init__(self, vsc, cachePath=None, maxBytes=None):
+      self.vsc = vsc
+      self.cachePath = cachePath or os.path.join(vsc.vtVars['vissimPath'], "cache", "reg")
+      if maxBytes is None:
+         maxBytes = int(os.environ.get("VISSIM_REG_CACHE_MB", "2048")) * 1024 * 1024
+      self.maxBytes = maxBytes
+
+  def getKey(self, img, point, side, parameterPaths, atlasPaths, options=""):
+      keyHash = hashlib.sha256()
+      keyHash.update(sitk.GetArrayViewFromImage(img).tobytes())
+      keyHash.update(repr([img.GetSize(), img.GetSpacing(), img.GetOrigin(), img.GetDirection(), img.GetPixelIDValue()]).encode())
+      keyHash.update(repr([[round(float(v), 3) for v in point], side, options]).encode())
+      for parsPath in parameterPaths:
+          with open(parsPath, 'rb') as f:
+               keyHash.update(hashlib.sha256(f.read()).digest())
+      # atlas version
+      for atlasPath in atlasPaths:
+          st = os.stat(atlasPath)
+          keyHash.update(repr([os.path.basename(atlasPath), st.st_size, st.st_mtime]).encode())
+      return keyHash.hexdigest()
+
+  # entry folder or None
+  def load(self, key):
+      entryPath = os.path.join(self.cachePath, key)
+      if not os.path.isfile(os.path.join(entryPath, "landmarks.json")):
+         return None
+      os.utime(entryPath, None) # recently used
+      return entryPath
+
+  # writeFunc(folder) writes the entry, it is moved into the cache when complete
+  def store(self, key, writeFunc):
+      entryPath = os.path.join(self.cachePath, key)
+      tmpPath = entryPath + "." + uuid.uuid4().hex[0:8] + ".tmp"
+      os.makedirs(tmpPath)
+      try:
+         writeFunc(tmpPath)
+         if not os.path.exists(entryPath):
+            os.rename(tmpPath, entryPath)
+      except Exception as e:
+         print("Error: can not store registration result in the cache")
+         print(e)
+      finally:
+         shutil.rmtree(tmpPath, ignore_errors=True)
+      self.evict()
+
+  def evict(self):
+      entries = []
+      for name in os.listdir(self.cachePath):
+          entryPath = os.path.join(self.cachePath, name)
+          if name.endswith(".tmp") or not os.path.isdir(entryPath):
+             continue
+          entrySize = sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(entryPath) for f in files)
+          entries.append([os.path.getmtime(entryPath), entrySize, entryPath])
+      totalSize = sum(e[1] for e in entries)
+      for mTime, entrySize, entryPath in sorted(entries)[:-1]:
+          if totalSize <= self.maxBytes:
+             break
+          shutil.rmtree(entryPath, ignore_errors=True)
+          totalSize -= entrySize
+
+  # transforms: [engine, transform parameters] of each atlas, one transform is saved in the
+  # entry folder, more in the subfolders 0, 1, ...
+  def saveResult(self, entryPath, segNode, ptsNodes, transforms):
+      for i in range(len(transforms)):
+          tpPath = entryPath if len(transforms) == 1 else os.path.join(entryPath, str(i))
+          if not os.path.exists(tpPath):
+             os.makedirs(tpPath)
+          transforms[i][0].saveTransform(transforms[i][1], tpPath)
+      slicer.util.saveNode(segNode, os.path.join(entryPath, "segmentation.seg.nrrd"))
+      landmarks = [slicer.util.arrayFromMarkupsControlPoints(ptsNode).tolist() for ptsNode in ptsNodes]
+      with open(os.path.join(entryPath, "landmarks.json"), 'w') as f:
+           json.dump(landmarks, f)
+
+  # segmentation and landmark nodes from an entry, the landmark labels are from the atlas files
+  def loadResult(self, entryPath, segNodeName, ptsNodeNames, ptsModelPaths):
+      segNode = slicer.util.loadSegmentation(os.path.join(entryPath, "segmentation.seg.nrrd"))
+      segNode.SetName(segNodeName)
+      segNode.SetAndObserveStorageNodeID(None)
+      with open(os.path.join(entryPath, "landmarks.json")) as f:
+           landmarks = json.load(f)
+      ptsNodes = []
+      for ptsNodeName, ptsModelPath, pts in zip(ptsNodeNames, ptsModelPaths, landmarks):
+          labels = VisSimAtlasCache.instance().getLandmarks(ptsModelPath)[1]
+          ptsNodes.append(self.vsc.createMarkupsNode(ptsNodeName, np.array(pts).reshape(-1,3), labels))
+      return segNode, ptsNodes
+
+#===================================================================
+#                     Elastix iteration history
+#===================================================================
+# Iterations that elastix needed in past runs, for each parameter file and resolution. A run
+# needed the iterations until its smoothed metric curve is within 2% of its total improvement
+# from the final value. The key of a parameter file is its parameters without the iteration
+# budget and the output settings, so the run copies of a file share one history.
+# The runs are only recorded with vtVars['iterationTuning'] = "record" or "auto".
+# With "auto" the budget of a resolution is 1.25 times the most iterations needed in the last
+# runs. A run that needed nearly its whole budget shows that the budget is too small, then the
+# budget of the file is used again until that run is out of the window.
+# Each process appends its runs to its own file in the history folder, so batch workers do not
+# overwrite each other, the files are merged when the history is read.
+class VisSimElastixHistory(object):
+  ignoredParameters = ["MaximumNumberOfIterations", "WriteResultImage", "WriteIterationInfo", "ResultImageFormat", "ResultImagePixelType"]
+  lock = threading.Lock()
+
+  def __init__(self, vsc, historyPath=None, maxRuns=50, minRuns=5, windowRuns=10, minIterations=50):
+      self.vsc = vsc
+      self.historyPath   = historyPath or os.path.join(vsc.vtVars['vissimPath'], "cache", "elastixHistory")
+      self.runsPath      = os.path.join(self.historyPath, "runs_" + platform.node() + "_" + str(os.getpid()) + ".jsonl")
+      self.maxRuns       = maxRuns       # runs kept for each parameter file
+      self.minRuns       = minRuns       # runs needed before the budget is changed
+      self.windowRuns    = windowRuns    # last runs used for the budget
+      self.minIterations = minIterations
+
+  def getKey(self, parameters):
+      items = [[key, parameters[key]] for key in sorted(parameters) if key not in self.ignoredParameters]
+      return hashlib.sha256(json.dumps(items).encode("utf-8")).hexdigest()[0:16]
+
+  # MaximumNumberOfIterations of each resolution, 500 is the elastix default
+  def getBudget(self, parameters):
+      resolutions = int(parameters.get("NumberOfResolutions", "1").split()[0])
+      itrs = [int(float(v)) for v in parameters.get("MaximumNumberOfIterations", "500").split()]
+      return itrs * resolutions if len(itrs) == 1 else itrs
+
+  # iterations until the smoothed metric is within tolerance of its final value,
+  # the stochastic optimizers give a noisy metric
+  def getNeededIterations(self, metric, tolerance=0.02):
+      metric = np.array(metric, dtype=float)
+      metric = metric[np.isfinite(metric)]
+      if len(metric) < 2:
+         return len(metric)
+      window = min(max(5, len(metric)//20), len(metric))
+      smoothed = np.convolve(metric, np.ones(window)/window, mode='valid')
+      improvement = abs(smoothed[0] - smoothed[-1])
+      if improvement == 0:
+         return window
+      converged = np.nonzero(np.abs(smoothed - smoothed[-1]) <= tolerance*improvement)[0][0]
+      return int(min(converged + window, len(metric)))
+
+  # records {'time', 'key', 'run'} of one file, a line cut by a crash is skipped
+  def readRunsFile(self, runsPath):
+      records = []
+      try:
+         with open(runsPath) as f:
+              for line in f:
+                  try:
+                     records.append(json.loads(line))
+                  except ValueError:
+                     pass
+      except IOError:
+         pass
+      return records
+
+  # the last runs of each key in the order they finished, the files of all processes are merged
+  def getRuns(self, records):
+      history = {}
+      for record in sorted(records, key=lambda r: r['time']):
+          history.setdefault(record['key'], []).append(record['run'])
+      for key in history:
+          del history[key][0:-self.maxRuns]
+      return history
+
+  def read(self):
+      records = []
+      for runsPath in glob.glob(os.path.join(self.historyPath, "runs_*.jsonl")):
+          records += self.readRunsFile(runsPath)
+      return self.getRuns(records)
+
+  # add a finished run, stats are from readElastixLog
+  def add(self, parameterPaths, stats):
+      records = []
+      for parsPath, parsStats in zip(parameterPaths, stats['parameterFiles']):
+          parameters = self.vsc.readParameterFile(parsPath)
+          budget = self.getBudget(parameters)
+          run = []
+          for resStats in parsStats['resolutions']:
+              resBudget = budget[min(resStats['resolution'], len(budget)-1)]
+              needed = self.getNeededIterations(resStats['metric'])
+              run.append({'budget': resBudget, 'needed': needed, 'saturated': needed >= 0.9*resBudget})
+          if len(run) > 0:
+             records.append({'time': time.time(), 'key': self.getKey(parameters), 'run': run})
+      if len(records) == 0:
+         return
+      # only the threads of this process write this file
+      with self.lock:
+           if not os.path.exists(self.historyPath):
+              os.makedirs(self.historyPath)
+           with open(self.runsPath, 'a') as f:
+                f.write("".join(json.dumps(record) + "\n" for record in records))
+           # the file keeps the last runs of each key
+           records = self.readRunsFile(self.runsPath)
+           if len(records) > 2*self.maxRuns:
+              keyRecords = {}
+              for record in sorted(records, key=lambda r: r['time']):
+                  keyRecords.setdefault(record['key'], []).append(record)
+              records = sorted([r for key in keyRecords for r in keyRecords[key][-self.maxRuns:]], key=lambda r: r['time'])
+              tmpPath = self.runsPath + ".tmp"
+              with open(tmpPath, 'w') as f:
+                   f.write("".join(json.dumps(record) + "\n" for record in records))
+              os.replace(tmpPath, self.runsPath)
+
+  # MaximumNumberOfIterations text of the parameters, None if the budget stays the same
+  def getIterations(self, parameters):
+      runs = self.read().get(self.getKey(parameters), [])[-self.windowRuns:]
+      budget = self.getBudget(parameters)
+      itrs = []
+      for r in range(len(budget)):
+          samples = [run[r] for run in runs if r < len(run)]
+          if len(samples) < self.minRuns or any(s['saturated'] for s in samples):
+             itrs.append(budget[r])
+          else:
+             needed = int(math.ceil(1.25 * max(s['needed'] for s in samples) / 10.0)) * 10
+             itrs.append(min(budget[r], max(self.minIterations, needed)))
+      if itrs == budget:
+         return None
+      return " ".join(str(i) for i in itrs)
+
+#===================================================================
+#                     Remote files
+#===================================================================
+class VisSimRangeError(IOError):
+  pass
+
+# Read-only seekable file over HTTP range requests, a file:// link or a local path.
+# It can be given to zipfile.ZipFile, small reads are served from a cached block.
+class VisSimRemoteFile(object):
+  blockSize = 1 << 16
+
+  def __init__(self, url):
+      self.url = url
+      self.pos = 0
+      self.block = (0, b"")
+      self.localFile = None
+      if url.startswith("file:"):
+         url = url2pathname(urlparse(url).path)
+      if os.path.exists(url):
+         self.localFile = open(url, 'rb')
+         self.size = os.path.getsize(url)
+      else:
+         self.size = self.getRemoteSize()
+
+  def getRemoteSize(self):
+      response = urlopen(Request(self.url, headers={"Range": "bytes=0-0"}), timeout=60)
+      contentRange = response.headers.get("Content-Range")
+      response.close()
+      if not (response.getcode() == 206) or contentRange is None:
+         raise VisSimRangeError("range requests are not supported by " + self.url)
+      return int(contentRange.split("/")[-1])
+
+  # bytes from start to end, end is exclusive
+  def readRange(self, start, end):
+      return b"".join(self.iterRange(start, end))
+
+  def iterRange(self, start, end, chunkSize=1 << 20):
+      end = min(end, self.size)
+      if start >= end:
+         return
+      if self.localFile is not None:
+         self.localFile.seek(start)
+         while start < end:
+               buf = self.localFile.read(min(chunkSize, end-start))
+               if not buf: break
+               start += len(buf)
+               yield buf
+         return
+      response = urlopen(Request(self.url, headers={"Range": "bytes=%d-%d" % (start, end-1)}), timeout=60)
+      if not (response.getcode() == 206):
+         response.close()
+         raise VisSimRangeError("range requests are not supported by " + self.url)
+      try:
+         while start < end:
+               buf = response.read(min(chunkSize, end-start))
+               if not buf:
+                  raise IOError("connection closed at byte " + str(start))
+               start += len(buf)
+               yield buf
+      finally:
+         response.close()
+
+  # file interface used by zipfile
+  def seekable(self):
+      return True
+
+  def tell(self):
+      return self.pos
+
+  def seek(self, offset, whence=0):
+      if whence == 0:
+         self.pos = offset
+      elif whence == 1:
+         self.pos += offset
+      else:
+         self.pos = self.size + offset
+      return self.pos
+
+  def read(self, n=-1):
+      if n is None or n < 0:
+         n = self.size - self.pos
+      n = min(n, self.size - self.pos)
+      if n <= 0:
+         return b""
+      [blockStart, blockData] = self.block
+      if not (blockStart <= self.pos and self.pos + n <= blockStart + len(blockData)):
+         blockStart = self.pos
+         blockData  = self.readRange(self.pos, self.pos + max(n, self.blockSize))
+         self.block = (blockStart, blockData)
+      data = blockData[self.pos-blockStart:self.pos-blockStart+n]
+      self.pos += len(data)
+      return data
+
+  def close(self):
+      if self.localFile is not None:
+         self.localFile.close()
+         self.localFile = None
+
+#===================================================================
+#                     Registration Engines
+#===================================================================
+# Both engines have the same interface:
+#   register(fixed, moving, parameterPaths, outputPath, line)
+#       -> error code, result image, transform parameters
+#   transform(moving, transformParameters, outputPath, line)
+#       -> error code, result image, deformation field
+# fixed and moving can be a file path or a SimpleITK image. The subprocess
+# engine returns file paths, the in-process engine returns SimpleITK images
+# and elastix parameter maps.
+class VisSimElastixSubprocessEngine(object):
+  name = "subprocess"
+  needsFiles = True
+
+  def __init__(self, vsc):
+      self.vsc = vsc
+
+  # elastix binaries need files, write images that are only in memory
+  def imagePath(self, img, outputPath, imgName):
+      if isinstance(img, str):
+         return img
+      imgPath = os.path.join(outputPath, imgName + self.vsc.vtVars['imgType'])
+      sitk.WriteImage(img, imgPath)
+      return imgPath
+
+  def register(self, fixed, moving, parameterPaths, outputPath, line=""):
+      if not os.path.exists(outputPath):
+         os.makedirs(outputPath)
+      fixedPath  = self.imagePath(fixed,  outputPath, "fixedImage")
+      movingPath = self.imagePath(moving, outputPath, "movingImage")
+      cTI = self.vsc.runElastix(self.vsc.vtVars['elastixBinPath'], fixedPath, movingPath, outputPath, parameterPaths, self.vsc.vtVars['noOutput'], line)
+      # the last parameter file defines the final result
+      lastIdx = len(parameterPaths)-1
+      resPath   = os.path.join(outputPath, "result."+str(lastIdx)+self.vsc.vtVars['imgType'])
+      transPath = os.path.join(outputPath, "TransformParameters."+str(lastIdx)+".txt")
+      return cTI, resPath, transPath
+
+  # deformationField: also write the dense deformation field
+  # labelImage: nearest neighbour resampling for label images
+  def transform(self, moving, transformParameters, outputPath, line="", deformationField=True, labelImage=False):
+      if not os.path.exists(outputPath):
+         os.makedirs(outputPath)
+      movingPath = self.imagePath(moving, outputPath, "movingImage")
+      if labelImage:
+         transformParameters = self.vsc.writeTransformParameters(transformParameters, os.path.join(outputPath, "TransformParameters.label.txt"),
+                                  {"FinalBSplineInterpolationOrder": "0", "ResultImagePixelType": '"unsigned char"'})
+      cTS = self.vsc.runTransformix(self.vsc.vtVars['transformixBinPath'], movingPath, outputPath, transformParameters, self.vsc.vtVars['noOutput'], line,
+                                    "all" if deformationField else None)
+      resPath = os.path.join(outputPath, "result"+self.vsc.vtVars['imgType'])
+      defPath = os.path.join(outputPath, "deformationField"+self.vsc.vtVars['imgType']) if deformationField else None
+      return cTS, resPath, defPath
+
+  # Nx3 physical points (LPS) of the fixed image mapped to the moving image, None if it fails
+  def transformPoints(self, pts, transformParameters, outputPath, line=""):
+      if not os.path.exists(outputPath):
+         os.makedirs(outputPath)
+      ptsPath = self.vsc.writePointsFile(pts, os.path.join(outputPath, "inputPoints.txt"))
+      cTS = self.vsc.runTransformix(self.vsc.vtVars['transformixBinPath'], None, outputPath, transformParameters, self.vsc.vtVars['noOutput'], line, ptsPath)
+      if not cTS == 0:
+         return None
+      return self.vsc.readOutputPoints(os.path.join(outputPath, "outputpoints.txt"))
+
+  # copy the transform parameters file and its initial transforms to a folder,
+  # initial transforms are given relative to the folder
+  def saveTransform(self, transformParameters, folderPath):
+      tpPaths = [transformParameters]
+      while True:
+            with open(tpPaths[0]) as f:
+                 initialTp = re.search(r'^\(InitialTransformParametersFileName\s+"([^"]*)"\)', f.read(), re.MULTILINE)
+            if initialTp is None or initialTp.group(1) == "NoInitialTransform":
+               break
+            tpPaths.insert(0, initialTp.group(1))
+      savedPaths = []
+      for i in range(len(tpPaths)):
+          savedPath = os.path.join(folderPath, "TransformParameters."+str(i)+".txt")
+          initialTp = ('"' + os.path.basename(savedPaths[-1]) + '"') if savedPaths else '"NoInitialTransform"'
+          savedPaths.append(self.vsc.writeTransformParameters(tpPaths[i], savedPath, {"InitialTransformParametersFileName": initialTp}))
+      return savedPaths[-1]
+
+  # one transform that applies first and then second: second(first(x)),
+  # first becomes the initial transform of second
+  def composeTransforms(self, first, second, outputPath):
+      return self.vsc.writeTransformParameters(second, os.path.join(outputPath, "TransformParameters.composed.txt"),
+                {"InitialTransformParametersFileName": '"' + first.replace("\\", "/") + '"', "HowToCombineTransforms": '"Compose"'})
+
+class VisSimElastixInProcessEngine(object):
+  name = "inprocess"
+  needsFiles = False
+
+  def __init__(self, vsc, backend):
+      self.vsc = vsc
+      self.backend = backend
+      self.name = "inprocess (" + backend + ")"
+
+  # sitk: SimpleITK built with elastix, itk: ITKElastix, None: not available
+  @staticmethod
+  def getBackend():
+      if hasattr(sitk, "ElastixImageFilter"):
+         return "sitk"
+      try:
+         import itk
+         if hasattr(itk, "ElastixRegistrationMethod"):
+            return "itk"
+      except ImportError:
+         pass
+      return None
+
+  def readImage(self, img):
+      if isinstance(img, str):
+         return sitk.ReadImage(img)
+      return img
+
+  @vsProfiled("elastix")
+  def register(self, fixed, moving, parameterPaths, outputPath, line=""):
+      print ("************  Compute the Transform (in-process) **********************")
+      if not os.path.exists(outputPath):
+         os.makedirs(outputPath)
+      try:
+         fixedImg  = self.readImage(fixed)
+         movingImg = self.readImage(moving)
+         if self.backend == "sitk":
+            elx = sitk.ElastixImageFilter()
+            elx.SetFixedImage(fixedImg)
+            elx.SetMovingImage(movingImg)
+            elx.SetParameterMap(sitk.ReadParameterFile(parameterPaths[0]))
+            for parsPath in parameterPaths[1:]:
+                elx.AddParameterMap(sitk.ReadParameterFile(parsPath))
+            elx.LogToConsoleOff()
+            # the log is parsed for the convergence of the run
+            elx.SetOutputDirectory(outputPath)
+            elx.SetLogFileName("elastix.log")
+            elx.LogToFileOn()
+            if not self.vsc.vtVars['elastixThreads'] == "":
+               elx.SetNumberOfThreads(int(self.vsc.vtVars['elastixThreads']))
+            self.vsc.runInThread(elx.Execute, getattr(elx, "Abort", None))
+            resImg = elx.GetResultImage()
+            transformParameters = elx.GetTransformParameterMap()
+         else:
+            import itk
+            parameterObject = itk.ParameterObject.New()
+            for parsPath in parameterPaths:
+                parameterObject.AddParameterFile(parsPath)
+            fixedItkImg  = self.sitk2itk(fixedImg)
+            movingItkImg = self.sitk2itk(movingImg)
+            threadsArgs = {} if self.vsc.vtVars['elastixThreads'] == "" else {'number_of_threads': int(self.vsc.vtVars['elastixThreads'])}
+            resItkImg, transformParameters = self.vsc.runInThread(lambda: itk.elastix_registration_method(
+                fixedItkImg, movingItkImg, parameter_object=parameterObject, log_to_console=False,
+                log_to_file=True, log_file_name="elastix.log", output_directory=outputPath, **threadsArgs))
+            resImg = self.itk2sitk(resItkImg)
+            resImg = sitk.Cast(resImg, movingImg.GetPixelID())
+      except VisSimCancelledError:
+         raise
+      except Exception as e:
+         print(e)
+         cTI, errStr = self.vsc.checkElastixRun(outputPath, parameterPaths, 1, line, checkFiles=False)
+         self.vsc.chkElxER(cTI, errStr + " (" + str(e) + ")")
+         return cTI, None, None
+      cTI, errStr = self.vsc.checkElastixRun(outputPath, parameterPaths, 0, line, checkFiles=False)
+      self.vsc.chkElxER(cTI, errStr)
+      return cTI, resImg, transformParameters
+
+  # deformationField: also compute the dense deformation field
+  # labelImage: nearest neighbour resampling for label images
+  @vsProfiled("transformix")
+  def transform(self, moving, transformParameters, outputPath, line="", deformationField=True, labelImage=False):
+      print ("************  Apply transform (in-process) **********************")
+      defField = None
+      try:
+         movingImg = self.readImage(moving)
+         if labelImage:
+            transformParameters = self.setLastMapParameters(transformParameters, {"FinalBSplineInterpolationOrder": "0", "ResultImagePixelType": "unsigned char"})
+         if self.backend == "sitk":
+            tfx = sitk.TransformixImageFilter()
+            tfx.SetTransformParameterMap(transformParameters)
+            tfx.SetMovingImage(movingImg)
+            if deformationField:
+               tfx.ComputeDeformationFieldOn()
+            tfx.LogToConsoleOff()
+            tfx.LogToFileOff()
+            if not self.vsc.vtVars['elastixThreads'] == "":
+               tfx.SetNumberOfThreads(int(self.vsc.vtVars['elastixThreads']))
+            self.vsc.runInThread(tfx.Execute, getattr(tfx, "Abort", None))
+            resImg = tfx.GetResultImage()
+            if deformationField:
+               defField = tfx.GetDeformationField()
+         else:
+            import itk
+            tfx = itk.TransformixFilter.New(self.sitk2itk(movingImg))
+            tfx.SetTransformParameterObject(transformParameters)
+            tfx.SetComputeDeformationField(deformationField)
+            tfx.SetLogToConsole(False)
+            self.vsc.runInThread(tfx.Update)
+            resImg = self.itk2sitk(tfx.GetOutput())
+            if deformationField:
+               defField = self.itk2sitk(tfx.GetOutputDeformationField(), isVector=True)
+         if labelImage:
+            resImg = sitk.Cast(resImg, sitk.sitkUInt8)
+      except VisSimCancelledError:
+         raise
+      except Exception as e:
+         print(e)
+         self.vsc.chkElxER(1, "transformix error at line"+ line +", check the log files")
+         return 1, None, None
+      self.vsc.chkElxER(0, "No error!")
+      return 0, resImg, defField
+
+  # Nx3 physical points (LPS) of the fixed image mapped to the moving image, None if it fails
+  @vsProfiled("transformix points")
+  def transformPoints(self, pts, transformParameters, outputPath, line=""):
+      print ("************  Transform points (in-process) **********************")
+      if not os.path.exists(outputPath):
+         os.makedirs(outputPath)
+      ptsPath = self.vsc.writePointsFile(pts, os.path.join(outputPath, "inputPoints.txt"))
+      # no image is resampled, a one voxel output grid is enough
+      transformParameters = self.setLastMapParameters(transformParameters, {"Size": ["1","1","1"]})
+      dummyImg = sitk.Image([1,1,1], sitk.sitkFloat32)
+      try:
+         if self.backend == "sitk":
+            tfx = sitk.TransformixImageFilter()
+            tfx.SetTransformParameterMap(transformParameters)
+            tfx.SetMovingImage(dummyImg)
+            tfx.SetFixedPointSetFileName(ptsPath)
+            tfx.SetOutputDirectory(outputPath)
+            tfx.LogToConsoleOff()
+            tfx.LogToFileOff()
+            self.vsc.runInThread(tfx.Execute, getattr(tfx, "Abort", None))
+         else:
+            import itk
+            dummyItkImg = self.sitk2itk(dummyImg)
+            self.vsc.runInThread(lambda: itk.transformix_pointset(dummyItkImg, transformParameters,
+                fixed_point_set_file_name=ptsPath, output_directory=outputPath))
+      except VisSimCancelledError:
+         raise
+      except Exception as e:
+         print(e)
+         self.vsc.chkElxER(1, "transformix error at line"+ line +", check the log files")
+         return None
+      return self.vsc.readOutputPoints(os.path.join(outputPath, "outputpoints.txt"))
+
+  # write the parameter maps as chained transform parameters files,
+  # initial transforms are given relative to the folder
+  def saveTransform(self, transformParameters, folderPath):
+      if self.backend == "sitk":
+         maps = list(transformParameters)
+      else:
+         maps = [transformParameters.GetParameterMap(i) for i in range(transformParameters.GetNumberOfParameterMaps())]
+      savedPaths = []
+      for i in range(len(maps)):
+          savedPath = os.path.join(folderPath, "TransformParameters."+str(i)+".txt")
+          if self.backend == "sitk":
+             sitk.WriteParameterFile(maps[i], savedPath)
+          else:
+             transformParameters.WriteParameterFile(maps[i], savedPath)
+          initialTp = ('"' + os.path.basename(savedPaths[-1]) + '"') if savedPaths else '"NoInitialTransform"'
+          savedPaths.append(self.vsc.writeTransformParameters(savedPath, savedPath, {"InitialTransformParametersFileName": initialTp}))
+      return savedPaths[-1]
+
+  # one transform that applies first and then second: second(first(x))
+  def composeTransforms(self, first, second, outputPath):
+      if self.backend == "sitk":
+         return list(first) + list(second)
+      import itk
+      parameterObject = itk.ParameterObject.New()
+      for transformParameters in [first, second]:
+          for i in range(transformParameters.GetNumberOfParameterMaps()):
+              parameterObject.AddParameterMap(transformParameters.GetParameterMap(i))
+      return parameterObject
+
+  # copy of the transform parameters with parameters of the last map changed
+  def setLastMapParameters(self, transformParameters, parameters):
+      if self.backend == "sitk":
+         maps = [dict(m) for m in transformParameters]
+         for key in parameters:
+             maps[-1][key] = list(parameters[key]) if isinstance(parameters[key], (list, tuple)) else [parameters[key]]
+         return maps
+      import itk
+      parameterObject = itk.ParameterObject.New()
+      for i in range(transformParameters.GetNumberOfParameterMaps()):
+          parameterObject.AddParameterMap(transformParameters.GetParameterMap(i))
+      for key in parameters:
+          parameterObject.SetParameter(parameterObject.GetNumberOfParameterMaps()-1, key, parameters[key])
+      return parameterObject
+
+  # ITKElastix is wrapped for float images only
+  def sitk2itk(self, img):
+      import itk
+      itkImg = itk.GetImageFromArray(sitk.GetArrayFromImage(img).astype(np.float32))
+      itkImg.SetOrigin(img.GetOrigin())
+      itkImg.SetSpacing(img.GetSpacing())
+      itkImg.SetDirection(itk.matrix_from_array(np.array(img.GetDirection()).reshape(3,3)))
+      return itkImg
+
+  def itk2sitk(self, itkImg, isVector=False):
+      import itk
+      img = sitk.GetImageFromArray(itk.GetArrayFromImage(itkImg), isVector=isVector)
+      img.SetOrigin(tuple(itkImg.GetOrigin()))
+      img.SetSpacing(tuple(itkImg.GetSpacing()))
+      img.SetDirection(itk.array_from_matrix(itkImg.GetDirection()).flatten().tolist())
+      return img
+
 #===================================================================
 #                           Test Class
 #===================================================================
-class VisSimCommonTest(ScriptedLoadableModuleLogic):
+class VisSimCommonTest(ScriptedLoadableModuleTest):
 
   def setUp(self):
     slicer.mrmlScene.Clear(0)
  
   def runTest(self):
     self.setUp()
-    print(VisSimCommonLogic().tstSum(10,20))
\ No newline at end of file
+    print(VisSimCommonLogic().tstSum(10,20))
+    self.testModelManifest()
+    self.testZipMemberDownload()
+    self.testPolylineLengths()
+    self.testSegmentsStatistics()
+    self.testRegistrationCache()
+    self.testFuseLabelImages()
+    self.testParameterChanges()
+    self.testElastixLog()
+    self.testElastixHistory()
+    self.testLabelMorphology()
+    self.testInverseTransformPoints()
+    self.testIJKToRASCache()
+
+  # an empty folder in the Slicer temporary folder
+  def getTestPath(self, name):
+    testPath = os.path.join(slicer.app.temporaryPath, "VisSimCommonTest", name)
+    if os.path.exists(testPath):
+       shutil.rmtree(testPath)
+    os.makedirs(testPath)
+    return testPath
+
+  def testModelManifest(self):
+    self.delayDisplay("Starting testModelManifest")
+    vsl = VisSimCommonLogic()
+    folderPath = self.getTestPath("model")
+    for name, data in [("a.txt", b"cochlea"), ("b.bin", os.urandom(10000))]:
+        with open(os.path.join(folderPath, name), 'wb') as f:
+             f.write(data)
+    sha256Sum = hashlib.sha256(b"".join(vsl.hashModelFile(p)[1] for p in vsl.getModelFiles(folderPath))).hexdigest()
+
+    # the first check is a full check, it writes the manifest
+    self.assertFalse(vsl.chkModelManifest(folderPath, "0"*64))
+    self.assertIsNone(vsl.readModelManifest(folderPath))
+    self.assertTrue(vsl.chkModelManifest(folderPath, sha256Sum))
+    manifest = vsl.readModelManifest(folderPath)
+    self.assertEqual(sorted(manifest['files'].keys()), ["a.txt", "b.bin"])
+    self.assertEqual(manifest['files']['a.txt']['size'], 7)
+
+    # a new time stamp with the same contents is still valid
+    aPath = os.path.join(folderPath, "a.txt")
+    st = os.stat(aPath)
+    os.utime(aPath, (st.st_atime, st.st_mtime + 10))
+    self.assertTrue(vsl.chkModelManifest(folderPath, sha256Sum))
+    self.assertEqual(vsl.readModelManifest(folderPath)['files']['a.txt']['mtime'], os.stat(aPath).st_mtime)
+
+    # changed, added and removed files are found
+    with open(aPath, 'wb') as f:
+         f.write(b"Cochlea")
+    self.assertFalse(vsl.chkModelManifest(folderPath, sha256Sum))
+    with open(aPath, 'wb') as f:
+         f.write(b"cochlea")
+    self.assertTrue(vsl.chkModelManifest(folderPath, sha256Sum, verifyFull=True))
+    with open(os.path.join(folderPath, "c.txt"), 'wb') as f:
+         f.write(b"scala")
+    self.assertFalse(vsl.chkModelManifest(folderPath, sha256Sum))
+    os.remove(os.path.join(folderPath, "c.txt"))
+    os.remove(aPath)
+    self.assertFalse(vsl.chkModelManifest(folderPath, sha256Sum))
+    self.delayDisplay("testModelManifest passed")
+
+  def testZipMemberDownload(self):
+    self.delayDisplay("Starting testZipMemberDownload")
+    vsl = VisSimCommonLogic()
+    testPath = self.getTestPath("download")
+    zipPath = os.path.join(testPath, "model.zip")
+    data = {"model/a.txt": b"cochlea scala tympani " * 20000, "model/b.bin": os.urandom(3000)}
+    with zipfile.ZipFile(zipPath, 'w') as zf:
+         zf.writestr("model/a.txt", data["model/a.txt"], zipfile.ZIP_DEFLATED)
+         zf.writestr("model/b.bin", data["model/b.bin"], zipfile.ZIP_STORED)
+
+    # a local path and a file link are read without range requests
+    remote = VisSimRemoteFile("file://" + zipPath)
+    self.assertEqual(remote.size, os.path.getsize(zipPath))
+    remote.seek(-22, 2)
+    self.assertEqual(remote.read(4), b"PK\x05\x06")
+    remote.close()
+
+    remote = VisSimRemoteFile(zipPath)
+    zf = zipfile.ZipFile(remote)
+    for info in zf.infolist():
+        targetPath = os.path.join(testPath, "out", info.filename)
+        self.assertFalse(vsl.isLocalFileUpToDate(targetPath, info))
+        vsl.extractZipMember(remote, zf, info, targetPath)
+        with open(targetPath, 'rb') as f:
+             self.assertEqual(f.read(), data[info.filename])
+        self.assertFalse(os.path.exists(targetPath + ".part"))
+        self.assertTrue(vsl.isLocalFileUpToDate(targetPath, info))
+
+    # a download is continued from the compressed bytes of its part file
+    info = zf.getinfo("model/a.txt")
+    targetPath = os.path.join(testPath, "out", info.filename)
+    nameLength, extraLength = struct.unpack("<HH", remote.readRange(info.header_offset + 26, info.header_offset + 30))
+    dataStart = info.header_offset + 30 + nameLength + extraLength
+    os.remove(targetPath)
+    with open(targetPath + ".part", 'wb') as f:
+         f.write(remote.readRange(dataStart, dataStart + info.compress_size//2))
+    vsl.extractZipMember(remote, zf, info, targetPath)
+    with open(targetPath, 'rb') as f:
+         self.assertEqual(f.read(), data[info.filename])
+
+    # a part file from another file fails the CRC check and is removed
+    with open(targetPath + ".part", 'wb') as f:
+         f.write(os.urandom(info.compress_size//2))
+    self.assertRaises(IOError, vsl.extractZipMember, remote, zf, info, targetPath)
+    self.assertFalse(os.path.exists(targetPath + ".part"))
+
+    with open(targetPath, 'wb') as f:
+         f.write(data[info.filename][::-1])
+    self.assertFalse(vsl.isLocalFileUpToDate(targetPath, info))
+    zf.close()
+    remote.close()
+    self.delayDisplay("testZipMemberDownload passed")
+
+  def testPolylineLengths(self):
+    self.delayDisplay("Starting testPolylineLengths")
+    vsl = VisSimCommonLogic()
+    length, arcLength = vsl.getPolylineLengths([[0,0,0],[3,4,0],[3,4,12]])
+    self.assertAlmostEqual(length, 17.0)
+    self.assertTrue(np.allclose(arcLength, [0,5,17]))
+    length, arcLength = vsl.getPolylineLengths([[1,2,3]])
+    self.assertEqual(length, 0.0)
+    self.assertEqual(len(arcLength), 1)
+
+    # the spline goes through the points, the first sample of each segment is a point
+    pts = np.array([[0,0,0],[10,0,0],[10,10,0],[0,10,5]], dtype=float)
+    curve = vsl.getCatmullRomPoints(pts, samplesPerSegment=8)
+    self.assertEqual(curve.shape, (3*8+1, 3))
+    self.assertTrue(np.allclose(curve[::8], pts))
+    self.assertGreater(vsl.getPolylineLengths(curve)[0], 0.9*vsl.getPolylineLengths(pts)[0])
+    # evenly spaced points on a line give the same line
+    linePts = np.outer(np.arange(5), [1.0,2.0,2.0])
+    self.assertAlmostEqual(vsl.getPolylineLengths(vsl.getCatmullRomPoints(linePts))[0], 12.0)
+    self.assertTrue(np.array_equal(vsl.getCatmullRomPoints(pts[0:2]), pts[0:2]))
+    self.delayDisplay("testPolylineLengths passed")
+
+  def testSegmentsStatistics(self):
+    self.delayDisplay("Starting testSegmentsStatistics")
+    vsl = VisSimCommonLogic()
+    spacing = [0.5, 0.5, 2.0]
+    labelArray = np.zeros((4,6,8), dtype=np.uint8)
+    labelArray[1:3, 2:4, 1:5] = 1
+    labelArray[3, 5, 7] = 2
+    masterArray = np.arange(labelArray.size, dtype=np.float32).reshape(labelArray.shape)
+    labelImg = sitk.GetImageFromArray(labelArray)  ; labelImg.SetSpacing(spacing)
+    masterImg = sitk.GetImageFromArray(masterArray) ; masterImg.SetSpacing(spacing)
+    labelNode  = sitkUtils.PushVolumeToSlicer(labelImg, None, "testLabel", "vtkMRMLLabelMapVolumeNode")
+    masterNode = sitkUtils.PushVolumeToSlicer(masterImg, None, "testMaster", "vtkMRMLScalarVolumeNode")
+    segNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+    slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelNode, segNode)
+
+    stats = vsl.getSegmentsStatistics(segNode, masterNode, ["voxelCount","volume","centroid","boundingBox","mean","min","max","std"])
+    segStats = [stats[segNode.GetSegmentation().GetNthSegmentID(i)] for i in range(2)]
+    values = masterArray[labelArray == 1]
+    self.assertEqual(segStats[0]['voxelCount'], 16)
+    self.assertAlmostEqual(segStats[0]['volume'], 8.0)
+    self.assertEqual(segStats[0]['boundingBox'], [[1,2,1],[4,3,2]])
+    self.assertAlmostEqual(segStats[0]['mean'], values.mean(), places=3)
+    self.assertAlmostEqual(segStats[0]['std'], values.std(), places=3)
+    self.assertEqual([segStats[0]['min'], segStats[0]['max']], [values.min(), values.max()])
+    # the images are in LPS, the centroid is in RAS
+    self.assertTrue(np.allclose(segStats[0]['centroid'], np.array([2.5,2.5,1.5]) * spacing * [-1,-1,1]))
+    self.assertEqual(segStats[1]['voxelCount'], 1)
+    self.assertEqual(segStats[1]['boundingBox'], [[7,5,3],[7,5,3]])
+    self.assertEqual(segStats[1]['mean'], masterArray[3,5,7])
+    self.delayDisplay("testSegmentsStatistics passed")
+
+  def testRegistrationCache(self):
+    self.delayDisplay("Starting testRegistrationCache")
+    vsl = VisSimCommonLogic()
+    testPath = self.getTestPath("regCache")
+    regCache = VisSimRegistrationCache(vsl, os.path.join(testPath, "cache"), maxBytes=1500)
+    parsPath  = os.path.join(testPath, "pars.txt")
+    atlasPath = os.path.join(testPath, "atlas.nrrd")
+    for filePath in [parsPath, atlasPath]:
+        with open(filePath, 'w') as f:
+             f.write("(MaximumNumberOfIterations 500)\n")
+    img = sitk.Image(8, 8, 8, sitk.sitkInt16)
+    getKey = lambda img=img, point=[10.0,20.0,30.0], side="L", options="": regCache.getKey(img, point, side, [parsPath], [atlasPath], options)
+
+    key = getKey()
+    self.assertEqual(getKey(), key)
+    # the point is rounded to 1/1000 voxel
+    self.assertEqual(getKey(point=[10.0001,20.0,30.0]), key)
+    self.assertNotEqual(getKey(point=[10.01,20.0,30.0]), key)
+    self.assertNotEqual(getKey(side="R"), key)
+    self.assertNotEqual(getKey(options="multi"), key)
+    changedImg = sitk.Image(img) ; changedImg.SetPixel(1, 2, 3, 7)
+    self.assertNotEqual(getKey(img=changedImg), key)
+    changedImg = sitk.Image(img) ; changedImg.SetSpacing([0.5,0.5,0.5])
+    self.assertNotEqual(getKey(img=changedImg), key)
+    with open(parsPath, 'w') as f:
+         f.write("(MaximumNumberOfIterations 250)\n")
+    self.assertNotEqual(getKey(), key)
+    key = getKey()
+    # a new atlas version
+    st = os.stat(atlasPath)
+    os.utime(atlasPath, (st.st_atime, st.st_mtime + 10))
+    self.assertNotEqual(getKey(), key)
+
+    # an entry is only found when it is complete, the least recently used entries are evicted
+    def writeEntry(folderPath):
+        with open(os.path.join(folderPath, "landmarks.json"), 'w') as f:
+             f.write(" " * 1000)
+    self.assertIsNone(regCache.load("a"))
+    regCache.store("a", writeEntry)
+    self.assertEqual(regCache.load("a"), os.path.join(regCache.cachePath, "a"))
+    os.utime(regCache.load("a"), (0, 0))
+    regCache.store("b", writeEntry)
+    self.assertIsNone(regCache.load("a"))
+    self.assertIsNotNone(regCache.load("b"))
+    self.assertEqual([n for n in os.listdir(regCache.cachePath) if n.endswith(".tmp")], [])
+    self.delayDisplay("testRegistrationCache passed")
+
+  def testFuseLabelImages(self):
+    self.delayDisplay("Starting testFuseLabelImages")
+    vsl = VisSimCommonLogic()
+    labelArrays = [np.array([[[0,1,1,2,0,1]]], dtype=np.uint8),
+                   np.array([[[0,1,2,2,1,2]]], dtype=np.uint8),
+                   np.array([[[1,1,2,0,2,0]]], dtype=np.uint8)]
+    labelImgs = []
+    for labelArray in labelArrays:
+        labelImg = sitk.GetImageFromArray(labelArray)
+        labelImg.SetSpacing([0.2,0.2,0.2]) ; labelImg.SetOrigin([1,2,3])
+        labelImgs.append(labelImg)
+
+    self.assertIs(vsl.fuseLabelImages(labelImgs[0:1]), labelImgs[0])
+    # majority vote, a tie goes to the lower label
+    fusedImg = vsl.fuseLabelImages(labelImgs)
+    self.assertEqual(sitk.GetArrayFromImage(fusedImg).tolist(), [[[0,1,2,2,0,0]]])
+    self.assertEqual(fusedImg.GetSpacing(), labelImgs[0].GetSpacing())
+    self.assertEqual(fusedImg.GetOrigin(), labelImgs[0].GetOrigin())
+    self.assertEqual(fusedImg.GetPixelID(), sitk.sitkUInt8)
+    # staple agrees with the vote where the majority is clear
+    fusedImg = vsl.fuseLabelImages(labelImgs, method="staple")
+    self.assertEqual(sitk.GetArrayFromImage(fusedImg)[0,0,0:4].tolist(), [0,1,2,2])
+    self.delayDisplay("testFuseLabelImages passed")
+
+  def testParameterChanges(self):
+    self.delayDisplay("Starting testParameterChanges")
+    vsl = VisSimCommonLogic()
+    testPath = self.getTestPath("parameters")
+    parsPath = os.path.join(testPath, "pars.txt")
+    with open(parsPath, 'w') as f:
+         f.write("// rigid\n(Transform \"EulerTransform\")\n(MaximumNumberOfIterations 500 250) // per resolution\n"
+                 "(NumberOfSpatialSamples 2000)\n(MaximumStepLength 0.5)\n(NumberOfHistogramBins 32)\n")
+    parameters = vsl.readParameterFile(parsPath)
+    self.assertEqual(list(parameters.keys()), ["Transform", "MaximumNumberOfIterations", "NumberOfSpatialSamples", "MaximumStepLength", "NumberOfHistogramBins"])
+    self.assertEqual(parameters["Transform"], '"EulerTransform"')
+    self.assertEqual(parameters["MaximumNumberOfIterations"], "500 250")
+    self.assertEqual(vsl.readParameterFile(vsl.writeParameterFile(parameters, os.path.join(testPath, "run_pars.txt"))), parameters)
+
+    overrides = vsl.parseParameterOverrides("MaximumStepLength=*2; NumberOfResolutions = 3;Metric;Transform=\"BSplineTransform\"")
+    self.assertEqual(list(overrides.items()), [("MaximumStepLength", "*2"), ("NumberOfResolutions", "3"), ("Transform", '"BSplineTransform"')])
+    self.assertEqual(vsl.parseParameterOverrides({"Metric": "AdvancedMattesMutualInformation"}), {"Metric": "AdvancedMattesMutualInformation"})
+    self.assertEqual(len(vsl.parseParameterOverrides(None)), 0)
+
+    # scaled integers stay integers and at least 1, unchanged values are not reported
+    applied = vsl.applyParameterChanges(parameters, vsl.elastixPresets["fast"])
+    self.assertEqual(applied, [["MaximumNumberOfIterations", "500 250", "125 62"], ["NumberOfSpatialSamples", "2000", "1000"]])
+    self.assertEqual(vsl.applyParameterChanges(parameters, {"MaximumNumberOfIterations": "*0.001"}), [["MaximumNumberOfIterations", "125 62", "1 1"]])
+    applied = vsl.applyParameterChanges(parameters, overrides)
+    self.assertEqual(applied, [["MaximumStepLength", "0.5", "1.0"], ["NumberOfResolutions", None, "3"], ["Transform", '"EulerTransform"', '"BSplineTransform"']])
+    # a missing or not numeric parameter can not be scaled
+    self.assertEqual(vsl.applyParameterChanges(parameters, {"Metric": "*2", "Transform": "*2"}), [])
+    self.assertNotIn("Metric", parameters)
+    self.assertEqual(len(vsl.applyParameterChanges(parameters, vsl.elastixPresets["default"])), 0)
+    self.delayDisplay("testParameterChanges passed")
+
+  def testElastixLog(self):
+    self.delayDisplay("Starting testElastixLog")
+    vsl = VisSimCommonLogic()
+    outputPath = self.getTestPath("elastixLog")
+    with open(os.path.join(outputPath, "elastix.log"), 'w') as f:
+         f.write("\n".join(["Running elastix with parameter file 0: \"pars.txt\".",
+                            "Resolution: 0",
+                            "1:ItNr\t2:Metric\t3a:Time\t3b:StepSize",
+                            "0\t-0.50\t1.0\t0.1", "1\t-0.60\t1.0\t0.1", "2\t-0.70\t1.0\t0.1",
+                            "Time spent in resolution 0 (ITK initialisation and iterating): 1.5",
+                            "Stopping condition: Maximum number of iterations has been reached.",
+                            "Final metric value  = -0.70",
+                            "Resolution: 1",
+                            "1:ItNr\t2:Metric\t3a:Time\t3b:StepSize",
+                            "0\t-0.80\t1.0\t0.1", "1\t-0.90\t1.0\t0.1",
+                            "Final metric value  = -0.90",
+                            "Running elastix with parameter file 1: \"parsNR.txt\".",
+                            "Resolution: 0",
+                            "ERROR: too many samples map outside moving image buffer",
+                            "Total time elapsed: 12.3s."]) + "\n")
+    # the metric curve of the second file is taken from its IterationInfo file
+    with open(os.path.join(outputPath, "IterationInfo.1.R0.txt"), 'w') as f:
+         f.write("1:ItNr\t2:Metric\n0\t-0.1\n1\t-0.2\n2\t-0.3\n3\t-0.4\n")
+
+    stats = vsl.readElastixLog(outputPath)
+    self.assertEqual(len(stats['parameterFiles']), 2)
+    resolutions = stats['parameterFiles'][0]['resolutions']
+    self.assertEqual([r['resolution'] for r in resolutions], [0, 1])
+    self.assertEqual([r['iterations'] for r in resolutions], [3, 2])
+    self.assertEqual(resolutions[0]['metric'], [-0.5, -0.6, -0.7])
+    self.assertEqual(resolutions[0]['seconds'], 1.5)
+    self.assertTrue(resolutions[0]['stoppingCondition'].startswith("Maximum number of iterations"))
+    self.assertEqual(stats['parameterFiles'][0]['finalMetric'], -0.9)
+    self.assertEqual(stats['parameterFiles'][1]['resolutions'][0]['metric'], [-0.1, -0.2, -0.3, -0.4])
+    self.assertEqual(stats['parameterFiles'][1]['resolutions'][0]['iterations'], 4)
+    self.assertEqual(stats['seconds'], 12.3)
+    self.assertEqual(len(stats['errors']), 1)
+
+    # no log gives no statistics
+    self.assertEqual(vsl.readElastixLog(self.getTestPath("noLog")), {'parameterFiles': [], 'seconds': None, 'errors': []})
+    self.delayDisplay("testElastixLog passed")
+
+  def testElastixHistory(self):
+    self.delayDisplay("Starting testElastixHistory")
+    vsl = VisSimCommonLogic()
+    testPath = self.getTestPath("elastixHistory")
+    history = VisSimElastixHistory(vsl, os.path.join(testPath, "elastixHistory"), maxRuns=4, minRuns=3)
+    parsPath = vsl.writeParameterFile(collections.OrderedDict([("NumberOfResolutions", "2"), ("MaximumNumberOfIterations", "500 250")]),
+                                      os.path.join(testPath, "pars.txt"))
+    parameters = vsl.readParameterFile(parsPath)
+
+    # the first resolution converges after about 100 iterations, the second needs all of its budget
+    convergedMetric = np.concatenate((np.linspace(-0.1, -1.0, 100), np.full(400, -1.0))).tolist()
+    linearMetric = np.linspace(-0.1, -1.0, 250).tolist()
+    needed = history.getNeededIterations(convergedMetric)
+    self.assertTrue(90 <= needed <= 130)
+    self.assertGreaterEqual(history.getNeededIterations(linearMetric), 0.9*250)
+    self.assertEqual(history.getNeededIterations([]), 0)
+    self.assertEqual(history.getBudget(parameters), [500, 250])
+    self.assertEqual(history.getBudget({"NumberOfResolutions": "3", "MaximumNumberOfIterations": "200"}), [200, 200, 200])
+
+    stats = {'parameterFiles': [{'resolutions': [{'resolution': 0, 'metric': convergedMetric}, {'resolution': 1, 'metric': linearMetric}]}]}
+    for i in range(3):
+        self.assertIsNone(history.getIterations(parameters))
+        history.add([parsPath], stats)
+    # the saturated resolution keeps its budget
+    itrs = int(math.ceil(1.25 * needed / 10.0)) * 10
+    self.assertEqual(history.getIterations(parameters), str(itrs) + " 250")
+    # a run copy with other iterations shares the history of its file
+    parameters["MaximumNumberOfIterations"] = "1000 250"
+    self.assertEqual(history.getIterations(parameters), str(itrs) + " 250")
+    parameters["NumberOfSpatialSamples"] = "2000"
+    self.assertIsNone(history.getIterations(parameters))
+
+    # another process writes its own file, the runs of both are merged
+    otherHistory = VisSimElastixHistory(vsl, history.historyPath, maxRuns=4, minRuns=3)
+    otherHistory.runsPath = os.path.join(history.historyPath, "runs_other_1.jsonl")
+    otherHistory.add([parsPath], stats)
+    key = history.getKey(vsl.readParameterFile(parsPath))
+    self.assertEqual(len(history.read()[key]), 4)
+    # a file keeps the last runs of each key, a cut line is skipped
+    for i in range(6):
+        history.add([parsPath], stats)
+    self.assertLessEqual(len(history.readRunsFile(history.runsPath)), 2*4)
+    with open(history.runsPath, 'a') as f:
+         f.write('{"time": ')
+    self.assertEqual(len(history.read()[key]), 4)
+    self.delayDisplay("testElastixHistory passed")
+
+  def testLabelMorphology(self):
+    self.delayDisplay("Starting testLabelMorphology")
+    vsl = VisSimCommonLogic()
+    # triple junction: 10 background, 5 voxels of label 1 with the centre and 12 of label 2,
+    # the median of the values is 1 but label 2 has the most votes
+    labelArray = np.array([0]*10 + [1]*5 + [2]*12, dtype=np.uint8).reshape(3,3,3)
+    self.assertEqual(labelArray[1,1,1], 1)
+    labelImg = sitk.GetImageFromArray(labelArray)
+    labelImg.SetSpacing([0.5,0.5,0.5])
+    smoothedImg = vsl.runLabelMorphology(labelImg, "median", 1.5)
+    self.assertEqual(sitk.GetArrayFromImage(smoothedImg)[1,1,1], 2)
+    self.assertEqual(smoothedImg.GetSpacing(), labelImg.GetSpacing())
+
+    # a small island is removed, a flat boundary stays
+    labelArray = np.zeros((5,5,5), dtype=np.uint8)
+    labelArray[:, :, 3:] = 1
+    labelArray[2,2,1] = 2
+    smoothedArray = sitk.GetArrayFromImage(vsl.getLabelMajority(sitk.GetImageFromArray(labelArray), [1,1,1]))
+    self.assertEqual(smoothedArray[2,2,1], 0)
+    self.assertTrue(np.array_equal(smoothedArray[:, :, 1:], labelArray[:, :, 1:] * (labelArray[:, :, 1:] == 1)))
+    # a tie keeps the voxel label, voxels outside the image do not vote
+    labelArray = np.array([[[0,1,1,2]]], dtype=np.uint8)
+    smoothedArray = sitk.GetArrayFromImage(vsl.getLabelMajority(sitk.GetImageFromArray(labelArray), [1,0,0]))
+    self.assertEqual(smoothedArray.tolist(), labelArray.tolist())
+    self.delayDisplay("testLabelMorphology passed")
+
+  def testInverseTransformPoints(self):
+    self.delayDisplay("Starting testInverseTransformPoints")
+    vsl = VisSimCommonLogic()
+    # an engine that moves the points with a known transform and counts the points
+    class TestEngine(object):
+      def __init__(self, transformFunc):
+          self.transformFunc = transformFunc
+          self.calls = 0
+      def transformPoints(self, pts, transformParameters, outputPath):
+          self.calls += 1
+          return self.transformFunc(pts)
+    lps = np.array([-1.0,-1.0,1.0])
+    ptsRAS = np.random.RandomState(0).uniform(-5, 5, (30,3))
+    smoothTransform = lambda P: P + 0.4*np.sin(P[:,[1,2,0]]/1.5) + [0.3,-0.2,0.1]
+
+    engine = TestEngine(smoothTransform)
+    pts = vsl.inverseTransformPoints(engine, ptsRAS, None, None)
+    err = np.linalg.norm(smoothTransform(pts*lps) - ptsRAS*lps, axis=1)
+    self.assertLess(err.max(), 2e-3)
+    self.assertEqual(engine.calls, 2)
+    self.assertEqual(vsl.inverseTransformStats['gridPoints'], 30*4**3)
+    self.assertTrue(vsl.inverseTransformStats['converged'])
+
+    # a strongly curved transform needs transformix steps for some points
+    curvedTransform = lambda P: P + 1.0*np.sin(P[:,[1,2,0]]/1.5)
+    pts = vsl.inverseTransformPoints(TestEngine(curvedTransform), ptsRAS, None, None)
+    self.assertLess(np.linalg.norm(curvedTransform(pts*lps) - ptsRAS*lps, axis=1).max(), 2e-3)
+
+    # a folded transform can not be inverted, the result is an error instead of wrong points
+    engine = TestEngine(lambda P: np.zeros_like(P))
+    self.assertIsNone(vsl.inverseTransformPoints(engine, ptsRAS[0:2], None, None))
+    self.assertLessEqual(engine.calls, 2 + 3)
+    self.assertFalse(vsl.inverseTransformStats['converged'])
+    self.delayDisplay("testInverseTransformPoints passed")
+
+  def testIJKToRASCache(self):
+    self.delayDisplay("Starting testIJKToRASCache")
+    vsl = VisSimCommonLogic()
+    vsl.ijk2rasCacheSize = 2
+    testPath = self.getTestPath("ijk2ras")
+    imgPaths = []
+    for i in range(3):
+        img = sitk.Image(4, 4, 4, sitk.sitkInt16)
+        img.SetSpacing([0.1*(i+1)]*3)
+        img.SetOrigin([1.0, 2.0, 3.0])
+        imgPaths.append(os.path.join(testPath, "img" + str(i) + ".nrrd"))
+        sitk.WriteImage(img, imgPaths[i])
+    for imgPath in imgPaths:
+        vsl.getIJKToRASArray(imgPath)
+    # the first image is not used since and is dropped
+    self.assertEqual(len(vsl.ijk2rasCache), 2)
+    self.assertFalse(os.path.abspath(imgPaths[0]) in vsl.ijk2rasCache)
+    M = vsl.getIJKToRASArray(imgPaths[0])
+    np.testing.assert_allclose(M, [[-0.1,0,0,-1.0],[0,-0.1,0,-2.0],[0,0,0.1,3.0],[0,0,0,1]], atol=1e-9)
+    np.testing.assert_allclose(vsl.getRASToIJKArray(imgPaths[0]).dot(M), np.eye(4), atol=1e-9)
+    self.assertEqual(list(vsl.ijk2rasCache.keys()), [os.path.abspath(imgPaths[2]), os.path.abspath(imgPaths[0])])
+    vsl.ijk2rasCache.clear()
+    self.delayDisplay("testIJKToRASCache passed")
\ No newline at end of file